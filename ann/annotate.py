@@ -10,7 +10,17 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import backends
+import bigrefgene
 import file_utils as fu
+import intervals
+import profiling
+import records
+import sweep
+import transcripts
 import utils as u
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
@@ -107,89 +117,581 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
+"""Base class for annotation stages
+
+A stage splits the work done for a variant line in two: lookup() queries
+the reference database and depends only on the locus returned by key(),
+while apply() folds the lookup result into the record (a records.Variant)
+and the stage's counters. Stages can therefore be chained over a record
+that was parsed once and kept in memory.
+"""
+class Stage(object):
+    # Names of the integer counters reported by writeLog()
+    counters = ('var_count', 'line_count')
+    logmode = 'a'
+
+    # Compiled reference snapshot (snapshot.Snapshot), if any
+    snapshot = None
+
+    # Sweep joins over the snapshot, per table, for coordinate-sorted
+    # input (see sweep.py); None disables them
+    sweeps = None
+
+    # Cross-job cache of lookup results (cache.AnnotationCache), if any
+    cache = None
+
+    # Version of the stage's reference data, recorded in the results and
+    # keying its cached lookups; None if unknown, and then its lookups are
+    # not cached
+    version = None
+
+    # Number of lookup results kept per job, so that a locus repeated in
+    # the input (e.g. multi-allelic sites, or calls of several callers) is
+    # only looked up once; 0 disables the memo
+    memo_size = 0
+
+    # Number of lookups kept in flight at once while the stage looks up a
+    # batch of keys, each on a connection of its own, so that it does not
+    # wait out the round trip to the database once per query; 1 looks them
+    # up one after the other
+    inflight = 1
+
+    # Whether apply() separates its INFO fragments with ';' even if INFO
+    # already ends with one, rather than going through appendInfo()
+    always_separates = False
+
+    def __init__(self, format='vcf', table=None, sep='\t'):
+        self.format = format
+        self.table = table
+        self.sep = sep
+        self.inds = getFormatSpecificIndices(format=format)
+        for c in self.counters:
+            setattr(self, c, 0)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Least recently used results of the job, by key
+        self.memo = OrderedDict()
+        self.profile = profiling.StageProfile()
+        # Reference data backend (see backends.py) of the database in use,
+        # unless the pipeline picks another one
+        self.backend = backends.getBackend()
+
+    """Identifies the stage, and any parameters its results depend on, in
+    the lookup cache
+    """
+    def cacheId(self):
+        return self.__class__.__name__ + ':' + str(self.table)
+
+    """Whether the stage's table is answered from the compiled reference
+    snapshot rather than by the database
+    """
+    def servedBySnapshot(self):
+        return (self.snapshot is not None) and \
+            self.snapshot.hasTable(self.table)
+
+    """Name of the reference data the stage annotates from, e.g. in the
+    results' ##annotationReference header lines
+    """
+    def referenceName(self):
+        return str(self.table)
+
+    def versionHeader(self):
+        return '##annotationReference=<ID=' + self.referenceName() + \
+            ',Version=' + str(self.version) + '>'
+
+    """INFO keys of the fragments apply() adds, so that they can be told
+    apart from those of other stages when a single stage is re-run (see
+    reannotate.py); None if they are not the stage's alone
+    """
+    def infoKeys(self):
+        return None
+
+    """Undoes what apply() did to the record outside of the stage's INFO
+    fragments
+    """
+    def unapply(self, variant):
+        return variant
+
+    def isHeader(self, line):
+        return (line.startswith('##') or line.startswith('CHROM') or
+            line.startswith('#CHROM'))
+
+    def key(self, variant):
+        variant = variant.locate(self.inds)
+        return (variant.chr_chrom, variant.pos_text)
+
+    def lookup(self, cursor, key):
+        raise NotImplementedError
+
+    """Rows of table (the stage's by default) overlapping pos on chr, from
+    the compiled reference snapshot when it holds the table and from the
+    backend otherwise; options are those of backends.ReferenceBackend's
+    overlap()
+    """
+    def overlapRows(self, cursor, chr, pos, table=None, limit=None,
+        **options):
+        table = table or self.table
+        if (self.snapshot is not None) and self.snapshot.hasTable(table):
+            rows = self.snapshotOverlap(table, chr, int(pos))
+            return rows if (limit is None) else rows[:limit]
+        return self.backend.overlap(cursor, table, chr, pos, limit=limit,
+            **options)
+
+    """Overlaps from the snapshot, through a sweep join while the stage's
+    input stays sorted and by binary search otherwise. Sweep joins given up
+    on unsorted input are counted in the stage's profile.
+    """
+    def snapshotOverlap(self, table, chr, pos):
+        rows = None
+        if self.sweeps is not None:
+            if table not in self.sweeps:
+                self.sweeps[table] = sweep.SweepJoin(self.snapshot, table)
+            join = self.sweeps[table]
+            if join.sorted:
+                rows = join.overlap(chr, pos)
+                if not join.sorted:
+                    self.profile.sweep_fallbacks += 1
+        if rows is None:
+            rows = self.snapshot.overlap(table, chr, pos)
+        self.profile.ref_rows += len(rows)
+        return rows
+
+    """Looks up a list of keys; stages that can fetch many loci per query
+    override this
+    """
+    def lookupBatch(self, cursor, keys):
+        return [self.lookup(cursor, key) for key in keys]
+
+    """Same as lookupBatch(), but answers the keys found in the lookup
+    cache from there and adds the results of the others to it. The
+    lookups are recorded in the stage's profile.
+    """
+    def cachedLookupBatch(self, cursor, keys):
+        with profiling.Timed(self.profile):
+            if cursor is not None:
+                cursor = profiling.ProfiledCursor(cursor, self.profile)
+            if (self.memo_size <= 0):
+                return self.storedLookupBatch(cursor, keys)
+
+            # Each distinct key is resolved once per job
+            memo = self.memo
+            missing = [key for key in dict.fromkeys(keys) if key not in memo]
+            found = dict(zip(missing, self.storedLookupBatch(cursor, missing)))
+            results = []
+            for key in keys:
+                if key in found:
+                    results.append(found[key])
+                else:
+                    results.append(memo[key])
+                    memo.move_to_end(key)
+            self.profile.memo_hits += len(keys) - len(missing)
+
+            memo.update(found)
+            while (len(memo) > self.memo_size):
+                memo.popitem(last=False)
+            return results
+
+    """lookupBatch() through the lookup cache, if any
+    """
+    def storedLookupBatch(self, cursor, keys):
+        if self.cache is None:
+            return self.pipelinedLookupBatch(cursor, keys)
+
+        found = self.cache.get(self.cacheId(), self.version, keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if (len(missing) > 0):
+            results = self.pipelinedLookupBatch(cursor, missing)
+            self.cache.put(self.cacheId(), self.version,
+                zip(missing, results))
+            found.update(zip(missing, results))
+
+        self.cache_hits = self.cache_hits + len(keys) - len(missing)
+        self.cache_misses = self.cache_misses + len(missing)
+        return [found[key] for key in keys]
+
+    """lookupBatch() with up to inflight lookups at a time: the keys are
+    split into consecutive runs, one on cursor and one on each connection
+    the pool can spare (without waiting for one, so that stages looked up
+    concurrently cannot starve each other), and their results are put
+    back together in key order. Snapshot lookups are local and run as is.
+    """
+    def pipelinedLookupBatch(self, cursor, keys):
+        if ((self.inflight <= 1) or (self.snapshot is not None) or
+            (cursor is None) or (len(keys) < 2)):
+            return self.lookupBatch(cursor, keys)
+
+        pool = u.db_pool()
+        conns = []
+        while (len(conns) < min(self.inflight, len(keys)) - 1):
+            conn = pool.acquire(block=False)
+            if conn is None:
+                break
+            conns.append(conn)
+        if (len(conns) == 0):
+            return self.lookupBatch(cursor, keys)
+
+        size = -(-len(keys) // (len(conns) + 1))
+        runs = [keys[i:i + size] for i in range(0, len(keys), size)]
+        profiles = [profiling.StageProfile() for conn in conns]
+
+        def lookupRun(conn, profile, run):
+            run_cursor = conn.cursor()
+            try:
+                return self.lookupBatch(
+                    profiling.ProfiledCursor(run_cursor, profile), run)
+            finally:
+                run_cursor.close()
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(conns)) as executor:
+                futures = [executor.submit(lookupRun, conn, profile, run)
+                    for (conn, profile, run) in
+                    zip(conns, profiles, runs[1:])]
+                results = list(self.lookupBatch(cursor, runs[0]))
+                for future in futures:
+                    results.extend(future.result())
+        finally:
+            for conn in conns:
+                pool.release(conn)
+
+        for profile in profiles:
+            self.profile.add(profile)
+        return results
+
+    def apply(self, variant, result):
+        raise NotImplementedError
+
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+    def getCounts(self):
+        return dict([(c, getattr(self, c)) for c in
+            self.counters + ('cache_hits', 'cache_misses')])
+
+    """Adds counts, e.g. those of the same stage run over another shard
+    of the input
+    """
+    def addCounts(self, counts):
+        for c in counts:
+            setattr(self, c, getattr(self, c) + counts[c])
+
+
+"""Appends records to the INFO column, unless the column already ends
+with a separator
+"""
+def appendInfo(variant, records):
+    if (variant.lastInfoChar() == ';'):
+        variant.appendInfo(records)
+    else:
+        variant.appendInfo(';' + records)
+    return variant
+
+
+"""Adds the ##annotationReference header line of each stage with a known
+version in front of the #CHROM line among items, if there is one, so that
+results record the reference versions that produced them. A line of the
+same reference that is already there (e.g. in results being re-annotated)
+is replaced. Stages whose version is not known get no line, e.g. the
+stages the database serves in a job that only knows the snapshot's
+version (see driver.getPipeline()): reannotate.py trusts these lines.
+"""
+def addReferenceVersions(items, stages):
+    for i in range(len(items)):
+        if isinstance(items[i], str) and items[i].startswith('#CHROM'):
+            for stage in stages:
+                if stage.version is None:
+                    continue
+                line = stage.versionHeader()
+                prefix = line[:line.index(',') + 1]
+                found = [j for j in range(i) if isinstance(items[j], str)
+                    and items[j].startswith(prefix)]
+                if (len(found) > 0):
+                    items[found[0]] = line
+                else:
+                    items.insert(i, line)
+                    i = i + 1
+            break
+    return items
+
+
+"""Looks up keys for a stage on a connection borrowed from the pool, for
+lookups running in worker threads
+"""
+def lookupPooled(stage, keys):
+    with u.db_connection() as conn:
+        cursor = conn.cursor()
+        results = stage.cachedLookupBatch(cursor, keys)
+        cursor.close()
+    return results
+
+
+"""Runs the stages over a chunk of items and returns them annotated.
+Items are (stripped) lines or, for lines an earlier stage has already
+parsed, records.Variant records; a line is parsed into a record by the
+first stage that does not recognize it as a header, and passed through
+unchanged by each stage that does. Each stage looks up the whole chunk at
+once.
+
+Results are always applied stage by stage in pipeline order, so INFO
+fragments come out in the canonical order. Given a thread pool executor,
+all stages' lookups run concurrently up front: stages only append to INFO
+(and dbSNP sets ID), and none of them rewrites the CHROM, POS, REF or ALT
+their keys are made of.
+"""
+def annotateRecords(items, stages, cursor, executor=None):
+    items = list(items)
+    todos = []
+    for stage in stages:
+        todo = []
+        for i in range(len(items)):
+            # Stages never rewrite the first column, so it tells whether
+            # the line is a header for every stage
+            if isinstance(items[i], str):
+                if stage.isHeader(items[i]):
+                    continue
+                items[i] = records.Variant(items[i].split(stage.sep))
+            elif stage.isHeader(items[i].fields[0]):
+                continue
+            todo.append(i)
+        todos.append(todo)
+
+    if executor is not None:
+        pending = [executor.submit(lookupPooled, stages[j],
+            [stages[j].key(items[i]) for i in todos[j]])
+            for j in range(len(stages))]
+
+    for j in range(len(stages)):
+        stage = stages[j]
+        todo = todos[j]
+        for i in todo:
+            items[i] = items[i].restrip()
+
+        if executor is None:
+            results = stage.cachedLookupBatch(cursor,
+                [stage.key(items[i]) for i in todo])
+        else:
+            results = pending[j].result()
+
+        with profiling.Timed(stage.profile):
+            for (i, result) in zip(todo, results):
+                items[i] = stage.apply(items[i], result)
+        stage.profile.lines_read += len(items)
+        stage.profile.lines_written += len(items)
+        stage.profile.variants += len(todo)
+        stage.profile.peak_rss_kb = profiling.peakRss()
 
-    inds = getFormatSpecificIndices(format=format)
+    return items
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
+"""Runs the stages over a chunk of (stripped) lines and returns the
+output lines (see annotateRecords)
+"""
+def annotateLines(lines, stages, cursor, executor=None):
+    return records.renderAll(annotateRecords(lines, stages, cursor,
+        executor=executor))
+
+
+"""Runs the stages over a single (stripped) line
+"""
+def annotateLine(line, stages, cursor):
+    return annotateLines([line], stages, cursor)[0]
+
+
+"""Reads a file in chunks of stripped lines
+"""
+def readChunks(fh, chunk_size=10000):
+    chunk = []
     for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
+        chunk.append(line.strip())
+        if (len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+    if (len(chunk) > 0):
+        yield chunk
+
+
+"""Runs a single stage from vcf + tmpextin to vcf + tmpextout and writes
+its counts to the job's count log. With spill_in (spill_out), the input
+(output) is a spill of parsed records (see records.py) rather than text,
+so that stages run one after the other only render the final output.
+"""
+def runStage(stage, vcf, tmpextin='', tmpextout='.1', spill_in=False,
+    spill_out=False):
+    if spill_in:
+        fh = open(vcf + tmpextin, 'rb')
+        chunks = records.readSpill(fh)
+    else:
+        fh = fu.openFile(vcf + tmpextin)
+        chunks = readChunks(fh)
+    fh_out = open(vcf + tmpextout, 'wb' if spill_out else 'w')
+
+    with u.db_connection() as conn:
+        cursor = conn.cursor()
+        for chunk in chunks:
+            items = addReferenceVersions(annotateRecords(chunk, [stage],
+                cursor), [stage])
+            if spill_out:
+                records.writeSpill(fh_out, items)
+            else:
+                for line in records.renderAll(items):
+                    fh_out.write(line + '\n')
+        cursor.close()
+
+    fh_log = open(vcf + '.count.log', stage.logmode)
+    stage.writeLog(fh_log)
+    fh_log.close()
+
+    fh.close()
+    fh_out.close()
+
+
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+""" 
+class DbSnpStage(Stage):
+    counters = ('var_count', 'linenum')
+    logmode = 'w'
+
+    # Maximum number of positions per batched query; None queries dbSNP
+    # once per variant
+    batch_size = 500
+
+    # Membership filter of the table (dbsnp_filter.DbSnpFilter), if any:
+    # variants it rules out are not looked up
+    membership = None
+
+    def __init__(self, format='vcf', table='dbSNP', varclass='SNV', sep='\t',
+        batch_size=batch_size):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.varclass = varclass
+        self.batch_size = batch_size
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def cacheId(self):
+        return Stage.cacheId(self) + ':' + self.varclass
+
+    def key(self, variant):
+        variant = variant.locate(self.inds)
+        return (variant.chrom, variant.pos_text, variant.ref)
+
+    def lookup(self, cursor, key):
+        chr, pos, ref = key
+        compRef = getComplementary(ref)
+
+        rows = self.backend.point_lookup(cursor, self.table, {'CHR': chr,
+            'POS': int(pos), 'REF': [ref, compRef], 'INFO': self.varclass})
+
+        rsids = []
+        mafs = []
+        for row in rows:
+            rsids.append(str(row[3]))
+            if (str(row[7]) != '.'):
+                mafs.append('GMAF=' + str(row[7]))
+
+        return (rsids, mafs)
+
+    """Stage.storedLookupBatch() of the keys that may be in dbSNP, going
+    by the membership filter; the others are found in it without a lookup
+    """
+    def storedLookupBatch(self, cursor, keys):
+        if self.membership is None:
+            return Stage.storedLookupBatch(self, cursor, keys)
+
+        candidates = [key for key in keys if self.mayBeInDbSnp(key)]
+        self.profile.filter_skips += len(keys) - len(candidates)
+        found = {}
+        if (len(candidates) > 0):
+            found = dict(zip(candidates,
+                Stage.storedLookupBatch(self, cursor, candidates)))
+        return [found.get(key, ([], [])) for key in keys]
+
+    """Whether the membership filter holds the variant's REF, or its
+    complement, at its position (as lookup() and lookupBatch() match it)
+    """
+    def mayBeInDbSnp(self, key):
+        chr, pos, ref = key
+        try:
+            return (self.membership.mayContain(chr, pos, ref) or
+                self.membership.mayContain(chr, pos, getComplementary(ref)))
+        except ValueError:
+            # Positions that are not numbers are left to the lookup
+            return True
+
+    """Fetches dbSNP rows for up to batch_size positions of a chromosome
+    per query and joins them back to the variants locally
+    """
+    def lookupBatch(self, cursor, keys):
+        if (self.batch_size is None):
+            return Stage.lookupBatch(self, cursor, keys)
+
+        positions = {}
+        for (chr, pos, ref) in keys:
+            positions.setdefault(chr, set()).add(int(pos))
+
+        # (chr, pos) -> [(REF, row), ...] in the order returned by the query
+        found = {}
+        for chr in positions:
+            chr_positions = sorted(positions[chr])
+            for i in range(0, len(chr_positions), self.batch_size):
+                batch = chr_positions[i:i + self.batch_size]
+                rows = self.backend.point_lookup(cursor, self.table,
+                    {'CHR': chr, 'POS': batch, 'INFO': self.varclass},
+                    columns=['*', 'POS', 'REF'])
+                for row in rows:
+                    found.setdefault((chr, int(row[-2])), []).append(
+                        (str(row[-1]).upper(), row))
+
+        results = []
+        for (chr, pos, ref) in keys:
+            refs = (ref.upper(), getComplementary(ref).upper())
             rsids = []
             mafs = []
-            if (len(rows) > 0):
-                for row in rows:
+            for (row_ref, row) in found.get((chr, int(pos)), []):
+                if (row_ref in refs):
                     rsids.append(str(row[3]))
                     if (str(row[7]) != '.'):
                         mafs.append('GMAF=' + str(row[7]))
+            results.append((rsids, mafs))
 
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+        return results
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+    def apply(self, variant, result):
+        rsids, mafs = result
+        self.linenum = self.linenum + 1
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        variant.fields[2] = '.'
+        if (len(rsids) > 0):
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
 
+            self.var_count = self.var_count + 1
+            if (variant.getInfo() == '.'):
+                variant.setInfo('DB' + maf_str)
             else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+                variant.appendInfo(';DB;VC=' + self.varclass + maf_str)
 
-            linenum = linenum + 1
+            variant.fields[2] = str(';'.join(rsids))
 
-        else:
-            fh_out.write(line + '\n')
+        return variant
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+    def writeLog(self, fh_log):
+        linenum = self.linenum + 1
+        ratioInDbSnp = (self.var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t'):
+    runStage(DbSnpStage(format=format, varclass=varclass, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -197,933 +699,636 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
 """
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
+class BigRefGeneStage(Stage):
+    counters = ()
+
+    # Resolve all three tiers for a chunk of variants with batched queries
+    # (see bigrefgene.py), instead of querying them in turn per variant
+    local_index = False
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def referenceName(self):
+        return 'BigRefGene'
+
+    def key(self, variant):
+        variant = variant.locate(self.inds)
+        return (variant.chrom, variant.pos_text, variant.ref, variant.alt)
+
+    """(REF, ALT) pairs a variant matches: the same alleles on either
+    strand, compared as MySQL does
+    """
+    def alleles(self, key):
+        chr, pos, ref, alt = key
+        return [(ref.upper(), alt.upper()),
+            (getComplementary(ref).upper(), getComplementary(alt).upper())]
+
+    """INFO record of the rows of a tier: their isoforms once each, in the
+    order of the rows; None without rows
+    """
+    def records(self, rows):
+        if (len(rows) == 0):
+            return None
+        return ';'.join(dict.fromkeys([collapseRefSeq('\t'.join([str(x)
+            for x in row[1:len(row)]])) for row in rows]))
+
+    def lookup(self, cursor, key):
+        chr, pos, ref, alt = key
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        backend = self.backend
+        alleles = self.alleles(key)
+
+        tiers = [
+            lambda: [row for row in backend.point_lookup(cursor,
+                'chrom_pos_equal_base', {'CHR': chr, 'start': int(pos),
+                'haplotypeReference': [ref, compRef],
+                'haplotypeAlternate': [alt, compAlt]})
+                if (str(row[4]).upper(), str(row[5]).upper()) in alleles],
+            lambda: backend.point_lookup(cursor, 'chrom_pos_equal_nobase',
+                {'CHR': chr, 'start': int(pos)}),
+            lambda: backend.overlap(cursor, 'chrom_pos_unequal', chr, pos,
+                chrom_col='CHR', start_col='start', end_col='end'),
+        ]
+
+        for tier in tiers:
+            rows = tier()
 
             if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+                return self.records(rows)
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+        return None
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
+    def lookupBatch(self, cursor, keys):
+        if not self.local_index:
+            return Stage.lookupBatch(self, cursor, keys)
 
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+        return [self.records(rows) for rows in bigrefgene.lookupBatch(
+            self.backend, cursor, keys, self.alleles)]
 
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+    def apply(self, variant, result):
+        if (result is not None):
+            variant.appendInfo(';' + result)
+            if variant.infoStartsWith(".;"):
+                variant.setInfo(variant.getInfo().replace('.;', '', 1))
+        return variant
 
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
+    def writeLog(self, fh_log):
+        pass
 
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
 
-            if (keep_going):
-                fh_out.write(line + '\n')
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
+    runStage(BigRefGeneStage(format=format, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-            vcf_linenum = vcf_linenum + 1
 
+"""Get information about location in gene structures
+"""
+class GenesStage(Stage):
+    counters = ('interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count')
+
+    # Classify against transcript models of the whole table loaded once
+    # per process, instead of querying the transcripts of every variant
+    transcript_models = False
+
+    # Look CpG islands up in an in-memory index of cpgIslandExt loaded once
+    # per process (see intervals.py), instead of querying each of them
+    cpg_index = False
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500,
+        sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.promoter_offset = promoter_offset
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def cacheId(self):
+        return Stage.cacheId(self) + ':' + str(self.promoter_offset)
+
+    """Transcripts starting or ending within promoter_offset of pos, from
+    the transcript models of the whole table when transcript_models is set
+    (see transcripts.py) and from the rows of a query otherwise. Returns
+    the transcript set and the indices of the transcripts in it.
+    """
+    def transcriptsAt(self, cursor, chr, pos):
+        promoter_offset = self.promoter_offset
+        if self.transcript_models:
+            tset = transcripts.getModels(cursor, backends.getBackend(),
+                self.table).chrom(chr)
+            return (tset, tset.overlapping(int(pos), int(promoter_offset)))
+
+        rows = self.backend.overlap(cursor, self.table, chr, pos,
+            start_col='txStart', end_col='txEnd', margin=int(promoter_offset))
+        tset = transcripts.TranscriptRows(rows)
+        return (tset, tset.overlapping(int(pos), int(promoter_offset)))
+
+    """Returns the putative promoter region for a CpG island at pos
+    """
+    def promoterRegion(self, cursor, chr, pos):
+        if self.cpg_index:
+            row = intervals.getIndex(cursor, backends.getBackend(),
+                'cpgIslandExt', ['chrom', 'chromStart', 'chromEnd',
+                'name']).first(chr, pos)
         else:
-            fh_out.write(line + '\n')
+            rows = self.backend.overlap(cursor, 'cpgIslandExt', chr, pos,
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'], limit=1)
+            row = rows[0] if (len(rows) > 0) else None
+
+        if (row is not None):
+            return 'putativePromoterRegion=' + "".join(str(row[3]).split())
+        return ''
+
+    def lookup(self, cursor, key):
+        chr, pos = key
+        promoter_offset = self.promoter_offset
+
+        tset, hits = self.transcriptsAt(cursor, chr, pos)
+        info = []
+        exonic_count = 0
+        promoter_count = 0
+        pos = int(pos)
+
+        cnt = 1
+        for i in hits:
+            txtStart = tset.txStarts[i]
+            txtEnd = tset.txEnds[i]
+            cdsStart = tset.cdsStarts[i]
+            cdsEnd = tset.cdsEnds[i]
+            exonCount = tset.exonCount(i)
+            strand = tset.strands[i]
+
+            promoter_plus = txtStart - int(promoter_offset)
+            promoter_minus = txtEnd + int(promoter_offset)
+            region = ""
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in tset.exonsAt(i, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+            elif (u.isBetween(pos, cdsStart, cdsEnd)):
+                for e in tset.exonsAt(i, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum = exonCount - e
+                    exons.append("exon=" +  "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                    exonic_count = exonic_count + 1
+                if (len(exons) > 0):
+                    region = ";".join(exons)
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and 
+                (strand == "+")):
+                region = self.promoterRegion(cursor, chr, pos)
+
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                region = self.promoterRegion(cursor, chr, pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+            else:
+                region = ''
 
+            if (region.startswith('putativePromoterRegion=')):
+                promoter_count = promoter_count + 1
 
-"""Get information about location in gene structures
-"""
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+            if (region != ''):
+                info.append(collapseGeneNames(row=tset.names[i],
+                    indices=indicesKnownGenes, region=region, cnt=cnt))
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
+            cnt = cnt + 1
 
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
+        return (len(hits), info, exonic_count, promoter_count)
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+    def apply(self, variant, result):
+        nrows, info, exonic_count, promoter_count = result
 
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+        if (nrows > 0):
+            #count location
+            info_field = clean_mysql_chars(variant.getInfo()).strip()
+            positionType = str(u.parse_field(info_field, 
+                'positionType', ';', '='))
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+            if (positionType == 'intron'):
+                self.intronic_count = self.intronic_count + nrows
+            elif (positionType == 'non_coding_intron'):
+                self.non_coding_intronic_count = \
+                    self.non_coding_intronic_count + nrows
+            elif (positionType == 'CDS'):
+                self.cds_count = self.cds_count + nrows
+            elif (positionType == 'non_coding_exon'):
+                self.non_coding_exonic_count = \
+                    self.non_coding_exonic_count + nrows
+            elif (positionType == 'utr5'):
+                self.utr5_count = self.utr5_count + nrows
+            elif (positionType == 'utr3'):
+                self.utr3_count = self.utr3_count + nrows
 
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+            self.exonic_count = self.exonic_count + exonic_count
+            self.promoter_count = self.promoter_count + promoter_count
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
-
-            linenum = linenum + 1
+            str_info = ";".join(info)
+            variant.appendInfo(';' + str_info)
 
         else:
-            fh_out.write(line + '\n')
+            variant.appendInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        return variant
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+        print(f"In \'3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In \'3 UTR {str(self.utr3_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+        print(f"In \'5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In \'5 UTR {str(self.utr5_count)}\n")
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
     tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(GenesStage(format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
+"""Method used in INDELS, where bigRefGeneTable is not applicable
+"""
+class ExonsEtAlStage(GenesStage):
+
+    def lookup(self, cursor, key):
+        chr, pos = key
+        promoter_offset = self.promoter_offset
+
+        tset, hits = self.transcriptsAt(cursor, chr, pos)
+        info = []
+        counts = dict([(c, 0) for c in self.counters])
+        pos = int(pos)
+
+        cnt = 1
+        for i in hits:
+            txtStart = tset.txStarts[i]
+            txtEnd = tset.txEnds[i]
+            cdsStart = tset.cdsStarts[i]
+            cdsEnd = tset.cdsEnds[i]
+            exonCount = tset.exonCount(i)
+            strand = tset.strands[i]
+
+            promoter_plus = txtStart - int(promoter_offset)
+            promoter_minus = txtEnd + int(promoter_offset)
+            region = ""
+            exons = []
+
+            if (cdsStart == cdsEnd):
+                for e in tset.exonsAt(i, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum =  exonCount - e
+                    exons.append("non_coding_exon=" + "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                    counts['non_coding_exonic_count'] += 1
+                if (len(exons) > 0):
+                    region='positionType=non_coding_exon;' + ";".join(exons)
+                else:
+                    counts['non_coding_intronic_count'] += 1
+                    region = 'positionType=non_coding_intron'
+
+            elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+                counts['cds_count'] += 1
+                for e in tset.exonsAt(i, pos):
+                    exnum = e + 1
+                    if (strand == '-'):
+                        exnum =  exonCount - e
+                    exons.append("exon=" + "ex" + \
+                        str(exnum) + '/' + str(exonCount))
+                    counts['exonic_count'] += 1
+                if (len(exons) > 0):
+                    region = 'positionType=CDS;' + ";".join(exons)
+                else:
+                    counts['intronic_count'] += 1
+                    region = 'positionType=CDS;' + 'intron'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+                (cdsStart < cdsEnd) and (strand == "+")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr5_count'] += 1
+                region = 'positionType=utr5'
+
+            elif (u.isBetween(pos, txtStart, cdsStart) and \
+                (cdsStart < cdsEnd) and (strand == "-")):
+                counts['utr3_count'] += 1
+                region = 'positionType=utr3'
+
+            elif (u.isBetween(pos, promoter_plus, txtStart) and \
+                (strand == "+")):
+                region = self.promoterRegion(cursor, chr, pos)
+                if (region != ''):
+                    counts['promoter_count'] += 1
+
+            elif (u.isBetween(pos, txtEnd, promoter_minus) and \
+                (strand == "-")):
+                region = self.promoterRegion(cursor, chr, pos)
+                if (region != ''):
+                    counts['promoter_count'] += 1
 
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                region = ''
 
-            linenum = linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
+            if (region != ''):
+                info.append(collapseGeneNames(
+                    row=tset.names[i], indices=indicesKnownGenes,
+                    region=region, cnt=cnt))
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+            cnt = cnt + 1
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        return (len(hits), info, counts)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    def apply(self, variant, result):
+        nrows, info, counts = result
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
+        if (nrows > 0):
+            self.addCounts(counts)
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+            str_info = ";".join(info)
+            variant.appendInfo(';' + str_info)
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
-
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
-
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+        else:
+            variant.appendInfo(";positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        return variant
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(ExonsEtAlStage(format=format, table=table,
+        promoter_offset=promoter_offset, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesStage(Stage):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def __init__(self, format='vcf', table='tfbsConsSites', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+    def key(self, variant):
+        variant = variant.locate(self.inds)
+        # For some reason this table has no "chr" preceeding number
+        chrIndex = variant.chrom
+        if (chrIndex in self.allowed_chrom):
+            return (chrIndex, variant.pos_text)
+        # chrom is not on the list
+        return None
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
+    def infoKeys(self):
+        return ['tfbsRegion']
 
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
+    def lookup(self, cursor, key):
+        if key is None:
+            return []
 
+        chrIndex, pos = key
+        if (self.snapshot is not None) and self.snapshot.hasTable(self.table):
+            rows = self.overlapRows(cursor, chrIndex, pos)
         else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
+            # One table per chromosome
+            rows = self.backend.overlap(cursor, self.table + chrIndex, None,
+                pos, chrom_col=None,
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+        records = []
 
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
+        for row in rows:
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            t = t.strip()
+            records.append('tfbsRegion' + '=' + t)
 
-        linenum = linenum + 1
+        return records
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, records):
+        if (len(records) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(records)
+            variant = appendInfo(variant, ';'.join(records))
+        return variant
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t'):
+    runStage(TfbsConsSitesStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GadAllStage(Stage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='gadAll', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def key(self, variant):
+        variant = variant.locate(self.inds)
+        # For some reason this table has no "chr" preceeding number
+        return (variant.chrom, variant.pos_text)
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def infoKeys(self):
+        return [str(self.table)]
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, chrom_col='chromosome')
+        records = []
+        r_tmp = []
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        for row in rows:
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]) )
+                records.append(str(self.table) + '=' + str(row[3]))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        return (len(rows), records)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def apply(self, variant, result):
+        nrows, records = result
+        if (nrows > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + nrows
+            variant = appendInfo(variant, ';'.join(records))
+            # Annotated lines have always been written out joined by '\t '
+            variant.indent(' ')
+        return variant
+
+    def unapply(self, variant):
+        variant.unindent(' ')
+        return variant
+
+
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t'):
+    runStage(GadAllStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GwasCatalogStage(Stage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='gwasCatalog', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def infoKeys(self):
+        return [str(self.table)]
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, start_col='chromEnd',
+            end_col='chromEnd')
+        records = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        for row in rows:
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        return records
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, records):
+        if (len(records) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(records)
+            variant = appendInfo(variant, ';'.join(records))
+        return variant
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(GwasCatalogStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HugoGeneNomenclatureStage(Stage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='hugo', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def infoKeys(self):
+        return ['HGNC_GeneAnnotation']
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos)
+        records = []
+        r_tmp = []
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
+        for row in rows:
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        return (len(rows), records)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, result):
+        nrows, records = result
+        if (nrows > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + nrows
+            variant = appendInfo(variant, ','.join(records).replace(';', ','))
+        return variant
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(HugoGeneNomenclatureStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GenomicSuperDupsStage(Stage):
+    always_separates = True
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='genomicSuperDups', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def infoKeys(self):
+        return [str(self.table), 'otherChrom', 'otherStart', 'otherEnd']
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, limit=1)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            row = rows[0]
+            # otherChrom, otherStart, otherEnd
+            return (str(row[7]), str(row[8]), str(row[9]))
+        return None
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, result):
+        if result is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            otherChrom, otherStart, otherEnd = result
+            variant.appendInfo(';' + str(self.table) + '=' + \
+                str(True) + ';' + 'otherChrom=' + \
+                str(otherChrom) + ';otherStart=' + \
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
+        return variant
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(GenomicSuperDupsStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneOverlapStage(Stage):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1336,146 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def __init__(self, format='vcf', table='refGene', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, start_col=self.startName,
+            end_col=self.endName)
+        overlapsWith = []
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+        for row in rows:
+            overlapsWith.append(self.name2 + '=' + \
+                str(row[self.colindex2]) + ';' + self.name + '=' + \
+                str(row[self.colindex]))
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        return overlapsWith
+
+    def apply(self, variant, overlapsWith):
+        if (len(overlapsWith) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(overlapsWith)
+            genes = ';'.join([str(x) for x in overlapsWith])
+            variant = appendInfo(variant, str(genes))
+        return variant
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(RefGeneOverlapStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+class CytobandStage(Stage):
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+    def __init__(self, format='vcf', table='cytoBand', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def infoKeys(self):
+        return [str(self.table)]
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, start_col=self.startName,
+            end_col=self.endName)
+        overlapsWith = []
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        for row in rows:
+            overlapsWith.append(str(row[self.colindex]))
+
+        return (len(rows), u.dedup(overlapsWith))
+
+    def apply(self, variant, result):
+        nrows, overlapsWith = result
+        if (nrows > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + nrows
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+            variant = appendInfo(variant, str(self.table) + '=' + str(cytoband))
+        return variant
+
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(CytobandStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseStage(Stage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='dgv_Cnv', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def infoKeys(self):
+        return [str(self.table)]
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, cursor, key):
+        chr, pos = key
+        return (len(self.overlapRows(cursor, chr, pos, limit=1)) > 0)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def apply(self, variant, isOverlap):
+        if isOverlap:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            variant = appendInfo(variant, str(self.table) + '=' + str(isOverlap))
+        return variant
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(CnvDatabaseStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAStage(Stage):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, format='vcf', table='targetScanS', sep='\t'):
+        Stage.__init__(self, format=format, table=table, sep=sep)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def infoKeys(self):
+        return ['miRNAsites']
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    def lookup(self, cursor, key):
+        chr, pos = key
+        rows = self.overlapRows(cursor, chr, pos, limit=1)
 
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (len(rows) > 0):
+            row = rows[0]
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            return 'miRNAsites=' + t.strip()
+        return None
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, variant, t):
+        if t is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            variant = appendInfo(variant, t)
+        return variant
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def writeLog(self, fh_log):
+        fh_log.write(f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n")
+
+
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t'):
+    runStage(MiRNAStage(format=format, table=table, sep=sep),
+        vcf, tmpextin=tmpextin, tmpextout=tmpextout)
 
-### EOF
\ No newline at end of file
+### EOF
@@ -1,7 +1,9 @@
 import boto3
 import os
+import time
 import subprocess
 import json
+import threading
 from botocore.exceptions import ClientError
 import configparser
 import helpers
@@ -14,6 +16,13 @@ AWS_REGION = config.get('AWS', 'REGION')
 SQS_URL = config.get('SQS', 'REQUESTS_URL')
 DDB_TABLE_NAME = config.get('DDB', 'TABLE_NAME')
 INPUT_BUCKET = config.get('S3', 'INPUT_BUCKET')
+# Job requests stay on the queue, hidden for VISIBILITY_TIMEOUT seconds at
+# a time, until their job completes; the request of a job whose annotator
+# died becomes visible again and the job is rescheduled
+VISIBILITY_TIMEOUT = config.getint('SQS', 'VISIBILITY_TIMEOUT', fallback=600)
+# Number of times a job request is received (i.e. the job is attempted)
+# before the job is marked FAILED and its request deleted
+MAX_RECEIVES = config.getint('SQS', 'MAX_RECEIVES', fallback=3)
 
 # current directory
 # https://www.geeksforgeeks.org/get-current-directory-python/
@@ -28,27 +37,127 @@ table = dynamoDB.Table(DDB_TABLE_NAME)
 def update_job_status(job_id):
     try:
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/update_item.html
+        # A rescheduled job is already RUNNING
         response = table.update_item(
             Key={'job_id': job_id},
             UpdateExpression='SET job_status = :status',
-            ConditionExpression='job_status = :expected_status',
+            ConditionExpression='job_status IN (:pending, :status)',
             ExpressionAttributeValues={
                 ':status': 'RUNNING',
-                ':expected_status': 'PENDING'
+                ':pending': 'PENDING'
             }
         )
     except ClientError as e:
         print(f"Failed to update DynamoDB item status for job {job_id}: {e}")
         raise
 
+def fail_job(job_id, receipt_handle):
+    try:
+        # A job that completed meanwhile stays COMPLETED
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :failed',
+            ConditionExpression='job_status IN (:pending, :running)',
+            ExpressionAttributeValues={
+                ':failed': 'FAILED',
+                ':pending': 'PENDING',
+                ':running': 'RUNNING'
+            }
+        )
+        print(f"Job {job_id} failed {MAX_RECEIVES} times, marked FAILED.")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Failed to mark job {job_id} FAILED: {e}")
+            # Left for a later attempt to mark
+            return
+    delete_message(job_id, receipt_handle)
+
+def delete_message(job_id, receipt_handle):
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
+        sqs_client.delete_message(
+            QueueUrl=SQS_URL,
+            ReceiptHandle=receipt_handle
+        )
+        print(f"Message for job {job_id} deleted in SQS.")
+    except Exception as e:
+        print(f"Failed to delete message for job {job_id} in SQS: {e}")
+
+# Requests this annotator is working on, from their receipt until their
+# job is started, done or given up: job_id -> receipt handle. The
+# heartbeat thread keeps them hidden meanwhile.
+hidden = {}
+hidden_lock = threading.Lock()
+
+def hide(job_id, receipt_handle):
+    with hidden_lock:
+        hidden[job_id] = receipt_handle
+
+def unhide(job_id):
+    with hidden_lock:
+        hidden.pop(job_id, None)
+
+def heartbeat():
+    """
+    Extend the visibility of the hidden requests every third of
+    VISIBILITY_TIMEOUT, whatever the main loop is doing (e.g. downloading
+    a large input), so that they do not become visible again while their
+    job runs here; SQS limits a request's total visibility to 12 hours.
+    """
+    while True:
+        time.sleep(VISIBILITY_TIMEOUT / 3)
+        with hidden_lock:
+            requests = list(hidden.items())
+        for (job_id, receipt_handle) in requests:
+            try:
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+                sqs_client.change_message_visibility(
+                    QueueUrl=SQS_URL,
+                    ReceiptHandle=receipt_handle,
+                    VisibilityTimeout=VISIBILITY_TIMEOUT
+                )
+            except ClientError as e:
+                print(f"Failed to extend visibility of job {job_id}: {e}")
+
+# Jobs started by this annotator: job_id -> [process, number of times their
+# request was received]
+running = {}
+
+def check_jobs():
+    """
+    Delete the requests of jobs that completed. The request of a failed
+    job is left to become visible again, so that the job is retried (from
+    its last checkpoint, see run.py), unless it was attempted MAX_RECEIVES
+    times: the job is then marked FAILED and its request deleted.
+    """
+    for job_id in list(running):
+        process, receives = running[job_id]
+        if process.poll() is None:
+            continue
+        with hidden_lock:
+            receipt_handle = hidden[job_id]
+        if process.returncode == 0:
+            delete_message(job_id, receipt_handle)
+        else:
+            print(f"Job {job_id} failed with exit code {process.returncode}.")
+            if receives >= MAX_RECEIVES:
+                fail_job(job_id, receipt_handle)
+        unhide(job_id)
+        del running[job_id]
+
+threading.Thread(target=heartbeat, daemon=True).start()
+
 while True:
+    check_jobs()
     try:
         # Poll the message queue in a loop
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
         response = sqs_client.receive_message(
             QueueUrl=SQS_URL,
             MaxNumberOfMessages=1,
-            WaitTimeSeconds=5
+            WaitTimeSeconds=5,
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
+            AttributeNames=['ApproximateReceiveCount']
         )
     except ClientError as e:
         print(f"SQS Failed to receive messages: {e}")
@@ -61,6 +170,7 @@ while True:
     message = messages[0]
     # parse the message body
     receipt_handle = message['ReceiptHandle']
+    receives = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
     body = json.loads(message['Body'])
     msg = json.loads(body['Message'])
 
@@ -68,6 +178,20 @@ while True:
     job_id = msg['job_id']
     key = msg['s3_key_input_file']
     user_id = msg['user_id']
+
+    if job_id in running:
+        # Redelivered while the job still runs here; only the latest
+        # receipt handle of a request is valid
+        hide(job_id, receipt_handle)
+        running[job_id][1] = receives
+        continue
+
+    if receives > MAX_RECEIVES:
+        # Attempted MAX_RECEIVES times already, by annotators that failed
+        # or died
+        fail_job(job_id, receipt_handle)
+        continue
+    hide(job_id, receipt_handle)
     
     # use helper function to get user name and email
     # user_profile = helpers.get_user_profile(id=user_id)
@@ -85,26 +209,28 @@ while True:
         s3_client.download_file(INPUT_BUCKET, key, file_path)
     except ClientError as e:
         print(f"Failed to download file from S3 for job {job_id}: {e}")
+        unhide(job_id)
         continue
     
+    # update DynamoDB item to RUNNING; a job that is no longer pending or
+    # running (e.g. completed before its request was redelivered) is done
+    try:
+        update_job_status(job_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            delete_message(job_id, receipt_handle)
+        unhide(job_id)
+        continue
+
     # run the annotation job in a subprocess
     command = ['python', 'run.py', f'{job_id}/{os.path.basename(key)}', job_id, user_id, user_name, user_email]
     try:
         # https://stackoverflow.com/questions/12605498/how-to-use-subprocess-popen-python
-        subprocess.Popen(command, cwd=CUR_DIR)
-        # update DynamoDB item to RUNNING
-        update_job_status(job_id)
+        process = subprocess.Popen(command, cwd=CUR_DIR)
         print(f"Job {job_id} started with input file {os.path.basename(key).split('~')[-1]}.")
     except Exception as e:
         print(f"Failed to start job {job_id}: {e}")
+        unhide(job_id)
     else:
-        # If Popen succeeds, then attempt to delete the message
-        try:
-            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/delete_message.html
-            sqs_client.delete_message(
-                QueueUrl=SQS_URL,
-                ReceiptHandle=receipt_handle
-            )
-            print(f"Message for job {job_id} deleted in SQS.")
-        except Exception as e:
-            print(f"Failed to delete message for job {job_id} in SQS: {e}")
\ No newline at end of file
+        # The request is deleted once the job completes (see check_jobs)
+        running[job_id] = [process, receives]
\ No newline at end of file
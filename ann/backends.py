@@ -0,0 +1,501 @@
+# backends.py
+#
+# Reference data backends: how the annotation stages look rows up in the
+# reference tables. The stages describe what they need (rows at a point,
+# rows overlapping a position) and the backend decides how to find them.
+#
+##
+
+import itertools
+import threading
+from collections import namedtuple, OrderedDict
+
+import pymysql
+
+import bins
+import intervals
+import profiling
+import utils as u
+
+
+# Bound beyond any position, for range predicates over whole chromosomes
+MAX_POSITION = 1 << 62
+
+_record_types = {}
+_record_types_lock = threading.Lock()
+
+"""Named tuple type for rows with the given column names. Records can be
+read by position, as the stages always have, or by column name; names
+that are not valid identifiers are renamed (see collections.namedtuple).
+"""
+def recordType(columns):
+    columns = tuple(columns)
+    with _record_types_lock:
+        if columns not in _record_types:
+            _record_types[columns] = namedtuple('Record', columns,
+                rename=True)
+        return _record_types[columns]
+
+
+"""Position of column name in a record's fields, ignoring case as MySQL
+does
+"""
+def fieldIndex(record, name):
+    return [f.upper() for f in record._fields].index(name.upper())
+
+
+"""Chromosome name without any chr prefix, as input and reference tables
+name chromosomes either way
+"""
+def chromKey(chrom):
+    chrom = str(chrom).strip()
+    if chrom.lower().startswith('chr'):
+        chrom = chrom[3:]
+    return chrom.upper()
+
+
+"""Interface of reference data backends
+
+Lookups take the cursor of the stage's (pooled) connection, so that a
+backend's queries run on the connection the stage was given.
+
+point_lookup() returns the rows of table whose columns equal the values
+of the where dict (a list or tuple value matches any of its items).
+overlap() returns the rows of table with start_col - margin <= pos <=
+end_col + margin on chrom (any chromosome if chrom_col is None), and
+batch_overlap() the overlap() of each (chrom, pos) pair of loci. Rows come
+back as records (see recordType), limited to the first limit rows if
+given; columns selects the columns returned (all if None). Rows come
+back in the order the SQL queries return them, which is not specified by
+the query but by the access path the engine takes (e.g. by start_col and
+then in table order through an index on (chrom_col, start_col), in table
+order through a table scan). Local backends reproduce it by reading the
+rows they answer from with the same range predicates (see
+SqlBackend.chromRows()), so that stages taking the first overlapping
+rows see the same ones whichever backend answers them.
+"""
+class ReferenceBackend(object):
+    name = None
+
+    def point_lookup(self, cursor, table, where, columns=None, limit=None):
+        raise NotImplementedError
+
+    def overlap(self, cursor, table, chrom, pos, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', margin=0, columns=None,
+        limit=None):
+        raise NotImplementedError
+
+    def batch_overlap(self, cursor, table, loci, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', margin=0, columns=None,
+        limit=None):
+        return [self.overlap(cursor, table, chrom, pos, chrom_col=chrom_col,
+            start_col=start_col, end_col=end_col, margin=margin,
+            columns=columns, limit=limit) for (chrom, pos) in loci]
+
+
+"""Backend running parameterized SQL queries on the stage's connection.
+With bin_index=True, overlap queries on tables with a UCSC bin column
+(see bins.py) are narrowed down to the bins that can hold overlapping
+rows, so that an index on (chrom, bin) answers them with equality
+lookups instead of scanning a two-sided range (see index_reference.py).
+"""
+class SqlBackend(ReferenceBackend):
+    # Query parameter placeholder and identifier quote of the dialect
+    placeholder = '%s'
+    quote = '`'
+
+    def __init__(self, bin_index=False):
+        self.bin_index = bin_index
+        self.columns = {}
+        self.lock = threading.Lock()
+
+    def column(self, name):
+        if (name == '*'):
+            return name
+        return self.quote + name + self.quote
+
+    def select(self, table, columns):
+        return 'select ' + ('*' if columns is None else
+            ', '.join([self.column(c) for c in columns])) + ' from ' + \
+            self.column(table)
+
+    """Column names of table, looked up once
+    """
+    def tableColumns(self, cursor, table):
+        with self.lock:
+            if table in self.columns:
+                return self.columns[table]
+        cursor.execute(self.select(table, None) + ' limit 0')
+        cursor.fetchall()
+        columns = [d[0] for d in cursor.description]
+        with self.lock:
+            self.columns[table] = columns
+        return columns
+
+    """Name of the bin column of table, None if it has none
+    """
+    def binColumn(self, cursor, table):
+        for column in self.tableColumns(cursor, table):
+            if (column.lower() == 'bin'):
+                return column
+        return None
+
+    def fetch(self, cursor, sql, params, limit):
+        if limit is not None:
+            sql = sql + ' limit ' + str(int(limit))
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        Record = recordType([d[0] for d in cursor.description])
+        return [Record(*row) for row in rows]
+
+    """Cursor on the connection of cursor that streams the rows of a
+    query instead of buffering them all first; cursor itself by default
+    """
+    def streamingCursor(self, cursor):
+        return cursor
+
+    """Rows of table overlapping [lo, hi] on chrom (on any chromosome if
+    chrom_col is None), streamed from the database, at most limit of them.
+    The query has the predicates of overlap(), so the engine returns the
+    rows in the order it returns overlaps in.
+    """
+    def window(self, cursor, table, chrom, lo, hi, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns=None,
+        limit=None):
+        conditions = []
+        params = []
+        if chrom_col is not None:
+            conditions.append(self.column(chrom_col) + ' = ' + self.placeholder)
+            params.append(chrom)
+        conditions.append(self.column(start_col) + ' <= ' + self.placeholder)
+        params.append(int(hi))
+        conditions.append(self.column(end_col) + ' >= ' + self.placeholder)
+        params.append(int(lo))
+        sql = self.select(table, columns) + ' where ' + \
+            ' AND '.join(conditions)
+        if limit is not None:
+            sql = sql + ' limit ' + str(int(limit))
+
+        stream = self.streamingCursor(cursor)
+        try:
+            stream.execute(sql, params)
+            Record = recordType([d[0] for d in stream.description])
+            return [Record(*row) for row in stream]
+        finally:
+            if stream is not cursor:
+                stream.close()
+
+    """Chromosomes of table, as chromRows() takes them
+    """
+    def chroms(self, cursor, table, chrom_col='chrom'):
+        cursor.execute('select distinct ' + self.column(chrom_col) +
+            ' from ' + self.column(table))
+        return [row[0] for row in cursor.fetchall()]
+
+    """All rows of table on chrom (all of the table if chrom_col is None),
+    in the order overlap() returns them in: read through the same range
+    predicates over every position, so that the engine takes the access
+    path it takes for overlaps rather than a plain table scan
+    """
+    def chromRows(self, cursor, table, chrom, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', columns=None):
+        return self.window(cursor, table, chrom, -MAX_POSITION, MAX_POSITION,
+            chrom_col=chrom_col, start_col=start_col, end_col=end_col,
+            columns=columns)
+
+    def point_lookup(self, cursor, table, where, columns=None, limit=None):
+        conditions = []
+        params = []
+        for (column, value) in where.items():
+            if isinstance(value, (list, tuple)):
+                conditions.append(self.column(column) + ' in (' +
+                    ','.join([self.placeholder] * len(value)) + ')')
+                params.extend(value)
+            else:
+                conditions.append(self.column(column) + ' = ' +
+                    self.placeholder)
+                params.append(value)
+        sql = self.select(table, columns)
+        if (len(conditions) > 0):
+            sql = sql + ' where ' + ' AND '.join(conditions)
+        return self.fetch(cursor, sql, params, limit)
+
+    def overlap(self, cursor, table, chrom, pos, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', margin=0, columns=None,
+        limit=None):
+        conditions = []
+        params = []
+        if chrom_col is not None:
+            conditions.append(self.column(chrom_col) + ' = ' + self.placeholder)
+            params.append(chrom)
+        candidates = None
+        if self.bin_index:
+            bin_col = self.binColumn(cursor, table)
+            # Rows ending at pos - margin match too, hence the extra base
+            if bin_col is not None:
+                candidates = bins.overlappingBins(int(pos) - margin - 1,
+                    int(pos) + margin + 1)
+            if candidates is not None:
+                conditions.append(self.column(bin_col) + ' in (' +
+                    ','.join([self.placeholder] * len(candidates)) + ')')
+                params.extend(candidates)
+        conditions.append(self.column(start_col) + ' <= ' + self.placeholder)
+        params.append(int(pos) + margin)
+        conditions.append(self.column(end_col) + ' >= ' + self.placeholder)
+        params.append(int(pos) - margin)
+        sql = self.select(table, columns) + ' where ' + \
+            ' AND '.join(conditions)
+        if candidates is None:
+            return self.fetch(cursor, sql, params, limit)
+
+        # Rows come back by bin; put them in the order of a range query
+        # through an index on (chrom, start_col) before limiting them, so
+        # that the stages see the same rows either way
+        rows = self.fetch(cursor, sql, params, None)
+        if (len(rows) > 0):
+            start_ind = fieldIndex(rows[0], start_col)
+            rows.sort(key=lambda row: int(row[start_ind]))
+        return rows if (limit is None) else rows[:limit]
+
+
+"""The RDS (MySQL) reference database, through pymysql
+"""
+class MySQLBackend(SqlBackend):
+    name = 'mysql'
+
+    # Unbuffered (server-side) cursor, counted in the stage's profile
+    def streamingCursor(self, cursor):
+        stream = cursor.connection.cursor(pymysql.cursors.SSCursor)
+        if isinstance(cursor, profiling.ProfiledCursor):
+            stream = profiling.ProfiledCursor(stream, cursor.profile)
+        return stream
+
+
+"""A SQLite copy of the reference database (see utils.SQLITE_DB)
+"""
+class SQLiteBackend(SqlBackend):
+    name = 'sqlite'
+    placeholder = '?'
+    quote = '"'
+
+
+"""Backend answering from in-memory indices of whole tables, loaded from
+a SQL backend on first use and shared by all stages (and jobs) of the
+process. Overlaps are found by bisection in per-chromosome interval
+arrays (see intervals.py), loaded a chromosome at a time with
+SqlBackend.chromRows() and returned in the order it read them in, point
+lookups in hash tables of the looked-up columns; values are compared
+case-insensitively, like MySQL does. Only suitable for tables that fit in
+memory.
+"""
+class MemoryBackend(ReferenceBackend):
+    name = 'memory'
+
+    def __init__(self, source):
+        self.source = source
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def normalize(self, value):
+        return str(value).upper()
+
+    def load(self, key, build):
+        with self.lock:
+            if key not in self.tables:
+                self.tables[key] = build()
+            return self.tables[key]
+
+    def rows(self, cursor, table, columns):
+        return self.source.point_lookup(cursor, table, {}, columns=columns)
+
+    def point_lookup(self, cursor, table, where, columns=None, limit=None):
+        names = tuple(sorted(where))
+
+        def build():
+            index = {}
+            rows = self.rows(cursor, table, columns)
+            if (len(rows) > 0):
+                fields = [fieldIndex(rows[0], n) for n in names]
+                for (i, row) in enumerate(rows):
+                    index.setdefault(tuple([self.normalize(row[f])
+                        for f in fields]), []).append((i, row))
+            return index
+
+        index = self.load(('point', table, names,
+            None if columns is None else tuple(columns)), build)
+
+        values = [where[n] if isinstance(where[n], (list, tuple))
+            else [where[n]] for n in names]
+        matches = {}
+        for combination in itertools.product(*values):
+            for (i, row) in index.get(tuple([self.normalize(v)
+                for v in combination]), []):
+                matches[i] = row
+        rows = [matches[i] for i in sorted(matches)]
+        return rows if limit is None else rows[:limit]
+
+    def overlap(self, cursor, table, chrom, pos, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', margin=0, columns=None,
+        limit=None):
+
+        def build():
+            by_chrom = {}
+            chroms = [None] if (chrom_col is None) else \
+                self.source.chroms(cursor, table, chrom_col=chrom_col)
+            for c in chroms:
+                rows = self.source.chromRows(cursor, table, c,
+                    chrom_col=chrom_col, start_col=start_col,
+                    end_col=end_col, columns=columns)
+                if (len(rows) > 0):
+                    start_ind = fieldIndex(rows[0], start_col)
+                    end_ind = fieldIndex(rows[0], end_col)
+                    by_chrom.setdefault(None if c is None else
+                        self.normalize(c), []).extend([(int(row[start_ind]),
+                        int(row[end_ind]), row) for row in rows])
+            return dict([(c, intervals.ChromIndex(rows)) for (c, rows) in
+                by_chrom.items()])
+
+        index = self.load(('overlap', table, chrom_col, start_col,
+            end_col, None if columns is None else tuple(columns)), build)
+
+        c = None if chrom_col is None else self.normalize(chrom)
+        if c not in index:
+            return []
+        rows = index[c].overlap(int(pos), margin=margin)
+        return rows if limit is None else rows[:limit]
+
+
+"""Backend answering the overlaps of a job from windows of the tables
+prefetched from a SQL backend (source), one per table and chromosome:
+the first overlap looked up on a chromosome streams in all rows
+overlapping the range of positions the job has on it (ranges, by
+chromKey()), and the job's other positions on the chromosome are then
+found by bisection (see intervals.py). Windows are read with the
+predicates of the source's overlap() queries, and rows come back in the
+order the window query returned them, i.e. that of overlap().
+
+At most max_rows rows are held at once, over all windows (those being
+loaded aside); the least
+recently used windows are dropped to make room for new ones. Overlaps on
+chromosomes the job has no range for, in tables without a chromosome
+column, or whose window alone would exceed max_rows are looked up in the
+source, as are point lookups.
+
+A window is loaded outside of the backend's lock, so that the stages
+keep answering overlaps from the other windows meanwhile; threads
+overlapping in a window that is being loaded wait for it.
+"""
+class PrefetchBackend(ReferenceBackend):
+    name = 'prefetch'
+
+    def __init__(self, source, max_rows, ranges=None):
+        self.source = source
+        self.max_rows = max_rows
+        self.ranges = ranges or {}
+        self.windows = OrderedDict()
+        self.held = 0
+        self.fallback = set()
+        # Windows being loaded, by key, set once they are
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def point_lookup(self, cursor, table, where, columns=None, limit=None):
+        return self.source.point_lookup(cursor, table, where,
+            columns=columns, limit=limit)
+
+    """Window of key and the range of positions it covers, loading it if
+    need be; None to look up in the source
+    """
+    def getWindow(self, cursor, key, table, chrom, chrom_col, start_col,
+        end_col, margin, columns):
+        while True:
+            with self.lock:
+                if key in self.fallback:
+                    return None
+                if key in self.windows:
+                    self.windows.move_to_end(key)
+                    return self.windows[key]
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    loaded = threading.Event()
+                    self.loading[key] = loaded
+                    break
+            # Loaded by another thread; if it failed, load it here
+            loaded.wait()
+
+        try:
+            span = None if (chrom_col is None) else \
+                self.ranges.get(chromKey(chrom))
+            rows = []
+            if span is not None:
+                rows = self.source.window(cursor, table, chrom,
+                    span[0] - margin, span[1] + margin, chrom_col=chrom_col,
+                    start_col=start_col, end_col=end_col, columns=columns,
+                    limit=self.max_rows + 1)
+            if (span is None) or (len(rows) > self.max_rows):
+                with self.lock:
+                    self.fallback.add(key)
+                return None
+
+            if (len(rows) > 0):
+                start_ind = fieldIndex(rows[0], start_col)
+                end_ind = fieldIndex(rows[0], end_col)
+            index = intervals.ChromIndex([(int(row[start_ind]),
+                int(row[end_ind]), row) for row in rows])
+            with self.lock:
+                while (len(self.windows) > 0) and \
+                    (self.held + len(rows) > self.max_rows):
+                    old_key, (old_span, old_index) = \
+                        self.windows.popitem(last=False)
+                    self.held = self.held - len(old_index.rows)
+                self.windows[key] = (span, index)
+                self.held = self.held + len(rows)
+                return self.windows[key]
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loaded.set()
+
+    def overlap(self, cursor, table, chrom, pos, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd', margin=0, columns=None,
+        limit=None):
+        key = (table, chrom, chrom_col, start_col, end_col, margin,
+            None if columns is None else tuple(columns))
+        window = self.getWindow(cursor, key, table, chrom, chrom_col,
+            start_col, end_col, margin, columns)
+        if (window is None) or not (window[0][0] <= int(pos) <= window[0][1]):
+            return self.source.overlap(cursor, table, chrom, pos,
+                chrom_col=chrom_col, start_col=start_col, end_col=end_col,
+                margin=margin, columns=columns, limit=limit)
+        rows = window[1].overlap(int(pos), margin=margin)
+        return rows if (limit is None) else rows[:limit]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+"""Get the (process-wide) backend of the given name: mysql, sqlite or
+memory, which loads from the database in use. Without a name, the backend
+of the database utils.db_connect() connects to. bin_index applies to the
+SQL backends (the memory backend's indices need no bins).
+"""
+def getBackend(name=None, bin_index=False):
+    source = SQLiteBackend if u.SQLITE_DB else MySQLBackend
+    if not name:
+        name = source.name
+    if (name == MemoryBackend.name):
+        bin_index = False
+    with _backends_lock:
+        if (name, bin_index) not in _backends:
+            if (name == MySQLBackend.name):
+                backend = MySQLBackend(bin_index=bin_index)
+            elif (name == SQLiteBackend.name):
+                backend = SQLiteBackend(bin_index=bin_index)
+            elif (name == MemoryBackend.name):
+                backend = MemoryBackend(source())
+            else:
+                raise ValueError(f"Unknown reference backend: {name}")
+            _backends[(name, bin_index)] = backend
+        return _backends[(name, bin_index)]
+
+### EOF
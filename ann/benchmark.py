@@ -0,0 +1,421 @@
+# benchmark.py
+#
+# Offline annotation benchmark: annotates a synthetic VCF against a
+# synthetic SQLite stand-in for the reference database, and reports the
+# throughput of each stage
+#
+# Usage: python benchmark.py <work_dir> [--variants N] [--chroms 1,2,X:0.5]
+#            [--sorted FRACTION] [--baseline FILE] [--save FILE]
+#            [--compare-bin-index] ...
+#
+##
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import argparse
+
+import bins
+import utils as u
+
+CHROMS = [str(c) for c in range(1, 23)] + ['X', 'Y']
+BASES = 'ACGT'
+
+CNV_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+# Tables of the reference database, with the columns annotate.py reads
+# from them (by position, for select * queries)
+TRANSCRIPT_COLUMNS = '(id, CHR, start int, "end" int, haplotypeReference, ' + \
+    'haplotypeAlternate, name, name2, transcriptStrand, positionType, frame)'
+SCHEMA = {
+    'dbSNP': '(CHR, POS int, REF, RSID, ALT, QUAL, FILT, GMAF, INFO)',
+    'chrom_pos_equal_base': TRANSCRIPT_COLUMNS,
+    'chrom_pos_equal_nobase': TRANSCRIPT_COLUMNS,
+    'chrom_pos_unequal': TRANSCRIPT_COLUMNS,
+    'refGene': '(bin int, name, chrom, strand, txStart int, txEnd int, ' +
+        'cdsStart int, cdsEnd int, exonCount int, exonStarts blob, ' +
+        'exonEnds blob, score int, name2, cdsStartStat, cdsEndStat, ' +
+        'exonFrames)',
+    'cpgIslandExt': '(chrom, chromStart int, chromEnd int, name)',
+    'cytoBand': '(chrom, chromStart int, chromEnd int, name, gieStain)',
+    'gadAll': '(chromosome, chromStart int, chromEnd int, geneSymbol, ' +
+        'diseaseClass)',
+    'gwasCatalog': '(bin int, chrom, chromStart int, chromEnd int, name, ' +
+        'pubMedID, author, pubDate, journal, title, trait)',
+    'targetScanS': '(bin int, chrom, chromStart int, chromEnd int, name, ' +
+        'score int)',
+    'hugo': '(chrom, chromStart int, chromEnd int, hgncId, status, ' +
+        'symbol, description)',
+    'genomicSuperDups': '(bin int, chrom, chromStart int, chromEnd int, ' +
+        'name, score int, strand, otherChrom, otherStart int, otherEnd int)',
+}
+for table in CNV_TABLES:
+    SCHEMA[table] = '(chrom, chromStart int, chromEnd int, name)'
+for chrom in CHROMS:
+    SCHEMA['tfbsConsSites' + chrom] = \
+        '(chrom, chromStart int, chromEnd int, name)'
+
+# Indices on the columns the annotator's queries filter on
+INDICES = {
+    'dbSNP': 'CHR, POS',
+    'chrom_pos_equal_base': 'CHR, start',
+    'chrom_pos_equal_nobase': 'CHR, start',
+    'chrom_pos_unequal': 'CHR, start',
+    'refGene': 'chrom, txStart',
+    'cpgIslandExt': 'chrom, chromStart',
+    'cytoBand': 'chrom, chromStart',
+    'gadAll': 'chromosome, chromStart',
+    'gwasCatalog': 'chrom, chromEnd',
+    'targetScanS': 'chrom, chromStart',
+    'hugo': 'chrom, chromStart',
+    'genomicSuperDups': 'chrom, chromStart',
+}
+
+# Spans of the rows of the tables with a UCSC bin column
+BIN_TABLES = {
+    'refGene': ('txStart', 'txEnd'),
+    'gwasCatalog': ('chromStart', 'chromEnd'),
+    'targetScanS': ('chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chromStart', 'chromEnd'),
+}
+
+
+"""Parses a chromosome mix such as "1,2,X:0.5" into (chrom, weight) pairs;
+chromosomes without a weight have weight 1
+"""
+def parseChroms(text):
+    mix = []
+    for item in text.split(','):
+        chrom, sep, weight = item.strip().partition(':')
+        chrom = chrom.replace('chr', '')
+        if chrom not in CHROMS:
+            raise ValueError(f"Unknown chromosome: {chrom}")
+        mix.append((chrom, float(weight) if sep else 1.0))
+    return mix
+
+
+"""Draws variant loci as (chrom, pos, ref, alt), sorted by chromosome (in
+the order given) and position
+"""
+def generateLoci(count, chroms, span, rng):
+    names = [c for (c, w) in chroms]
+    drawn = rng.choices(names, weights=[w for (c, w) in chroms], k=count)
+    loci = []
+    for chrom in drawn:
+        ref = rng.choice(BASES)
+        alt = rng.choice([b for b in BASES if b != ref])
+        loci.append((chrom, rng.randint(1, span), ref, alt))
+    loci.sort(key=lambda v: (names.index(v[0]), v[1]))
+    return loci
+
+
+"""Writes loci as a VCF. With sortedness < 1, that fraction of the lines
+stays in coordinate order and the others are moved to random places.
+A fraction chr_prefix of the lines name their chromosome chrN.
+"""
+def writeVcf(filename, loci, rng, sortedness=1.0, chr_prefix=0.5):
+    lines = list(loci)
+    moved = rng.sample(range(len(lines)),
+        int(round(len(lines) * (1.0 - sortedness))))
+    for i in moved:
+        j = rng.randrange(len(lines))
+        lines[i], lines[j] = lines[j], lines[i]
+
+    with open(filename, 'w') as fh:
+        fh.write('##fileformat=VCFv4.0\n##source=benchmark.py\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' +
+            'SAMPLE\n')
+        for (chrom, pos, ref, alt) in lines:
+            name = ('chr' + chrom) if (rng.random() < chr_prefix) else chrom
+            info = rng.choice(['.', 'DP=' + str(rng.randint(5, 100))])
+            fh.write(f"{name}\t{pos}\t.\t{ref}\t{alt}\t50\tPASS\t{info}\t" +
+                "GT\t0/1\n")
+
+
+"""Random intervals (start, end) on [0, span], at most width bases long
+"""
+def intervals(count, span, width, rng):
+    result = []
+    for i in range(count):
+        start = rng.randint(0, span)
+        result.append((start, start + rng.randint(1, width)))
+    return result
+
+
+"""Builds the SQLite reference database. Point tables (dbSNP, the exact
+BigRefGene tiers, gwasCatalog) get rows at a share hit_rate of the loci;
+interval tables get intervals_per_chrom random intervals per chromosome.
+"""
+def buildReference(filename, loci, chroms, span, rng, intervals_per_chrom=1000,
+    hit_rate=0.2):
+    if os.path.exists(filename):
+        os.remove(filename)
+    conn = sqlite3.connect(filename)
+    for table in SCHEMA:
+        conn.execute('create table ' + table + ' ' + SCHEMA[table])
+
+    def insert(table, rows):
+        if (len(rows) > 0):
+            conn.executemany('insert into ' + table + ' values (' +
+                ','.join(['?'] * len(rows[0])) + ')', rows)
+
+    def sample(fraction=hit_rate):
+        return rng.sample(loci, int(len(loci) * fraction))
+
+    n = intervals_per_chrom
+    insert('dbSNP', [(c, p, r, 'rs' + str(rng.randint(1, 10 ** 8)), a, '.',
+        '.', rng.choice(['.', '0.' + str(rng.randint(1, 49))]), 'SNV')
+        for (c, p, r, a) in sample()])
+    for table in ('chrom_pos_equal_base', 'chrom_pos_equal_nobase'):
+        insert(table, [(0, c, p, p, r, a, 'NM_' + str(rng.randint(1, 99999)),
+            'GENE' + str(rng.randint(1, 5000)), rng.choice('+-'),
+            rng.choice(['CDS', 'intron', 'utr5', 'utr3']), rng.randint(0, 2))
+            for (c, p, r, a) in sample(hit_rate / 2)])
+
+    for (chrom, weight) in chroms:
+        c = 'chr' + chrom
+        insert('chrom_pos_unequal', [(0, chrom, s, e, 'A', 'C',
+            'NM_' + str(rng.randint(1, 99999)), 'GENE1', '-', 'intron', 0)
+            for (s, e) in intervals(n, span, 5000, rng)])
+
+        genes = []
+        for (s, e) in intervals(n // 2, span, 40000, rng):
+            e = max(e, s + 100)
+            cds_start = min(s + rng.randint(0, 2000), e)
+            cds_end = min(cds_start + rng.choice([0, rng.randint(100, 30000)]),
+                e)
+            count = rng.randint(1, 8)
+            bounds = sorted(rng.sample(range(s, e), 2 * count))
+            genes.append((rng.randint(0, 1000), 'NM_' +
+                str(rng.randint(1, 99999)), c, rng.choice('+-'), s, e,
+                cds_start, cds_end, count,
+                (','.join([str(x) for x in bounds[0::2]]) + ',').encode(),
+                (','.join([str(x) for x in bounds[1::2]]) + ',').encode(),
+                0, 'GENE' + str(rng.randint(1, 5000)), 'cmpl', 'cmpl', '0,'))
+        insert('refGene', genes)
+
+        insert('cpgIslandExt', [(c, s, e, 'CpG: ' + str(rng.randint(1, 200)))
+            for (s, e) in intervals(n, span, 3000, rng)])
+        insert('cytoBand', [(c, s, e, 'p' + str(rng.randint(11, 36)),
+            'gneg') for (s, e) in intervals(n // 10, span, span // 50, rng)])
+        insert('gadAll', [(chrom, s, e, 'GAD' + str(rng.randint(1, 5000)),
+            'CANCER') for (s, e) in intervals(n, span, 5000, rng)])
+        insert('targetScanS', [(0, c, s, e, 'miR-' + str(rng.randint(1, 999)),
+            50) for (s, e) in intervals(n, span, 500, rng)])
+        insert('hugo', [(c, s, e, 0, 'Approved', 'HG' +
+            str(rng.randint(1, 5000)), 'gene description')
+            for (s, e) in intervals(n, span, 5000, rng)])
+        for table in CNV_TABLES:
+            insert(table, [(c, s, e, table) for (s, e) in
+                intervals(n // 2, span, 10000, rng)])
+        insert('genomicSuperDups', [(0, c, s, e, 'dup', 0, '+', 'chr5',
+            s + 7, e + 7) for (s, e) in intervals(n, span, 5000, rng)])
+        insert('tfbsConsSites' + chrom, [(c, s, e, 'V$TF' +
+            str(rng.randint(1, 500))) for (s, e) in
+            intervals(n * 2, span, 300, rng)])
+
+    insert('gwasCatalog', [(0, 'chr' + c, p - 1, p, 'rs1',
+        str(rng.randint(1, 99999)), 'Author', '2012', 'Journal', 'Title',
+        'Trait ' + str(rng.randint(1, 500))) for (c, p, r, a) in sample()])
+
+    # The UCSC bins of the rows, as in the real tables
+    for (table, (start_col, end_col)) in BIN_TABLES.items():
+        conn.executemany('update ' + table + ' set bin = ? where rowid = ?',
+            [(bins.binFromRange(start, end), rowid) for (rowid, start, end) in
+            conn.execute('select rowid, ' + start_col + ', ' + end_col +
+                ' from ' + table).fetchall()])
+
+    for table in INDICES:
+        conn.execute('create index ' + table + '_idx on ' + table + ' (' +
+            INDICES[table] + ')')
+    conn.commit()
+    conn.close()
+
+
+"""Throughput of each stage of a job profile (see profiling.py), keyed by
+the stage's label
+"""
+def stageThroughput(profile):
+    result = {}
+    for s in profile['stages']:
+        result[s['stage']] = (s['variants'] / s['wall_time']) \
+            if (s['wall_time'] > 0) else 0.0
+    return result
+
+
+"""Mean database query latency of each stage of a job profile, in ms,
+keyed like stageThroughput(); stages that ran no queries are left out
+"""
+def stageQueryLatency(profile):
+    result = {}
+    for s in profile['stages']:
+        if (s['db_queries'] > 0):
+            result[s['stage']] = s['db_time'] / s['db_queries'] * 1000
+    return result
+
+
+"""Stages whose throughput dropped by more than tolerance (a fraction)
+below the baseline's, as (stage, baseline, current) triples
+"""
+def findRegressions(throughput, baseline, tolerance):
+    regressions = []
+    for stage in baseline:
+        if stage not in throughput:
+            continue
+        if (throughput[stage] < baseline[stage] * (1.0 - tolerance)):
+            regressions.append((stage, baseline[stage], throughput[stage]))
+    return regressions
+
+
+"""Generates the inputs in work_dir (unless already there), annotates the
+VCF with driver.run and returns the benchmark report
+"""
+def runBenchmark(work_dir, variants=20000, chroms='1,2,X', span=5000000,
+    sortedness=1.0, intervals_per_chrom=1000, seed=1, snapshot=False,
+    bin_index=False, **options):
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    rng = random.Random(seed)
+    mix = parseChroms(chroms)
+
+    loci = generateLoci(variants, mix, span, rng)
+    vcf = os.path.join(work_dir, 'benchmark.vcf')
+    writeVcf(vcf, loci, rng, sortedness=sortedness)
+
+    db = os.path.join(work_dir, f"reference-{seed}-{variants}-" +
+        f"{chroms.replace(',', '_').replace(':', '-')}-{span}-" +
+        f"{intervals_per_chrom}.db")
+    if not os.path.exists(db):
+        print(f"Building reference database {db} . . .")
+        buildReference(db, loci, mix, span, random.Random(seed + 1),
+            intervals_per_chrom=intervals_per_chrom)
+    u.SQLITE_DB = db
+
+    # Imported here so that the driver picks up the SQLite database
+    import driver
+    if bin_index:
+        import index_reference
+        if (len(index_reference.indexReference(
+            sorted(index_reference.TABLES))) > 0):
+            raise ValueError(f"{db} is not ready for bin-narrowed " +
+                "queries; delete it to have it rebuilt")
+        options['bin_index'] = True
+    if snapshot:
+        import compile_reference
+        import snapshot as snap
+        snapshot_dir = db + '.snapshot'
+        if not os.path.isdir(snapshot_dir):
+            compile_reference.compileReference(snapshot_dir,
+                sorted(snap.TABLES) + [snap.TFBS_TABLE], 'benchmark')
+        options['snapshot_dir'] = snapshot_dir
+
+    driver.run(vcf, 'vcf', **options)
+    with open(vcf + '.profile.json') as fh:
+        profile = json.load(fh)
+
+    return {
+        'variants': variants,
+        'chroms': chroms,
+        'sortedness': sortedness,
+        'seed': seed,
+        'options': dict([(k, str(v)) for (k, v) in options.items()]),
+        'wall_time': profile['wall_time'],
+        'variants_per_sec': variants / profile['wall_time'],
+        'stages': stageThroughput(profile),
+        'query_ms': stageQueryLatency(profile),
+    }
+
+
+def printReport(report):
+    print(f"{report['variants']} variants in {report['wall_time']:.2f} s " +
+        f"({report['variants_per_sec']:.0f} variants/sec)")
+    for stage in report['stages']:
+        print(f"  {stage:<62} {report['stages'][stage]:>12.0f} variants/sec")
+
+
+"""Prints the query latency of each stage in two reports side by side
+"""
+def printLatencyComparison(before, after):
+    print(f"  {'ms/query':<62} {'before':>9} {'after':>9}")
+    for stage in before['query_ms']:
+        if stage in after['query_ms']:
+            print(f"  {stage:<62} {before['query_ms'][stage]:>9.4f} " +
+                f"{after['query_ms'][stage]:>9.4f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the annotator against a SQLite reference")
+    parser.add_argument('work_dir', help="directory for generated files")
+    parser.add_argument('--variants', type=int, default=20000)
+    parser.add_argument('--chroms', default='1,2,X',
+        help="chromosome mix, e.g. 1,2,X or 1:0.6,2:0.3,X:0.1")
+    parser.add_argument('--span', type=int, default=5000000,
+        help="bases per chromosome that variants are drawn from")
+    parser.add_argument('--sorted', type=float, default=1.0,
+        help="fraction of lines left in coordinate order")
+    parser.add_argument('--intervals', type=int, default=1000,
+        help="intervals per chromosome in the interval tables")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--snapshot', action='store_true',
+        help="annotate from a compiled reference snapshot")
+    parser.add_argument('--transcript-models', action='store_true',
+        help="classify against refGene transcript models loaded once")
+    parser.add_argument('--cpg-index', action='store_true',
+        help="look CpG islands up in an in-memory index")
+    parser.add_argument('--bigrefgene-index', action='store_true',
+        help="resolve BigRefGene lookups in batches")
+    parser.add_argument('--backend',
+        help="reference backend: sqlite (default) or memory")
+    parser.add_argument('--bin-index', action='store_true',
+        help="narrow overlap queries down by UCSC bin")
+    parser.add_argument('--compare-bin-index', action='store_true',
+        help="run without and with --bin-index and compare the stages' " +
+            "query latency")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--baseline',
+        help="report of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help="allowed drop in throughput per stage, as a fraction")
+    parser.add_argument('--save', help="write the report to this file")
+    args = parser.parse_args()
+
+    def benchmark(bin_index):
+        return runBenchmark(args.work_dir, variants=args.variants,
+            chroms=args.chroms, span=args.span, sortedness=args.sorted,
+            intervals_per_chrom=args.intervals, seed=args.seed,
+            snapshot=args.snapshot, bin_index=bin_index,
+            transcript_models=args.transcript_models,
+            cpg_index=args.cpg_index, bigrefgene_index=args.bigrefgene_index,
+            backend=args.backend, workers=args.workers,
+            concurrency=args.concurrency, chunk_size=args.chunk_size)
+
+    if args.compare_bin_index:
+        before = benchmark(False)
+        report = benchmark(True)
+        printLatencyComparison(before, report)
+    else:
+        report = benchmark(args.bin_index)
+    printReport(report)
+
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = findRegressions(report['stages'], baseline['stages'],
+            args.tolerance)
+        for (stage, before, after) in regressions:
+            print(f"Regression: {stage} {before:.0f} -> {after:.0f} " +
+                "variants/sec")
+        if (len(regressions) > 0):
+            sys.exit(1)
+
+### EOF
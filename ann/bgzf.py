@@ -0,0 +1,83 @@
+# bgzf.py
+#
+# Writer for BGZF (blocked gzip) files, as produced by bgzip. A BGZF file
+# is a series of gzip members of at most 64KB each, so it can be read by
+# any gzip reader, and a block index (.gzi) allows random access into it.
+#
+##
+
+import struct
+import zlib
+
+# Largest amount of uncompressed data per block, as used by bgzip, so that
+# the compressed block always fits in 64KB
+BLOCK_SIZE = 0xff00
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+"""Compresses data into a single BGZF block
+"""
+def compressBlock(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # Header (18 bytes) + compressed data + CRC32 and ISIZE (8 bytes)
+    bsize = 18 + len(cdata) + 8
+    header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6,
+        66, 67, 2, bsize - 1)
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+        len(data) & 0xffffffff)
+    return header + cdata + trailer
+
+
+"""Writes text to a BGZF file, and optionally its .gzi block index, i.e.
+the number of blocks after the first followed by the compressed and
+uncompressed offset at which each of them starts
+"""
+class BgzfWriter(object):
+    def __init__(self, filename, index=True, level=6):
+        self.filename = filename
+        self.fh = open(filename, 'wb')
+        self.index = index
+        self.level = level
+        self.buffer = bytearray()
+        self.offsets = []
+        self.coffset = 0
+        self.uoffset = 0
+
+    def write(self, text):
+        self.buffer += text.encode('utf-8')
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.flushBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def flushBlock(self, data):
+        if (self.coffset > 0):
+            self.offsets.append((self.coffset, self.uoffset))
+        block = compressBlock(data, level=self.level)
+        self.fh.write(block)
+        self.coffset = self.coffset + len(block)
+        self.uoffset = self.uoffset + len(data)
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self.flushBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+        if self.index:
+            with open(self.filename + '.gzi', 'wb') as fh:
+                fh.write(struct.pack('<Q', len(self.offsets)))
+                for (coffset, uoffset) in self.offsets:
+                    fh.write(struct.pack('<QQ', coffset, uoffset))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+### EOF
@@ -0,0 +1,135 @@
+# bigrefgene.py
+#
+# Batched lookups of the BigRefGene tables (chrom_pos_equal_base,
+# chrom_pos_equal_nobase and chrom_pos_unequal), resolving all three tiers
+# for a chunk of variants with a few queries per chromosome
+#
+##
+
+import backends
+import intervals
+
+# Maximum number of positions per query of the two equal tiers
+BATCH_SIZE = 500
+
+# Positions of the unequal tier further apart than this are looked up with
+# separate range queries, so that a query does not read the rows of the
+# whole chromosome between them
+WINDOW_GAP = 100000
+
+
+"""Rows of table at the given positions of chr, by position, fetched for
+up to batch_size positions per query
+"""
+def rowsAt(backend, cursor, table, chr, positions, batch_size=BATCH_SIZE):
+    found = {}
+    positions = sorted(positions)
+    for i in range(0, len(positions), batch_size):
+        for row in backend.point_lookup(cursor, table,
+            {'CHR': chr, 'start': positions[i:i + batch_size]}):
+            found.setdefault(int(row[2]), []).append(row)
+    return found
+
+
+"""The given positions, sorted and split into windows where consecutive
+positions are more than gap apart
+"""
+def windows(positions, gap=WINDOW_GAP):
+    groups = []
+    for pos in sorted(positions):
+        if (len(groups) > 0) and (pos - groups[-1][-1] <= gap):
+            groups[-1].append(pos)
+        else:
+            groups.append([pos])
+    return groups
+
+
+"""Rows of chrom_pos_unequal overlapping each of the given positions of
+chr, by position, read with one range query per window of positions (see
+windows()). The window query has the predicates of the per-position
+overlap query, so the engine returns its rows in the same order, and the
+rows of each position are kept in it. Backends that answer overlaps
+locally, or through the bin column, are asked position by position.
+"""
+def unequalRowsAt(backend, cursor, chr, positions, gap=WINDOW_GAP):
+    options = dict(chrom_col='CHR', start_col='start', end_col='end')
+    if not isinstance(backend, backends.SqlBackend) or backend.bin_index:
+        return dict([(pos, backend.overlap(cursor, 'chrom_pos_unequal', chr,
+            pos, **options)) for pos in positions])
+
+    found = {}
+    for group in windows(positions, gap=gap):
+        rows = backend.window(cursor, 'chrom_pos_unequal', chr, group[0],
+            group[-1], **options)
+        index = None
+        if (len(rows) > 0):
+            start_ind = backends.fieldIndex(rows[0], 'start')
+            end_ind = backends.fieldIndex(rows[0], 'end')
+            index = intervals.ChromIndex([(int(row[start_ind]),
+                int(row[end_ind]), row) for row in rows])
+        for pos in group:
+            found[pos] = [] if (index is None) else index.overlap(pos)
+    return found
+
+
+"""Rows of the first BigRefGene tier matching each of keys ((chr, pos,
+ref, alt), as BigRefGeneStage.key() makes them) with any of the (ref,
+alt) pairs alleles(key) returns, or an empty list. The equal tiers are
+fetched for all of the keys' positions on a chromosome at once, the
+nobase tier only for positions without a match in the base tier, and the
+unequal tier for the positions left, a window of them at a time (see
+unequalRowsAt()), so that memory is bounded by the rows around the
+chunk's positions. Alleles are compared in upper
+case, as MySQL compares them; rows come back in the order the
+per-variant queries return them.
+"""
+def lookupBatch(backend, cursor, keys, alleles, batch_size=BATCH_SIZE):
+    positions = {}
+    for (chr, pos, ref, alt) in keys:
+        positions.setdefault(chr, set()).add(int(pos))
+
+    base = {}
+    for chr in positions:
+        for (pos, rows) in rowsAt(backend, cursor, 'chrom_pos_equal_base',
+            chr, positions[chr], batch_size=batch_size).items():
+            base[(chr, pos)] = rows
+
+    results = []
+    for key in keys:
+        chr, pos, ref, alt = key
+        matches = alleles(key)
+        results.append([row for row in base.get((chr, int(pos)), [])
+            if (str(row[4]).upper(), str(row[5]).upper()) in matches])
+
+    nobase = {}
+    missing = {}
+    for (key, rows) in zip(keys, results):
+        if (len(rows) == 0):
+            missing.setdefault(key[0], set()).add(int(key[1]))
+    for chr in missing:
+        for (pos, rows) in rowsAt(backend, cursor,
+            'chrom_pos_equal_nobase', chr, missing[chr],
+            batch_size=batch_size).items():
+            nobase[(chr, pos)] = rows
+
+    unequal = {}
+    for i in range(len(keys)):
+        if (len(results[i]) > 0):
+            continue
+        chr, pos, ref, alt = keys[i]
+        results[i] = nobase.get((chr, int(pos)), [])
+        if (len(results[i]) == 0):
+            unequal.setdefault(chr, set()).add(int(pos))
+
+    found = {}
+    for chr in unequal:
+        for (pos, rows) in unequalRowsAt(backend, cursor, chr,
+            unequal[chr]).items():
+            found[(chr, pos)] = rows
+    for i in range(len(keys)):
+        if (len(results[i]) == 0):
+            results[i] = found.get((keys[i][0], int(keys[i][1])), [])
+
+    return results
+
+### EOF
@@ -0,0 +1,55 @@
+# bins.py
+#
+# The UCSC genome browser binning scheme: the bin column of UCSC tables
+# (refGene, gwasCatalog, genomicSuperDups, ...) files each row under the
+# smallest of a hierarchy of fixed genomic windows that contains it, so
+# that overlap queries can be answered by equality lookups on the bins
+# that may hold overlapping rows instead of two-sided range predicates
+#
+##
+
+# Windows of 128 kb, 1 Mb, 8 Mb, 64 Mb and 512 Mb, smallest first: bin
+# numbers of each level start at its offset
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+# Positions at or beyond this are outside the standard scheme (UCSC's
+# extended bins for them are not used by the annotator's tables)
+BIN_MAX_END = 1 << 29
+
+
+"""Bin of a row spanning [start, end) (0-based, half-open), as stored in
+the bin column; None if the row is outside the standard scheme
+"""
+def binFromRange(start, end):
+    if (start < 0) or (end > BIN_MAX_END):
+        return None
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (start_bin == end_bin):
+            return offset + start_bin
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return None
+
+
+"""Bins that can hold rows overlapping [start, end): at each level, those
+of the windows the range touches. None if the range is outside the
+standard scheme.
+"""
+def overlappingBins(start, end):
+    start = max(start, 0)
+    if (end > BIN_MAX_END) or (end <= start):
+        return None
+    bins = []
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return bins
+
+### EOF
@@ -0,0 +1,137 @@
+# cache.py
+#
+# Persistent cache of annotation stage lookups, shared by all jobs run on
+# an annotator instance
+#
+##
+
+import json
+import time
+import sqlite3
+import threading
+
+
+"""Version under which lookups of a table are cached; ValueError if it
+is not known
+"""
+def requireVersion(version):
+    if version is None:
+        raise ValueError("Cached lookups need the version of their table")
+    return str(version)
+
+
+"""On-disk (SQLite) cache of stage lookup results, keyed by stage,
+reference version and the stage's lookup key (locus, and alleles where
+the stage looks at them). The number of entries is bounded, and the
+least recently used ones are evicted first.
+
+Results are only valid for the release of the stage's table they were
+looked up in, so they are stored and found under that version: lookups
+of a stage whose version is not known cannot be cached, as results of
+different releases could not be told apart.
+
+Several jobs (processes) and stage threads may use the same cache file;
+SQLite serializes writers and a lock serializes the threads of one
+process. The database is only opened on first use, so that a cache can be
+handed to forked worker processes before it is used.
+"""
+class AnnotationCache(object):
+    # Check the number of entries after this many inserts, counted in the
+    # cache file across all the jobs using it, as a job may insert fewer
+    check_every = 10000
+
+    def __init__(self, path, max_entries=5000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=60,
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=WAL')
+            self.conn.execute('create table if not exists results ('
+                'stage text, version text, key text, result text, '
+                'used real, primary key (stage, version, key))')
+            self.conn.execute('create index if not exists results_used '
+                'on results (used)')
+            self.conn.execute('create table if not exists counters ('
+                'name text primary key, value integer)')
+            self.conn.execute('insert or ignore into counters (name, value) '
+                'values (?, 0)', ('inserts',))
+            self.conn.commit()
+        return self.conn
+
+    """Returns a dict of the cached results of stage for the given keys,
+    in version of its table
+    """
+    def get(self, stage, version, keys):
+        version = requireVersion(version)
+        found = {}
+        with self.lock:
+            conn = self.connect()
+            encoded = dict([(json.dumps(key), key) for key in keys])
+            names = list(encoded)
+            for i in range(0, len(names), 500):
+                batch = names[i:i + 500]
+                rows = conn.execute('select key, result from results '
+                    'where stage = ? and version = ? and key in (' +
+                    ','.join(['?'] * len(batch)) + ')',
+                    [stage, version] + batch).fetchall()
+                for (key, result) in rows:
+                    found[encoded[key]] = json.loads(result)
+
+            if (len(found) > 0):
+                now = time.time()
+                conn.executemany('update results set used = ? where '
+                    'stage = ? and version = ? and key = ?',
+                    [(now, stage, version, json.dumps(key))
+                    for key in found])
+                conn.commit()
+        return found
+
+    """Stores (key, result) pairs of stage, in version of its table
+    """
+    def put(self, stage, version, items):
+        version = requireVersion(version)
+        with self.lock:
+            conn = self.connect()
+            now = time.time()
+            rows = [(stage, version, json.dumps(key), json.dumps(result),
+                now) for (key, result) in items]
+            conn.executemany('insert or replace into results '
+                '(stage, version, key, result, used) values (?, ?, ?, ?, ?)',
+                rows)
+            # In the same transaction, so that concurrent jobs do not lose
+            # each other's inserts
+            conn.execute('update counters set value = value + ? where '
+                'name = ?', (len(rows), 'inserts'))
+            inserts = conn.execute('select value from counters where '
+                'name = ?', ('inserts',)).fetchone()[0]
+            if (inserts >= self.check_every):
+                conn.execute('update counters set value = 0 where name = ?',
+                    ('inserts',))
+            conn.commit()
+
+            if (inserts >= self.check_every):
+                self.evict()
+
+    """Drops the least recently used entries once the cache is full, down
+    to 90% of its size
+    """
+    def evict(self):
+        count = self.conn.execute('select count(*) from results').fetchone()[0]
+        if (count > self.max_entries):
+            self.conn.execute('delete from results where rowid in (select '
+                'rowid from results order by used limit ?)',
+                (count - int(self.max_entries * 0.9),))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+### EOF
@@ -0,0 +1,105 @@
+# checkpoint.py
+#
+# Stage-level checkpoints of annotation jobs run stage by stage, so that a
+# job interrupted part way can resume after its last completed stage
+#
+##
+
+import os
+import sys
+import json
+import marshal
+
+import profiling
+
+
+"""Manifest of the completed stages of a chained run over infile, kept in
+infile.checkpoint.json next to the stages' temporary files.
+
+For each completed stage the manifest records its output file, counts
+and profile, and the size of the job's count log once the stage had
+written to it. Stage outputs are record spills (see records.py), which
+are only readable by the Python version that wrote them, so a checkpoint
+written by another version (or for another pipeline) is ignored and the
+job starts over.
+
+If persist is given, it is called with the files of each checkpoint
+(the stage's output, the count log and the manifest, in that order)
+once the checkpoint has been written, e.g. to copy them to S3.
+"""
+class Checkpoint(object):
+    def __init__(self, infile, labels, persist=None):
+        self.infile = infile
+        self.filename = infile + '.checkpoint.json'
+        self.labels = list(labels)
+        self.persist = persist
+        self.stages = []
+
+    def version(self):
+        return [marshal.version] + list(sys.version_info[:2])
+
+    """Loads the completed stages from the manifest, if it is one of this
+    pipeline and the output of its last stage is still there. Returns the
+    number of completed stages.
+    """
+    def load(self):
+        self.stages = []
+        if not os.path.exists(self.filename):
+            return 0
+        with open(self.filename) as fh:
+            manifest = json.load(fh)
+        if ((manifest['labels'] != self.labels) or
+            (manifest['version'] != self.version())):
+            return 0
+        stages = manifest['stages']
+        if ((len(stages) > 0) and
+            not os.path.exists(self.infile + stages[-1]['output'])):
+            return 0
+        self.stages = stages
+        return len(stages)
+
+    """Sets a completed stage's counts and profile from the manifest
+    """
+    def restore(self, k, stage):
+        entry = self.stages[k]
+        stage.addCounts(entry['counts'])
+        for f in profiling.StageProfile.fields:
+            setattr(stage.profile, f, entry['profile'].get(f, 0))
+
+    """Truncates the count log to its size after the last completed
+    stage, dropping anything an interrupted stage wrote to it
+    """
+    def restoreLog(self, log_file):
+        if (len(self.stages) > 0) and os.path.exists(log_file):
+            with open(log_file, 'r+') as fh:
+                fh.truncate(self.stages[-1]['log_size'])
+
+    """Records that stage k wrote its output to infile + output
+    """
+    def complete(self, k, stage, output, log_file):
+        self.stages = self.stages[:k] + [{
+            'stage': self.labels[k],
+            'output': output,
+            'counts': stage.getCounts(),
+            'profile': stage.profile.asDict(),
+            'log_size': os.path.getsize(log_file),
+        }]
+        manifest = {
+            'input': os.path.basename(self.infile),
+            'labels': self.labels,
+            'version': self.version(),
+            'stages': self.stages,
+        }
+        # Replaced atomically, so that a crash leaves the previous manifest
+        with open(self.filename + '.tmp', 'w') as fh:
+            json.dump(manifest, fh, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+        if self.persist is not None:
+            self.persist([self.infile + output, log_file, self.filename])
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+### EOF
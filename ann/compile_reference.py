@@ -0,0 +1,83 @@
+# compile_reference.py
+#
+# Exports the annotator's interval tables from the reference database into
+# a local snapshot directory (see snapshot.py)
+#
+# Usage: python compile_reference.py <snapshot_dir> [--version VERSION]
+#            [table ...]
+#
+##
+
+import sys
+import argparse
+from datetime import datetime
+
+import backends
+import utils as u
+import snapshot as snap
+
+
+"""Streams the rows of table on chrom (all of them if chrom_col is None)
+as (start, end, row), in the order the overlap query returns them (see
+backends.SqlBackend.chromRows())
+"""
+def exportRows(backend, cursor, table, chrom, chrom_col, start_col, end_col,
+    columns=None):
+    rows = backend.chromRows(cursor, table, chrom, chrom_col=chrom_col,
+        start_col=start_col, end_col=end_col, columns=columns)
+    if (len(rows) == 0):
+        return []
+    start_ind = backends.fieldIndex(rows[0], start_col)
+    end_ind = backends.fieldIndex(rows[0], end_col)
+    return [(int(row[start_ind]), int(row[end_ind]), tuple(row))
+        for row in rows]
+
+
+def compileReference(root, tables, version):
+    writer = snap.SnapshotWriter(root, version)
+    backend = backends.getBackend()
+    conn = u.db_connect()
+    cursor = conn.cursor()
+
+    for table in tables:
+        print(f"Compiling {table} . . .")
+        if (table == snap.TFBS_TABLE):
+            columns = [c.strip() for c in snap.TFBS_COLUMNS.split(',')]
+            for chrom in snap.TFBS_CHROMS:
+                rows = exportRows(backend, cursor, table + chrom, None, None,
+                    'chromStart', 'chromEnd', columns=columns)
+                writer.addTable(table, {chrom: rows} if (len(rows) > 0)
+                    else {})
+        else:
+            chrom_col, start_col, end_col = snap.TABLES[table]
+            rows_by_chrom = {}
+            for chrom in backend.chroms(cursor, table, chrom_col=chrom_col):
+                rows_by_chrom[str(chrom)] = exportRows(backend, cursor,
+                    table, chrom, chrom_col, start_col, end_col)
+            writer.addTable(table, rows_by_chrom)
+
+    cursor.close()
+    conn.close()
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compile reference tables into a local snapshot")
+    parser.add_argument('root', help="snapshot directory")
+    parser.add_argument('tables', nargs='*',
+        default=sorted(snap.TABLES) + [snap.TFBS_TABLE],
+        help="tables to compile (default: all)")
+    parser.add_argument('--version',
+        default=datetime.now().strftime('%Y%m%d'),
+        help="reference release recorded in the snapshot")
+    args = parser.parse_args()
+
+    for table in args.tables:
+        if (table not in snap.TABLES) and (table != snap.TFBS_TABLE):
+            print(f"Unknown table: {table}")
+            sys.exit(1)
+
+    compileReference(args.root, args.tables, args.version)
+
+### EOF
@@ -0,0 +1,198 @@
+# dbsnp_filter.py
+#
+# Bloom filter over the (chromosome, position, REF) of the dbSNP table,
+# built offline and memory-mapped by the annotator, so that the dbSNP
+# stage only queries the database for variants that may be in it (see
+# annotate.DbSnpStage). The filter records the table and the reference
+# release it was built from, and is only used for that release.
+#
+# Usage: python dbsnp_filter.py <filter_file> [--version VERSION]
+#            [--fpr RATE] [--max-mb MB] [--table TABLE] [--sqlite FILE]
+#
+##
+
+import os
+import sys
+import json
+import math
+import mmap
+import struct
+import hashlib
+import argparse
+import configparser
+
+import backends
+import utils as u
+
+MAGIC = b'ANNBLOOM'
+FORMAT = 1
+
+# Load configuration from ann_config.ini
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    'ann_config.ini'))
+
+
+"""Key of a dbSNP row or variant in the filter. Chromosomes are compared
+without any chr prefix and bases regardless of case, so that whatever
+the query would match is in the filter.
+"""
+def filterKey(chrom, pos, ref):
+    return (backends.chromKey(chrom) + ':' + str(int(pos)) + ':' +
+        str(ref).strip().upper()).encode('utf-8')
+
+
+"""Number of bits and of hash functions of a filter of keys keys with a
+false positive rate of fpr, in at most max_bytes bytes if given (at the
+cost of a higher rate). Returns them with the rate they achieve.
+"""
+def filterSize(keys, fpr, max_bytes=None):
+    keys = max(keys, 1)
+    bits = int(math.ceil(-keys * math.log(fpr) / (math.log(2) ** 2)))
+    if max_bytes is not None:
+        bits = min(bits, int(max_bytes) * 8)
+    bits = max(bits, 64)
+    hashes = max(1, int(round(bits / keys * math.log(2))))
+    rate = (1 - math.exp(-hashes * keys / bits)) ** hashes
+    return (bits, hashes, rate)
+
+
+"""Bits of a key in a filter of bits bits, by double hashing
+"""
+def bitIndices(key, bits, hashes):
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+"""A filter file: MAGIC, the length of its JSON header, the header (the
+filter's parameters, table and version) padded to 8 bytes, and the bits
+"""
+def writeFilter(filename, bitmap, header):
+    text = json.dumps(header, sort_keys=True).encode('utf-8')
+    text = text + b' ' * (-(len(MAGIC) + 4 + len(text)) % 8)
+    # Written next to the filter and moved over it, so that annotators
+    # never map a partial file
+    tmpfile = filename + '.tmp'
+    with open(tmpfile, 'wb') as fh:
+        fh.write(MAGIC + struct.pack('<I', len(text)) + text)
+        fh.write(bitmap)
+    os.replace(tmpfile, filename)
+
+
+"""Read-only view of a filter file, memory-mapped so that the annotator's
+worker processes share its pages
+"""
+class DbSnpFilter(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if (self.map[:len(MAGIC)] != MAGIC):
+            raise ValueError(f"{filename} is not a dbSNP filter")
+        length = struct.unpack('<I', self.map[len(MAGIC):len(MAGIC) + 4])[0]
+        self.offset = len(MAGIC) + 4 + length
+        header = json.loads(self.map[len(MAGIC) + 4:self.offset].decode(
+            'utf-8'))
+        if (header['format'] != FORMAT):
+            raise ValueError(f"{filename}: unsupported format " +
+                str(header['format']))
+        self.table = header['table']
+        self.version = header['version']
+        self.bits = header['bits']
+        self.hashes = header['hashes']
+        self.keys = header['keys']
+        self.fpr = header['fpr']
+
+    """Whether the filter was built from table as of reference version
+    (None if unknown, which no filter is valid for)
+    """
+    def covers(self, table, version):
+        return ((version is not None) and (self.table == table) and
+            (str(self.version) == str(version)))
+
+    """False if no row of the table has this chromosome, position and REF;
+    True if one may have
+    """
+    def mayContain(self, chrom, pos, ref):
+        for i in bitIndices(filterKey(chrom, pos, ref), self.bits,
+            self.hashes):
+            if not (self.map[self.offset + (i >> 3)] & (1 << (i & 7))):
+                return False
+        return True
+
+    def close(self):
+        self.map.close()
+
+
+"""Builds the filter of table in the reference database as of version,
+at a false positive rate of fpr in at most max_mb MB, streaming its rows
+once to count them and once to add them. Returns the filter's header.
+"""
+def buildFilter(filename, version, table='dbSNP', fpr=0.01, max_mb=None):
+    backend = backends.getBackend()
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from ' + backend.column(table))
+    keys = int(cursor.fetchone()[0])
+    bits, hashes, rate = filterSize(keys, fpr, max_bytes=None if
+        (max_mb is None) else max_mb * 1024 * 1024)
+    print(f"{table}: {keys} rows, {bits // 8} bytes, {hashes} hashes, " +
+        f"false positive rate {rate:.4f}")
+
+    bitmap = bytearray((bits + 7) // 8)
+    stream = backend.streamingCursor(cursor)
+    stream.execute('select ' + ', '.join([backend.column(c) for c in
+        ('CHR', 'POS', 'REF')]) + ' from ' + backend.column(table))
+    for (chrom, pos, ref) in stream:
+        for i in bitIndices(filterKey(chrom, pos, ref), bits, hashes):
+            bitmap[i >> 3] |= 1 << (i & 7)
+    if stream is not cursor:
+        stream.close()
+    cursor.close()
+    conn.close()
+
+    header = {'format': FORMAT, 'table': table, 'version': str(version),
+        'keys': keys, 'bits': bits, 'hashes': hashes, 'fpr': rate}
+    writeFilter(filename, bitmap, header)
+    return header
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build the dbSNP membership filter of the annotator")
+    parser.add_argument('filename', help="filter file to write")
+    parser.add_argument('--version',
+        help="reference release of the table (default: its version in " +
+            "ann_config.ini)")
+    parser.add_argument('--fpr', type=float, default=0.01,
+        help="false positive rate (default: 0.01)")
+    parser.add_argument('--max-mb', type=float,
+        help="memory budget of the filter in MB, at the cost of a " +
+            "higher false positive rate")
+    parser.add_argument('--table', default='dbSNP',
+        help="dbSNP table (default: dbSNP)")
+    parser.add_argument('--sqlite',
+        help="SQLite copy of the reference database to read")
+    args = parser.parse_args()
+
+    # Same version as the annotator gives the dbSNP stage (see
+    # driver.getPipeline())
+    versions = dict(config.items('REFERENCE_VERSIONS')) \
+        if config.has_section('REFERENCE_VERSIONS') else {}
+    version = args.version or versions.get(args.table.lower()) or \
+        config.get('REFERENCE', 'VERSION', fallback='')
+    if not version:
+        print("Give the reference release of the table with --version")
+        sys.exit(1)
+    if not (0 < args.fpr < 1):
+        print("The false positive rate must be between 0 and 1")
+        sys.exit(1)
+    if args.sqlite:
+        u.SQLITE_DB = args.sqlite
+
+    buildFilter(args.filename, version, table=args.table, fpr=args.fpr,
+        max_mb=args.max_mb)
+
+### EOF
@@ -12,110 +12,553 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import file_utils as fu
 import annotate as ann
+import backends
+from dbsnp_filter import DbSnpFilter
+import pileup2vcf
+import profiling
+import snapshot
+from cache import AnnotationCache
+from checkpoint import Checkpoint
+import utils as u
 
-def run(infile, format):
+"""The annotation pipeline, in order, as (progress message, stage) pairs
+"""
+def getStages(format='vcf'):
+    return [
+        ("dbSNP", ann.DbSnpStage(format=format)),
+        ("BigRefGene", ann.BigRefGeneStage(format=format)),
+        ("refGene", ann.GenesStage(format=format, table='refGene',
+            promoter_offset=500)),
+        ("Cytoband", ann.CytobandStage(format=format, table='cytoBand')),
+        ("gadAll", ann.GadAllStage(format=format, table='gadAll')),
+        ("GwasCatalog", ann.GwasCatalogStage(format=format,
+            table='gwasCatalog')),
+        ("miRNA", ann.MiRNAStage(format=format, table='targetScanS')),
+        ("HUGO Gene Nomenclature Committee",
+            ann.HugoGeneNomenclatureStage(format=format, table='hugo')),
+        ("dgv_Cnv", ann.CnvDatabaseStage(format=format, table='dgv_Cnv')),
+        ("abParts_IG_T_CelReceptors", ann.CnvDatabaseStage(format=format,
+            table='abParts_IG_T_CelReceptors')),
+        ("mcCarroll_Cnv", ann.CnvDatabaseStage(format=format,
+            table='mcCarroll_Cnv')),
+        ("conrad_Cnv", ann.CnvDatabaseStage(format=format,
+            table='conrad_Cnv')),
+        ("genomicSuperDups", ann.GenomicSuperDupsStage(format=format,
+            table='genomicSuperDups')),
+        ("addOverlapWithTfbsConsSites", ann.TfbsConsSitesStage(
+            format=format, table='tfbsConsSites')),
+    ]
+
+
+"""Name of the annotated file for an input file, e.g. x.annot.vcf for
+x.vcf or x.vcf.gz, or x.annot.vcf.gz if compressed
+"""
+def getOutputFile(infile, compress=False):
+    if infile.endswith('.gz'):
+        infile = infile[:-len('.gz')]
+    outfile = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    return (outfile + '.gz') if compress else outfile
+
+
+"""Stages of the pipeline, reading from the compiled reference snapshot
+in snapshot_dir if given, and sharing the lookup cache at cache_path if
+given. Cached results are only reused for the same version of the
+stage's table (see below), and the lookups of stages whose version is
+not known are not cached; if no stage's is, getPipeline() raises
+ValueError. With transcript_models=True,
+gene stages classify variants against refGene transcript models loaded
+once per process (see transcripts.py), and with cpg_index=True they
+look CpG islands up in an in-memory index (see intervals.py). With
+bigrefgene_index=True, BigRefGene lookups are resolved a chunk at a
+time with batched queries of its tiers (see bigrefgene.py). The stages query the reference
+backend named by backend (mysql, sqlite or memory, see backends.py), by
+default that of the database in use; with bin_index=True, its overlap
+queries go through the UCSC bin column of the tables that have one (see
+backends.SqlBackend). With prefetch_rows > 0, the stages' overlaps are
+answered from windows of the tables prefetched once per chromosome of
+the job, holding up to prefetch_rows rows (see backends.PrefetchBackend
+and setPrefetchRanges()). With dbsnp_filter, the dbSNP stage only looks
+up the variants that the membership filter in that file does not rule
+out, provided it was built from the stage's table and version (see
+dbsnp_filter.py). The version of a stage whose table the snapshot holds
+is the snapshot's; that of the others, which the database serves, is
+looked up by name (case-insensitively) in table_versions, for tables
+updated on their own, and is reference_version otherwise (None if not
+given).
+Each stage keeps up to memo_size lookup results of the job, so that
+repeated loci are looked up once (see annotate.Stage.memo_size), and
+keeps up to inflight of its database lookups in flight at once (see
+annotate.Stage.inflight).
+"""
+def getPipeline(format='vcf', snapshot_dir=None, sweep=True, cache_path=None,
+    cache_size=5000000, reference_version=None, transcript_models=False,
+    cpg_index=False, bigrefgene_index=False, backend=None,
+    table_versions=None, memo_size=100000, inflight=1, bin_index=False,
+    prefetch_rows=0, dbsnp_filter=None):
+    stages = getStages(format=format)
+
+    prefetch = {}
+    for (label, stage) in stages:
+        stage.memo_size = memo_size
+        stage.inflight = inflight
+        if backend or bin_index:
+            stage.backend = backends.getBackend(backend, bin_index=bin_index)
+        if (prefetch_rows > 0) and \
+            isinstance(stage.backend, backends.SqlBackend):
+            # One per job, so that the stages share the row budget
+            if stage.backend not in prefetch:
+                prefetch[stage.backend] = backends.PrefetchBackend(
+                    stage.backend, prefetch_rows)
+            stage.backend = prefetch[stage.backend]
+        if isinstance(stage, ann.GenesStage):
+            stage.transcript_models = transcript_models
+            stage.cpg_index = cpg_index
+        if isinstance(stage, ann.BigRefGeneStage):
+            stage.local_index = bigrefgene_index
+
+    if snapshot_dir:
+        reference = snapshot.Snapshot(snapshot_dir)
+        for (label, stage) in stages:
+            stage.snapshot = reference
+            if sweep:
+                stage.sweeps = {}
+
+    versions = dict([(name.lower(), version) for (name, version) in
+        (table_versions or {}).items()])
+    for (label, stage) in stages:
+        if stage.servedBySnapshot():
+            stage.version = stage.snapshot.version
+        else:
+            stage.version = versions.get(stage.referenceName().lower(),
+                reference_version)
+
+    if dbsnp_filter:
+        membership = getDbSnpFilter(dbsnp_filter)
+        for (label, stage) in stages:
+            if not isinstance(stage, ann.DbSnpStage):
+                continue
+            if membership.covers(stage.table, stage.version):
+                stage.membership = membership
+            else:
+                # A filter of another release could rule out variants
+                # that are in the table
+                print(f"Not using {dbsnp_filter}: built from " +
+                    f"{membership.table} {membership.version}, not " +
+                    f"{stage.table} {stage.version}")
+
+    if cache_path:
+        cached = [stage for (label, stage) in stages
+            if stage.version is not None]
+        if (len(cached) == 0):
+            # Cached results of different releases could not be told apart
+            raise ValueError("The lookup cache needs the version of the " +
+                "stages' tables")
+        cache = AnnotationCache(cache_path, max_entries=cache_size)
+        for stage in cached:
+            stage.cache = cache
+
+    return stages
+
+
+"""Closes the lookup cache of a pipeline's stages, if any
+"""
+def closeCache(pipeline):
+    for stage in pipeline:
+        if stage.cache is not None:
+            stage.cache.close()
+            return
+
+
+_dbsnp_filters = {}
+
+"""The dbSNP membership filter in filename, mapped once per process
+"""
+def getDbSnpFilter(filename):
+    if filename not in _dbsnp_filters:
+        _dbsnp_filters[filename] = DbSnpFilter(filename)
+    return _dbsnp_filters[filename]
+
+
+"""Converts an uploaded variant pileup to the VCF file next to it that
+the pipeline annotates (see pileup2vcf.py); returns the VCF file and the
+number of variants written to it
+"""
+def convertPileup(infile, chunk_size=pileup2vcf.CHUNK_SIZE):
+    # Uncompressed, as the job only reads it back once
+    outfile = pileup2vcf.vcf_filename(infile)
+    if outfile.endswith('.gz'):
+        outfile = outfile[:-len('.gz')]
+    count = pileup2vcf.filter_pileup(infile, outfile, chunk_size=chunk_size)
+    return (outfile, count)
+
+
+"""Range of the positions (min, max) of infile's variants on each
+chromosome, by backends.chromKey()
+"""
+def scanRanges(infile, format='vcf'):
+    chr_ind, pos_ind = ann.getFormatSpecificIndices(format=format)[:2]
+    ranges = {}
+    fh = fu.openFile(infile)
+    for line in fh:
+        if line.startswith('#') or line.startswith('CHROM'):
+            continue
+        fields = line.split('\t', max(chr_ind, pos_ind) + 1)
+        try:
+            chrom = backends.chromKey(fields[chr_ind])
+            pos = int(fields[pos_ind])
+        except (IndexError, ValueError):
+            continue
+        lo, hi = ranges.get(chrom, (pos, pos))
+        ranges[chrom] = (min(lo, pos), max(hi, pos))
+    fh.close()
+    return ranges
+
+
+"""Points the prefetch backends of the stages, if any, at the ranges of
+infile's positions, so that they fetch the windows infile needs
+"""
+def setPrefetchRanges(pipeline, infile, format='vcf'):
+    prefetch = set([stage.backend for stage in pipeline
+        if isinstance(stage.backend, backends.PrefetchBackend)])
+    if (len(prefetch) > 0):
+        ranges = scanRanges(infile, format=format)
+        for backend in prefetch:
+            backend.ranges = ranges
+
+
+"""Runs the stages over infile in a single pass, writing outfile. With
+concurrency > 1 the stages' lookups run in that many threads, each on its
+own pooled connection. With versions=True, the header records the
+stages' reference versions.
+"""
+def annotateFile(infile, outfile, pipeline, chunk_size=10000, concurrency=1,
+    versions=True):
+    fh = fu.openFile(infile)
+    fh_out = fu.openFile(outfile, "w")
+    if (concurrency > 1):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for chunk in ann.readChunks(fh, chunk_size=chunk_size):
+                lines = ann.annotateLines(chunk, pipeline, None,
+                    executor=executor)
+                if versions:
+                    lines = ann.addReferenceVersions(lines, pipeline)
+                for line in lines:
+                    fh_out.write(line + '\n')
+    else:
+        with u.db_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in ann.readChunks(fh, chunk_size=chunk_size):
+                lines = ann.annotateLines(chunk, pipeline, cursor)
+                if versions:
+                    lines = ann.addReferenceVersions(lines, pipeline)
+                for line in lines:
+                    fh_out.write(line + '\n')
+            cursor.close()
+    fh.close()
+    fh_out.close()
+
+
+"""Annotates one shard in a worker process and returns the counts and
+profile of each stage
+"""
+def annotateShard(shard, format, chunk_size, snapshot_dir, sweep,
+    concurrency, cache_path, cache_size, reference_version,
+    transcript_models, cpg_index, bigrefgene_index, backend, table_versions,
+    memo_size, inflight, bin_index, prefetch_rows, dbsnp_filter):
+    pipeline = [stage for (label, stage) in
+        getPipeline(format=format, snapshot_dir=snapshot_dir, sweep=sweep,
+            cache_path=cache_path, cache_size=cache_size,
+            reference_version=reference_version,
+            transcript_models=transcript_models, cpg_index=cpg_index,
+            bigrefgene_index=bigrefgene_index, backend=backend,
+            table_versions=table_versions, memo_size=memo_size,
+            inflight=inflight, bin_index=bin_index,
+            prefetch_rows=prefetch_rows, dbsnp_filter=dbsnp_filter)]
+    setPrefetchRanges(pipeline, shard, format=format)
+    # The versions go into the merged header (see mergeShards)
+    annotateFile(shard, shard + '.annot', pipeline, chunk_size=chunk_size,
+        concurrency=concurrency, versions=False)
+    closeCache(pipeline)
+    return [(stage.getCounts(), stage.profile) for stage in pipeline]
+
+
+"""Shard of a line: its chromosome, or its chromosome and window of
+window bases if given. Header lines go into a shard of their own.
+"""
+def getShardKey(line, window=None):
+    if line.startswith('#'):
+        return '#'
+    fields = line.split('\t', 2)
+    if (window is None) or (len(fields) < 2):
+        return fields[0]
+    try:
+        return (fields[0], int(fields[1]) // window)
+    except ValueError:
+        return fields[0]
+
+
+"""Splits infile into shard files. Returns the shard files, their line
+counts and the shard of every input line, in input order.
+"""
+def splitShards(infile, window=None):
+    shards = []
+    sizes = []
+    order = array('I')
+    keys = {}
+    fhs = []
+
+    fh = fu.openFile(infile)
+    for line in fh:
+        key = getShardKey(line.strip(), window=window)
+        if key not in keys:
+            keys[key] = len(shards)
+            shards.append(infile + '.shard' + str(len(shards)))
+            sizes.append(0)
+            fhs.append(open(shards[-1], 'w'))
+        k = keys[key]
+        fhs[k].write(line.rstrip('\n') + '\n')
+        sizes[k] = sizes[k] + 1
+        order.append(k)
+    fh.close()
+
+    for fh_shard in fhs:
+        fh_shard.close()
+
+    return (shards, sizes, order)
+
+
+"""Writes the annotated shards back out in the original line order, with
+the reference versions of stages in the header
+"""
+def mergeShards(shards, order, outfile, stages=()):
+    fhs = [open(shard + '.annot') for shard in shards]
+    fh_out = fu.openFile(outfile, "w")
+    header = []
+    for k in order:
+        line = fhs[k].readline()
+        if line.startswith('##'):
+            header.append(line.rstrip('\n'))
+            continue
+        if line.startswith('#CHROM'):
+            header = ann.addReferenceVersions(header + [line.rstrip('\n')],
+                stages)
+            line = ''
+        for h in header:
+            fh_out.write(h + '\n')
+        header = []
+        fh_out.write(line)
+    for h in header:
+        fh_out.write(h + '\n')
+    fh_out.close()
+
+    for fh in fhs:
+        fh.close()
+
+
+"""Parallel pipeline: the input is split by chromosome (and by window for
+large chromosomes), the shards are annotated by a pool of worker
+processes and merged back in input order. Counts and profiles are summed
+into stages.
+"""
+def runParallel(infile, outfile, format, stages, chunk_size=10000,
+    snapshot_dir=None, sweep=True, workers=2, window=None, concurrency=1,
+    cache_path=None, cache_size=5000000, reference_version=None,
+    transcript_models=False, cpg_index=False, bigrefgene_index=False,
+    backend=None, table_versions=None, memo_size=100000, inflight=1,
+    bin_index=False, prefetch_rows=0, dbsnp_filter=None):
+    shards, sizes, order = splitShards(infile, window=window)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Start with the largest shards
+        futures = {}
+        for k in sorted(range(len(shards)), key=lambda k: -sizes[k]):
+            futures[k] = executor.submit(annotateShard, shards[k], format,
+                chunk_size, snapshot_dir, sweep, concurrency, cache_path,
+                cache_size, reference_version, transcript_models, cpg_index,
+                bigrefgene_index, backend, table_versions, memo_size,
+                inflight, bin_index, prefetch_rows, dbsnp_filter)
+        for k in range(len(shards)):
+            for ((label, stage), (counts, profile)) in \
+                zip(stages, futures[k].result()):
+                stage.addCounts(counts)
+                stage.profile.add(profile)
+
+    mergeShards(shards, order, outfile,
+        [stage for (label, stage) in stages])
+
+    ## Cleanup
+    for shard in shards:
+        fu.delete(shard)
+        fu.delete(shard + '.annot')
+
+
+"""CPU time of this process and of its finished worker processes
+"""
+def cpuTime():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+"""Reports once per job the stages whose sweep joins over the snapshot
+fell back to point lookups because the input is not coordinate-sorted
+"""
+def reportSweepFallbacks(stages):
+    labels = [label for (label, stage) in stages
+        if (stage.profile.sweep_fallbacks > 0)]
+    if (len(labels) > 0):
+        print("Input is not sorted by coordinate, point lookups used " +
+            "instead of sweep joins by: " + ', '.join(labels))
+
+
+"""Writes the job's profile (see profiling.py) to infile.profile.json
+"""
+def writeProfile(infile, stages, start, start_cpu, mode):
+    return profiling.writeProfile(infile + '.profile.json', infile, stages,
+        time.perf_counter() - start, cpuTime() - start_cpu, mode)
+
+
+"""Fused pipeline: every line is read and split once, passed through all
+stages in memory and written once to the annotated file. Lines are
+processed chunk_size at a time so that stages can batch their lookups.
+Tables held by the compiled reference snapshot in snapshot_dir, if given,
+are answered locally instead of by the database; with sweep=True they are
+joined in a single sorted pass while the input is coordinate-sorted.
+With workers > 1 the input is sharded by chromosome (see runParallel),
+and with concurrency > 1 independent stages are looked up concurrently
+(see annotate.annotateLines). Gzip/BGZF input is read as a stream, and
+with compress=True the result is written BGZF-compressed. With a
+cache_path, lookup results are cached across jobs (see cache.py) and the
+cache hits and misses of each stage (or that it was not cached) are added
+to the count log. A per-stage profile of the run is written to
+infile.profile.json, and the reference version of each stage whose
+version is known is recorded in the result's header.
+"""
+def run(infile, format, chunk_size=10000, snapshot_dir=None, sweep=True,
+    workers=1, window=None, concurrency=1, compress=False, cache_path=None,
+    cache_size=5000000, reference_version=None, transcript_models=False,
+    cpg_index=False, bigrefgene_index=False, backend=None,
+    table_versions=None, memo_size=100000, inflight=1, bin_index=False,
+    prefetch_rows=0, dbsnp_filter=None):
 
     print("Running . . .")
+    start = time.perf_counter()
+    start_cpu = cpuTime()
+
+    stages = getPipeline(format=format, snapshot_dir=snapshot_dir,
+        sweep=sweep, cache_path=cache_path, cache_size=cache_size,
+        reference_version=reference_version,
+        transcript_models=transcript_models, cpg_index=cpg_index,
+        bigrefgene_index=bigrefgene_index, backend=backend,
+        table_versions=table_versions, memo_size=memo_size,
+        inflight=inflight, bin_index=bin_index, prefetch_rows=prefetch_rows,
+        dbsnp_filter=dbsnp_filter)
+
+    outfile = getOutputFile(infile, compress=compress)
+    if (workers > 1):
+        runParallel(infile, outfile, format, stages, chunk_size=chunk_size,
+            snapshot_dir=snapshot_dir, sweep=sweep, workers=workers,
+            window=window, concurrency=concurrency, cache_path=cache_path,
+            cache_size=cache_size, reference_version=reference_version,
+            transcript_models=transcript_models, cpg_index=cpg_index,
+            bigrefgene_index=bigrefgene_index, backend=backend,
+            table_versions=table_versions, memo_size=memo_size,
+            inflight=inflight, bin_index=bin_index,
+            prefetch_rows=prefetch_rows, dbsnp_filter=dbsnp_filter)
+    else:
+        pipeline = [stage for (label, stage) in stages]
+        setPrefetchRanges(pipeline, infile, format=format)
+        annotateFile(infile, outfile, pipeline, chunk_size=chunk_size,
+            concurrency=concurrency)
+
+    fh_log = open(infile + '.count.log', 'w')
+    for (label, stage) in stages:
+        stage.writeLog(fh_log)
+        print(f"{label} - done.")
+    if cache_path:
+        for (label, stage) in stages:
+            if stage.cache is None:
+                fh_log.write(f"Cache {label}: not cached, version " +
+                    "unknown\n")
+                continue
+            fh_log.write(f"Cache {label}: {stage.cache_hits} hits, "
+                f"{stage.cache_misses} misses\n")
+        closeCache([stage for (label, stage) in stages])
+    fh_log.close()
+
+    reportSweepFallbacks(stages)
+    writeProfile(infile, stages, start, start_cpu,
+        'parallel' if (workers > 1) else 'fused')
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+
+"""Original pipeline: each stage reads the previous stage's temporary
+file and writes the next one. The temporary files are spills of parsed
+records (see records.py), so only the last stage renders text. Produces
+the same output as run(); options are those of getPipeline().
+
+With checkpoint=True, every completed stage is recorded in a manifest
+(see checkpoint.py), and a job restarted over the same input resumes
+after its last completed stage instead of starting over from dbSNP.
+persist is passed on to the checkpoints, e.g. to keep them in S3.
+"""
+def runChained(infile, format, compress=False, checkpoint=False,
+    persist=None, **options):
+
+    print("Running . . .")
+    start = time.perf_counter()
+    start_cpu = cpuTime()
+
+    stages = getPipeline(format=format, **options)
+    setPrefetchRanges([stage for (label, stage) in stages], infile,
+        format=format)
+    log_file = infile + '.count.log'
+    done = 0
+    if checkpoint:
+        checkpoints = Checkpoint(infile, [label for (label, stage) in stages],
+            persist=persist)
+        done = checkpoints.load()
+        if (done > 0):
+            print(f"Resuming after {done} completed stages . . .")
+            checkpoints.restoreLog(log_file)
+
+    tmpextin = ''
+    for k in range(len(stages)):
+        label, stage = stages[k]
+        tmpextout = '.' + str(k + 1)
+        if (k < done):
+            checkpoints.restore(k, stage)
+        else:
+            ann.runStage(stage, infile, tmpextin=tmpextin,
+                tmpextout=tmpextout, spill_in=(k > 0),
+                spill_out=(k < len(stages) - 1))
+            if checkpoint:
+                checkpoints.complete(k, stage, tmpextout, log_file)
+        print(f"{label} - done.")
+        tmpextin = tmpextout
 
     ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
+    for k in range(1, len(stages)):
+        fu.delete(infile + '.' + str(k))
+
+    outfile = getOutputFile(infile, compress=compress)
+    if compress:
+        with open(infile + tmpextin) as fh:
+            fh_out = fu.openFile(outfile, 'w')
+            for line in fh:
+                fh_out.write(line)
+            fh_out.close()
+        fu.delete(infile + tmpextin)
+    else:
+        os.rename(infile + tmpextin, outfile)
+    if checkpoint:
+        checkpoints.remove()
+    closeCache([stage for (label, stage) in stages])
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    reportSweepFallbacks(stages)
+    writeProfile(infile, stages, start, start_cpu, 'chained')
 
-### EOF
\ No newline at end of file
+### EOF
@@ -18,6 +18,9 @@ import shutil
 import sys
 
 import itertools, operator
+import gzip
+
+import bgzf
 
 """Execute command
 """
@@ -86,6 +89,23 @@ def fileSize(filename):
     return int(os.path.getsize(filename))
 
 
+"""Opens a text file. Gzip (and BGZF) files are detected by their magic
+number and decompressed as they are read; files written under a .gz
+name are BGZF-compressed, with a .gzi block index alongside.
+"""
+def openFile(filename, mode='r'):
+    if mode.startswith('r'):
+        with open(filename, 'rb') as fh:
+            magic = fh.read(2)
+        if (magic == b'\x1f\x8b'):
+            return gzip.open(filename, 'rt')
+        return open(filename, mode)
+
+    if filename.endswith('.gz'):
+        return bgzf.BgzfWriter(filename, index=True)
+    return open(filename, mode)
+
+
 def delete(filename):
     if (os.path.exists(filename) and os.path.isfile(filename)):
         os.unlink(filename)
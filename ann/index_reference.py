@@ -0,0 +1,160 @@
+# index_reference.py
+#
+# Adds (or checks) the (chrom, bin) indices that bin-narrowed overlap
+# queries use (see backends.SqlBackend and bins.py), and verifies that the
+# bin column of each table holds the UCSC bins of its rows
+#
+# Usage: python index_reference.py [--check] [--verify-bins N]
+#            [--sqlite FILE] [table ...]
+#
+##
+
+import sys
+import argparse
+
+import backends
+import bins
+import snapshot as snap
+import utils as u
+
+# Tables the stages look overlaps up in, with the columns of their rows'
+# chromosome and span. tfbsConsSites<N> and the cytoBand-like tables
+# without a bin column are reported and skipped.
+TABLES = dict([(table, (chrom_col, 'chromStart', 'chromEnd'))
+    for (table, (chrom_col, start_col, end_col)) in snap.TABLES.items()])
+TABLES.update({
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+})
+TABLES.update(dict([(snap.TFBS_TABLE + chrom, (None, 'chromStart',
+    'chromEnd')) for chrom in snap.TFBS_CHROMS]))
+
+
+"""Column lists of the indices of table, each in index order
+"""
+def tableIndices(cursor, backend, table):
+    indices = {}
+    if isinstance(backend, backends.SQLiteBackend):
+        cursor.execute('pragma index_list(' + backend.column(table) + ')')
+        for row in cursor.fetchall():
+            cursor.execute('pragma index_info(' + backend.column(row[1]) +
+                ')')
+            indices[row[1]] = [r[2] for r in
+                sorted(cursor.fetchall(), key=lambda r: r[0])]
+    else:
+        # Table, Non_unique, Key_name, Seq_in_index, Column_name, ...
+        cursor.execute('show index from ' + backend.column(table))
+        for row in sorted(cursor.fetchall(), key=lambda r: (r[2], r[3])):
+            indices.setdefault(row[2], []).append(row[4])
+    return list(indices.values())
+
+
+"""Index columns that bin-narrowed overlap queries on table need
+"""
+def binIndexColumns(chrom_col, bin_col):
+    return [bin_col] if (chrom_col is None) else [chrom_col, bin_col]
+
+
+"""Creates the index, and updates the table's statistics so that the
+query planner knows how selective it is
+"""
+def createIndex(cursor, backend, table, columns):
+    name = table + '_' + '_'.join([c.lower() for c in columns])
+    cursor.execute('create index ' + backend.column(name) + ' on ' +
+        backend.column(table) + ' (' +
+        ', '.join([backend.column(c) for c in columns]) + ')')
+    if isinstance(backend, backends.SQLiteBackend):
+        cursor.execute('analyze ' + backend.column(table))
+    else:
+        cursor.execute('analyze table ' + backend.column(table))
+        cursor.fetchall()
+
+
+"""Rows among the first limit of table whose stored bin is not that of
+their span, as (stored, expected) pairs
+"""
+def verifyBins(cursor, backend, table, bin_col, start_col, end_col, limit):
+    cursor.execute('select ' + ', '.join([backend.column(c) for c in
+        (bin_col, start_col, end_col)]) + ' from ' + backend.column(table) +
+        ' limit ' + str(int(limit)))
+    wrong = []
+    for (stored, start, end) in cursor.fetchall():
+        expected = bins.binFromRange(int(start), int(end))
+        if (expected is not None) and (int(stored) != expected):
+            wrong.append((stored, expected))
+    return wrong
+
+
+"""Indexes (chrom, bin) on each of tables with a bin column, or with
+check=True only reports the missing indices, and verifies the bins of
+the first verify_bins rows of each. Returns the tables that are not
+ready for bin-narrowed queries.
+"""
+def indexReference(tables, check=False, verify_bins=1000):
+    backend = backends.getBackend()
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    not_ready = []
+
+    for table in tables:
+        chrom_col, start_col, end_col = TABLES[table]
+        bin_col = backend.binColumn(cursor, table)
+        if bin_col is None:
+            print(f"{table}: no bin column, queried by range")
+            continue
+
+        columns = binIndexColumns(chrom_col, bin_col)
+        indexed = [index for index in tableIndices(cursor, backend, table)
+            if ([c.lower() for c in index[:len(columns)]] ==
+                [c.lower() for c in columns])]
+        if (len(indexed) > 0):
+            print(f"{table}: ({', '.join(columns)}) indexed")
+        elif check:
+            print(f"{table}: ({', '.join(columns)}) not indexed")
+            not_ready.append(table)
+        else:
+            print(f"{table}: indexing ({', '.join(columns)}) . . .")
+            createIndex(cursor, backend, table, columns)
+            conn.commit()
+
+        if (verify_bins > 0):
+            wrong = verifyBins(cursor, backend, table, bin_col, start_col,
+                end_col, verify_bins)
+            if (len(wrong) > 0):
+                stored, expected = wrong[0]
+                print(f"{table}: {len(wrong)} rows with wrong bins " +
+                    f"(e.g. {stored} instead of {expected})")
+                not_ready.append(table)
+
+    cursor.close()
+    conn.close()
+    return not_ready
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Index the bin columns of the reference tables")
+    parser.add_argument('tables', nargs='*', default=sorted(TABLES),
+        help="tables to index (default: all overlap tables)")
+    parser.add_argument('--check', action='store_true',
+        help="only report missing indices")
+    parser.add_argument('--verify-bins', type=int, default=1000,
+        help="rows per table whose bins are verified (0: none)")
+    parser.add_argument('--sqlite',
+        help="SQLite copy of the reference database to index")
+    args = parser.parse_args()
+
+    for table in args.tables:
+        if table not in TABLES:
+            print(f"Unknown table: {table}")
+            sys.exit(1)
+    if args.sqlite:
+        u.SQLITE_DB = args.sqlite
+
+    not_ready = indexReference(args.tables, check=args.check,
+        verify_bins=args.verify_bins)
+    if (len(not_ready) > 0):
+        sys.exit(1)
+
+### EOF
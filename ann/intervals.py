@@ -0,0 +1,88 @@
+# intervals.py
+#
+# In-memory per-chromosome interval indices of small reference tables,
+# loaded once and shared by the stages of a process
+#
+##
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+"""Intervals of one chromosome, sorted by start, with their rows and
+their position in the order given (that of the overlap query, see
+backends.SqlBackend.chromRows())
+"""
+class ChromIndex(object):
+    def __init__(self, intervals):
+        order = sorted(range(len(intervals)),
+            key=lambda i: (intervals[i][0], i))
+        self.order = array('l', order)
+        self.starts = array('l', [intervals[i][0] for i in order])
+        self.ends = array('l', [intervals[i][1] for i in order])
+        self.rows = [intervals[i][2] for i in order]
+
+        # Running maximum of the ends, to find the first interval that can
+        # still reach a position
+        self.maxEnds = array('l')
+        for end in self.ends:
+            self.maxEnds.append(max(end, self.maxEnds[-1])
+                if (len(self.maxEnds) > 0) else end)
+
+    """Rows with start - margin <= pos <= end + margin, in the order given
+    """
+    def overlap(self, pos, margin=0):
+        hi = bisect_right(self.starts, pos + margin)
+        lo = bisect_left(self.maxEnds, pos - margin)
+        hits = [i for i in range(lo, hi) if (self.ends[i] >= pos - margin)]
+        hits.sort(key=lambda i: self.order[i])
+        return [self.rows[i] for i in hits]
+
+
+"""Interval index of a whole table, per chromosome, read a chromosome at
+a time from the SQL backend (see backends.SqlBackend.chromRows())
+"""
+class IntervalIndex(object):
+    def __init__(self, cursor, backend, table, columns, chrom_col='chrom',
+        start_col='chromStart', end_col='chromEnd'):
+        start_ind = columns.index(start_col)
+        end_ind = columns.index(end_col)
+
+        self.chroms = {}
+        for chrom in backend.chroms(cursor, table, chrom_col=chrom_col):
+            rows = backend.chromRows(cursor, table, chrom,
+                chrom_col=chrom_col, start_col=start_col, end_col=end_col,
+                columns=columns)
+            self.chroms[str(chrom)] = ChromIndex([(int(row[start_ind]),
+                int(row[end_ind]), tuple(row)) for row in rows])
+
+    def overlap(self, chrom, pos):
+        if chrom not in self.chroms:
+            return []
+        return self.chroms[chrom].overlap(int(pos))
+
+    """First row overlapping pos in the order of the overlap query, as its
+    fetchone() would return it, or None
+    """
+    def first(self, chrom, pos):
+        rows = self.overlap(chrom, pos)
+        return rows[0] if (len(rows) > 0) else None
+
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+"""Get the interval index of table (with the given columns), loading it
+from backend on first use in this process
+"""
+def getIndex(cursor, backend, table, columns, chrom_col='chrom',
+    start_col='chromStart', end_col='chromEnd'):
+    key = (table, tuple(columns))
+    with _indices_lock:
+        if key not in _indices:
+            _indices[key] = IntervalIndex(cursor, backend, table, columns,
+                chrom_col=chrom_col, start_col=start_col, end_col=end_col)
+        return _indices[key]
+
+### EOF
@@ -11,34 +11,33 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
+import sys
+import argparse
 import datetime
+import itertools
 import file_utils as fu
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED_CHR_SET = frozenset(ACCEPTED_CHR)
+
+# Lines read, converted and written at a time
+CHUNK_SIZE = 100000
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
 def count_alt(depth, bases):
-    bases = bases.upper()
-    lst = list(bases)
-    ast = 0
-    match_sum = 0
-
-    for l in lst:
-        l = str(l)
-
-        if ((str(l) == '.') or (str(l) == ',')):
-            match_sum = match_sum + 1
-        elif (l == '*'):
-            ast = ast + 1
-
-    return (int(depth) - (match_sum + ast))
+    """ Read depth minus the reads matching the reference (. and ,) and
+    the deletions (*) """
+    return (int(depth) -
+        (bases.count('.') + bases.count(',') + bases.count('*')))
 
 
 def vcfheader(pileup):
     """ Generates VCF header """
     pileup = os.path.basename(pileup)
+    if pileup.endswith('.gz'):
+        pileup = pileup[:-len('.gz')]
     pileup = os.path.splitext(pileup)[0]
     now = datetime.datetime.now()
     curdate = str(now.year) + '-' + str(now.month) + '-' + str(now.day)
@@ -58,91 +57,137 @@ def vcfheader(pileup):
 
 def hetero2homo(ref, alt):
     """ Converts heterozygous symbols from Samtools pileup to A, G, T, C """
-    if not fu.isOnTheList(HETERO.keys(), alt):
+    alt_x = HETERO.get(alt)
+    if alt_x is None:
         return alt
+    elif (ref == alt_x[0]):
+        return alt_x[1]
     else:
-        alt_x = HETERO[alt]
-        if (str(ref) == str(alt_x)[0]):
-            return str(alt_x)[1]
-        else:
-            return str(alt_x)[0]
+        return alt_x[0]
 
 
 def varpileup_line2vcf_line(pileupfields):
     """ Converts Variant Pileup format to VCF format """
-
-    t = '\t'
-    chr = str(pileupfields[0])
-    pos = str(pileupfields[1])
-    ref = str(pileupfields[2])
-    alt = str(pileupfields[3])
-    consqual = str(pileupfields[4])
-    snpqual = str(pileupfields[5])
-    mapqual = str(pileupfields[6])
-    depth = str(pileupfields[7])
-    alt_count = str(count_alt(depth, pileupfields[8]))
+    chr, pos, ref, alt, consqual, snpqual, mapqual, depth, bases = \
+        pileupfields[0:9]
 
     GT = '1/1'
-    if fu.isOnTheList(HETERO.keys(), alt):
+    if alt in HETERO:
         GT = '0/1'
-        alt = hetero2homo(ref,alt)
+        alt = hetero2homo(ref, alt)
+
+    return '\t'.join((chr, pos, '.', ref, alt, mapqual, 'PASS', '.',
+        'GT:GQ:DP:AD', GT + ':' + consqual + ':' + depth + ':' +
+        str(count_alt(depth, bases))))
+
 
-    return chr + t + pos + t + '.' + t + ref + t + alt + t + mapqual + \
-        t + 'PASS' + t + '.' + t + 'GT:GQ:DP:AD' + t + GT + ':' + \
-        consqual + ':' + depth + ':' + alt_count
+def read_chunks(fh, chunk_size=CHUNK_SIZE):
+    """ Lists of up to chunk_size lines of fh """
+    while True:
+        chunk = list(itertools.islice(fh, chunk_size))
+        if (len(chunk) == 0):
+            return
+        yield chunk
 
 
 def filter_pileup(pileup, outfile=None, chr_col=0, 
-    ref_col=2, alt_col=3, sep='\t'):
-    
-    fh = open(pileup, "r")
+    ref_col=2, alt_col=3, sep='\t', chunk_size=CHUNK_SIZE):
+    """ Converts the variants of a pileup file on chromosomes 1 - 22, X, Y
+    and MT where ALT != REF to VCF, chunk_size lines at a time. Either
+    file may be gzipped (see file_utils.openFile()); lines with fewer
+    than the nine columns of a variant pileup are skipped. Returns the
+    number of variants written. """
     if (outfile is None):
         outfile = pileup + '.vcf'
 
     fu.delete(outfile)
-    fh_out = open(outfile, "w")
+    fh = fu.openFile(pileup)
+    fh_out = fu.openFile(outfile, "w")
     fh_out.write(vcfheader(pileup) + '\n')
 
-
-    for line in fh:
-        line = line.strip()
-        fields = line.split(sep)
-
-        chr = str(fields[chr_col])
-        ref = str(fields[ref_col])
-        alt = str(fields[alt_col])
-
-        if ((alt != ref) and \
-            (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-            fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
+    # The columns after the read bases (base qualities, ...) are not split
+    maxsplit = max(9, chr_col + 1, ref_col + 1, alt_col + 1)
+    count = 0
+    for chunk in read_chunks(fh, chunk_size=chunk_size):
+        lines = []
+        for line in chunk:
+            fields = line.strip().split(sep, maxsplit)
+            if ((len(fields) >= 9) and (fields[alt_col] != fields[ref_col])
+                and (fields[chr_col].strip() in ACCEPTED_CHR_SET)):
+                lines.append(varpileup_line2vcf_line(fields))
+        if (len(lines) > 0):
+            fh_out.write('\n'.join(lines) + '\n')
+            count = count + len(lines)
+
+    fh.close()
+    fh_out.close()
+    return count
 
 
 """Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
 """
 def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3, 
-    alt_col=4, sep='\t'):
+    alt_col=4, sep='\t', chunk_size=CHUNK_SIZE):
 
-    fh = open(pileup, "r")
     if (outfile is None):
         outfile = pileup + '.filt'
 
     fu.delete(outfile)
-    fh_out = open(outfile, "w")
-
-
-    for line in fh:
-        line = line.strip()
-        if line.startswith('#'):
-            fh_out.write(str(line)+'\n')
-        else:
-            fields = line.split(sep)
-            if (len(fields) >= 8):
-                chr = str(fields[chr_col])
-                ref = str(fields[ref_col])
-                alt = str(fields[alt_col])
-
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-                    fh_out.write(str(line) + '\n')
-
-### EOF
\ No newline at end of file
+    fh = fu.openFile(pileup)
+    fh_out = fu.openFile(outfile, "w")
+
+    for chunk in read_chunks(fh, chunk_size=chunk_size):
+        lines = []
+        for line in chunk:
+            line = line.strip()
+            if line.startswith('#'):
+                lines.append(line)
+            else:
+                fields = line.split(sep)
+                if ((len(fields) >= 8) and
+                    (fields[alt_col] != fields[ref_col]) and
+                    (fields[chr_col].strip() in ACCEPTED_CHR_SET)):
+                    lines.append(line)
+        if (len(lines) > 0):
+            fh_out.write('\n'.join(lines) + '\n')
+
+    fh.close()
+    fh_out.close()
+
+
+def is_pileup(filename):
+    """ Whether filename is a (gzipped) variant pileup, by its extension """
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    return filename.endswith('.pileup')
+
+
+def vcf_filename(pileup):
+    """ VCF file a pileup file converts to, gzipped if the pileup is """
+    if not is_pileup(pileup):
+        return pileup + '.vcf'
+    gz = pileup.endswith('.gz')
+    if gz:
+        pileup = pileup[:-len('.gz')]
+    return pileup[:-len('.pileup')] + '.vcf' + ('.gz' if gz else '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Convert a variant pileup to VCF")
+    parser.add_argument('pileup', help="pileup file, optionally gzipped")
+    parser.add_argument('-o', '--output',
+        help="VCF file to write, BGZF-compressed if it ends in .gz " +
+            "(default: the pileup's name with .vcf)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+        help=f"lines converted at a time (default: {CHUNK_SIZE})")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.pileup):
+        print(f"No such file: {args.pileup}")
+        sys.exit(1)
+    outfile = args.output or vcf_filename(args.pileup)
+    count = filter_pileup(args.pileup, outfile, chunk_size=args.chunk_size)
+    print(f"{count} variants written to {outfile}")
+
+### EOF
@@ -0,0 +1,162 @@
+# profiling.py
+#
+# Per-stage instrumentation of annotation jobs, written out as a JSON
+# profile next to the job's count log
+#
+##
+
+import os
+import json
+import time
+import resource
+
+
+"""Peak resident set size of this process so far, in KB, or of the
+largest of its finished child processes if that is larger
+"""
+def peakRss(children=False):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        rss = max(rss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss
+
+
+"""Measurements of one annotation stage. Times are in seconds; wall and
+CPU time cover the stage's lookups and the folding of their results into
+the records (CPU time of the thread that did the work). lines_read and
+lines_written count the lines that went through the stage, variants the
+data lines it looked up, and ref_rows the reference rows it read from
+the database or the snapshot. memo_hits counts the variants whose
+lookup was answered by the job's memo of repeated loci (see
+annotate.Stage.memo_size), and filter_skips those the dbSNP stage did
+not look up because its membership filter ruled them out (see
+dbsnp_filter.py). sweep_fallbacks counts the snapshot tables whose sweep
+join fell back to point lookups because the input was not sorted by
+coordinate (see sweep.py). peak_rss_kb is the process's peak RSS
+when the stage last finished a chunk. Jobs sharded over worker
+processes sum the shards' profiles (taking the largest peak RSS), so
+stage times may add up to more than the job's wall time; likewise
+db_time sums the queries a stage had in flight at once.
+"""
+class StageProfile(object):
+    fields = ('wall_time', 'cpu_time', 'lines_read', 'lines_written',
+        'variants', 'ref_rows', 'db_queries', 'db_time', 'memo_hits',
+        'filter_skips', 'sweep_fallbacks', 'peak_rss_kb')
+
+    def __init__(self):
+        for f in self.fields:
+            setattr(self, f, 0)
+
+    """Adds another profile of the same stage, e.g. from another shard
+    """
+    def add(self, other):
+        for f in self.fields:
+            if (f == 'peak_rss_kb'):
+                self.peak_rss_kb = max(self.peak_rss_kb, other.peak_rss_kb)
+            else:
+                setattr(self, f, getattr(self, f) + getattr(other, f))
+
+    def asDict(self):
+        d = dict([(f, getattr(self, f)) for f in self.fields])
+        for f in ('wall_time', 'cpu_time', 'db_time'):
+            d[f] = round(d[f], 6)
+        return d
+
+
+"""Times a block of work into a profile's wall and CPU time
+"""
+class Timed(object):
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        self.profile.wall_time += time.perf_counter() - self.wall
+        self.profile.cpu_time += time.thread_time() - self.cpu
+
+
+"""Database cursor that counts the queries run through it, the time spent
+in them and the rows they return into a StageProfile
+"""
+class ProfiledCursor(object):
+    def __init__(self, cursor, profile):
+        self.cursor = cursor
+        self.profile = profile
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.cursor.execute(*args, **kwargs)
+        finally:
+            self.profile.db_queries += 1
+            self.profile.db_time += time.perf_counter() - start
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.profile.db_time += time.perf_counter() - start
+        if row is not None:
+            self.profile.ref_rows += 1
+        return row
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.profile.db_time += time.perf_counter() - start
+        self.profile.ref_rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.profile.ref_rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Writes the profile of a job: its totals, and the profile of each of its
+(label, stage) pairs in pipeline order
+"""
+def writeProfile(filename, infile, stages, wall_time, cpu_time, mode):
+    profile = {
+        'input': os.path.basename(infile),
+        'mode': mode,
+        'wall_time': round(wall_time, 6),
+        'cpu_time': round(cpu_time, 6),
+        'peak_rss_kb': peakRss(children=True),
+        'stages': [],
+    }
+    for (label, stage) in stages:
+        entry = {'stage': label, 'class': stage.__class__.__name__,
+            'table': stage.table}
+        entry.update(stage.profile.asDict())
+        profile['stages'].append(entry)
+
+    with open(filename, 'w') as fh:
+        json.dump(profile, fh, indent=2)
+    return profile
+
+
+"""Short summary of a job profile, as stored on the job's DynamoDB item
+(integers only: milliseconds and KB)
+"""
+def summarize(profile):
+    slowest = max(profile['stages'], key=lambda s: s['wall_time'])
+    return {
+        'wall_ms': int(profile['wall_time'] * 1000),
+        'cpu_ms': int(profile['cpu_time'] * 1000),
+        'peak_rss_kb': int(profile['peak_rss_kb']),
+        'db_queries': sum([s['db_queries'] for s in profile['stages']]),
+        'db_ms': int(sum([s['db_time'] for s in profile['stages']]) * 1000),
+        'memo_hits': sum([s['memo_hits'] for s in profile['stages']]),
+        'filter_skips': sum([s['filter_skips'] for s in profile['stages']]),
+        'slowest_stage': slowest['stage'],
+        'slowest_stage_ms': int(slowest['wall_time'] * 1000),
+    }
+
+### EOF
@@ -0,0 +1,241 @@
+# reannotate.py
+#
+# Incremental re-annotation: after a reference table was updated, re-runs
+# only the stage that annotates from it over existing results, either
+# local files or, as a bulk backfill, every result in the results bucket
+#
+# Usage: python reannotate.py <table> <version> <annot_vcf> [...]
+#        python reannotate.py <table> <version> --backfill [--prefix P]
+#            [--dry-run]
+#
+##
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import configparser
+
+import boto3
+
+import annotate as ann
+import driver
+import file_utils as fu
+import records
+import utils as u
+
+# Load configuration from ann_config.ini
+config = configparser.ConfigParser()
+config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    'ann_config.ini'))
+
+
+"""Splits an INFO column around the fragments of one stage, given the
+INFO keys of the stage and those of the stages after it. Fragments
+without a key belong to the keyed fragment before them (e.g. p14 in
+cytoBand=p24;p14). Returns the INFO the stage appended to, i.e. without
+its fragments and those of later stages, what the later stages appended
+(without its leading separator), and the key of the first fragment of a
+later stage (None if there is none). A stage without fragments of its
+own would have appended them before the first fragment of a later stage.
+"""
+def splitInfo(info, keys, later_keys):
+    tokens = info.split(';')
+    owners = []
+    owner = None
+    for token in tokens:
+        if ('=' in token):
+            key = token.split('=', 1)[0].strip()
+            owner = 'own' if (key in keys) else \
+                (key if (key in later_keys) else None)
+        owners.append(owner)
+
+    own = [i for i in range(len(tokens)) if (owners[i] == 'own')]
+    later = [i for i in range(len(tokens))
+        if (owners[i] not in (None, 'own'))]
+    if (len(own) > 0):
+        at = own[0]
+    elif (len(later) > 0):
+        at = later[0]
+    else:
+        at = len(tokens)
+
+    before = [tokens[i] for i in range(at) if (owners[i] != 'own')]
+    after = [tokens[i] for i in range(at, len(tokens)) if (owners[i] != 'own')]
+    later = [i for i in later if (i >= at)]
+    return (';'.join(before), ';'.join(after),
+        owners[later[0]] if (len(later) > 0) else None)
+
+
+"""Reference versions recorded in the header of an annotated file, by
+reference name
+"""
+def referenceVersions(filename):
+    versions = {}
+    fh = fu.openFile(filename)
+    for line in fh:
+        if line.startswith('##annotationReference=<'):
+            attrs = dict([a.split('=', 1) for a in
+                line.strip()[len('##annotationReference=<'):-1].split(',')])
+            versions[attrs['ID']] = attrs['Version']
+        elif not line.startswith('##'):
+            break
+    fh.close()
+    return versions
+
+
+"""Re-runs the stage of the pipeline annotating from reference name over
+an annotated file, writing outfile: the stage's INFO fragments are
+replaced in place by those of a fresh lookup, and its version in the
+header by version. options are those of driver.getPipeline(). Returns
+the stage, with its counts.
+
+The later stages' fragments are joined back to the stage's the way they
+were appended in a full run. Only whether INFO ended with an empty
+fragment (';') before the stage is lost where the stage's fragments
+were followed by nothing, or by those of a stage that always separates
+them: a record losing all of the stage's fragments there does not get
+the empty fragment back.
+"""
+def reannotateFile(infile, outfile, name, version, format='vcf',
+    chunk_size=10000, **options):
+    stages = [stage for (label, stage) in driver.getPipeline(format=format,
+        table_versions={name: version}, **options)]
+    names = [stage.referenceName() for stage in stages]
+    if name not in names:
+        raise ValueError(f"No stage annotates from {name}")
+    k = names.index(name)
+    stage = stages[k]
+    keys = stage.infoKeys()
+    if keys is None:
+        raise ValueError(f"The INFO keys of {name} are shared with other " +
+            "stages; re-run the whole pipeline instead")
+    later_keys = {}
+    for later in reversed(stages[k + 1:]):
+        for key in (later.infoKeys() or []):
+            later_keys[key] = later
+
+    fh = fu.openFile(infile)
+    fh_out = fu.openFile(outfile, 'w')
+    with u.db_connection() as conn:
+        cursor = conn.cursor()
+        for chunk in ann.readChunks(fh, chunk_size=chunk_size):
+            items = []
+            afters = []
+            for line in chunk:
+                if stage.isHeader(line):
+                    items.append(line)
+                    afters.append(None)
+                    continue
+                variant = stage.unapply(records.Variant(line.split(stage.sep)))
+                after = None
+                if variant.info is not None:
+                    before, text, key = splitInfo(variant.getInfo(), keys,
+                        later_keys)
+                    variant.setInfo(before)
+                    if (len(text) > 0):
+                        after = (later_keys.get(key), text)
+                items.append(variant)
+                afters.append(after)
+
+            items = ann.annotateRecords(items, [stage], cursor)
+            for (item, after) in zip(items, afters):
+                if after is None:
+                    continue
+                later, text = after
+                if (later is not None) and later.always_separates:
+                    item.appendInfo(';' + text)
+                else:
+                    ann.appendInfo(item, text)
+            for line in records.renderAll(ann.addReferenceVersions(items,
+                [stage])):
+                fh_out.write(line + '\n')
+        cursor.close()
+    fh.close()
+    fh_out.close()
+    return stage
+
+
+"""Re-annotates every result in the results bucket (under prefix, by
+default all of this annotator's) that was not annotated with version of
+reference name yet, replacing it in place. Results already at version are
+skipped, so an interrupted backfill can simply be run again. Returns the
+number of results re-annotated.
+"""
+def backfill(name, version, prefix=None, dry_run=False, **options):
+    bucket = config.get('S3', 'RESULTS_BUCKET')
+    if prefix is None:
+        prefix = config.get('IDENTIFIER', 'CNET_ID') + '/'
+    s3_client = boto3.client('s3',
+        region_name=config.get('AWS', 'REGION'))
+
+    work_dir = tempfile.mkdtemp(prefix='reannotate-')
+    count = 0
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/paginator/ListObjectsV2.html
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                if ('/checkpoints/' in key) or not (key.endswith('.annot.vcf')
+                    or key.endswith('.annot.vcf.gz')):
+                    continue
+                local = os.path.join(work_dir, os.path.basename(key))
+                s3_client.download_file(bucket, key, local)
+                if (referenceVersions(local).get(name) == version):
+                    fu.delete(local)
+                    continue
+
+                print(f"Re-annotating s3://{bucket}/{key} . . .")
+                count = count + 1
+                if not dry_run:
+                    # Same compression (and .gzi index) as the original
+                    outfile = local.replace('.annot.vcf', '.reannot.vcf')
+                    reannotateFile(local, outfile, name, version, **options)
+                    s3_client.upload_file(outfile, bucket, key)
+                    if os.path.exists(outfile + '.gzi'):
+                        s3_client.upload_file(outfile + '.gzi', bucket,
+                            key + '.gzi')
+                        fu.delete(outfile + '.gzi')
+                    fu.delete(outfile)
+                fu.delete(local)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Re-run the stage of one updated reference table " +
+            "over annotated results")
+    parser.add_argument('table', help="reference table, e.g. gwasCatalog")
+    parser.add_argument('version', help="version of the updated table")
+    parser.add_argument('files', nargs='*',
+        help="annotated files, re-annotated in place")
+    parser.add_argument('--backfill', action='store_true',
+        help="re-annotate the results in the results bucket")
+    parser.add_argument('--prefix',
+        help="key prefix of the results to backfill")
+    parser.add_argument('--dry-run', action='store_true',
+        help="only list the results that would be re-annotated")
+    parser.add_argument('--backend',
+        help="reference backend (mysql, sqlite or memory)")
+    args = parser.parse_args()
+
+    try:
+        if args.backfill:
+            count = backfill(args.table, args.version, prefix=args.prefix,
+                dry_run=args.dry_run, backend=args.backend)
+            print(f"{count} results re-annotated")
+        for filename in args.files:
+            outfile = filename + '.reannot'
+            stage = reannotateFile(filename, outfile, args.table,
+                args.version, backend=args.backend)
+            os.replace(outfile, filename)
+            stage.writeLog(sys.stdout)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+### EOF
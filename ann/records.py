@@ -0,0 +1,174 @@
+# records.py
+#
+# Variant records passed between annotation stages, and the binary spill
+# format they are written in when they have to go to disk between stages
+#
+##
+
+import marshal
+
+
+"""A variant line split into its columns. INFO (column 8) is kept as a
+list of fragments that stages append to, and only joined when the record
+is rendered back to text, so that annotating a line with every stage
+does not rebuild the ever-growing INFO string at each of them. The INFO
+entry of fields is stale while the record is in use; lines without an
+INFO column have no fragments (info is None).
+
+The locus columns are normalized once for all stages by locate(), on
+first use: chrom (without any chr prefix), chr_chrom (with it), pos (a
+number, None if the column is not one) and pos_text, and ref and alt
+without quotes (None for lines without those columns). Stages never
+rewrite them, and the spaces some stages put in front of columns are
+stripped, so the locus stays valid while the record goes through the
+pipeline.
+"""
+class Variant(object):
+    __slots__ = ('fields', 'info', 'located', 'chrom', 'chr_chrom', 'pos',
+        'pos_text', 'ref', 'alt')
+
+    def __init__(self, fields, info=None):
+        self.fields = fields
+        if (info is None) and (len(fields) > 7):
+            info = [fields[7]]
+        self.info = info
+        self.located = None
+
+    """Normalizes the locus columns at inds (chromosome, position, REF and
+    ALT, see annotate.getFormatSpecificIndices()) unless they already
+    were; returns the record
+    """
+    def locate(self, inds):
+        if (self.located == inds):
+            return self
+        fields = self.fields
+        chrom = fields[inds[0]].strip()
+        if chrom.startswith('chr'):
+            self.chr_chrom = chrom
+            self.chrom = chrom.replace('chr', '')
+        else:
+            self.chr_chrom = 'chr' + chrom
+            self.chrom = chrom
+        self.pos_text = fields[inds[1]].strip()
+        try:
+            self.pos = int(self.pos_text)
+        except ValueError:
+            self.pos = None
+        self.ref = unquote(fields[inds[2]]).strip() \
+            if (len(fields) > inds[2]) else None
+        self.alt = unquote(fields[inds[3]]).strip() \
+            if (len(fields) > inds[3]) else None
+        self.located = inds
+        return self
+
+    """The INFO column; joins its fragments into one
+    """
+    def getInfo(self):
+        if (len(self.info) != 1):
+            self.info = [''.join(self.info)]
+        return self.info[0]
+
+    def setInfo(self, text):
+        self.info = [text]
+
+    """Appends text to the INFO column as is
+    """
+    def appendInfo(self, text):
+        self.info.append(text)
+
+    """Whether the INFO column starts with prefix, without joining it
+    """
+    def infoStartsWith(self, prefix):
+        head = ''
+        for fragment in self.info:
+            head = head + fragment
+            if (len(head) >= len(prefix)):
+                break
+        return head.startswith(prefix)
+
+    """Last character of the INFO column, '' if it is empty
+    """
+    def lastInfoChar(self):
+        for fragment in reversed(self.info):
+            if (len(fragment) > 0):
+                return fragment[-1]
+        return ''
+
+    """Prefixes every column but the first with prefix
+    """
+    def indent(self, prefix):
+        self.fields = self.fields[:1] + [prefix + x for x in self.fields[1:]]
+        if self.info is not None:
+            self.info.insert(0, prefix)
+
+    """Undoes indent(prefix), if every column but the first starts with it
+    """
+    def unindent(self, prefix):
+        if self.info is not None:
+            self.fields[7] = self.getInfo()
+        if all([x.startswith(prefix) for x in self.fields[1:]]):
+            self.fields = self.fields[:1] + [x[len(prefix):] for x in
+                self.fields[1:]]
+        if self.info is not None:
+            self.setInfo(self.fields[7])
+
+    def render(self, sep='\t'):
+        if self.info is None:
+            return sep.join(self.fields)
+        return sep.join(self.fields[:7] + [self.getInfo()] + self.fields[8:])
+
+    """The record as the next stage of a chained run would read it back,
+    i.e. written out, read in and passed through strip()
+    """
+    def restrip(self):
+        first = self.fields[0]
+        if (self.info is not None) and (len(self.fields) == 8):
+            last = self.lastInfoChar()
+        else:
+            last = self.fields[-1][-1:]
+        if ((not first) or first[0].isspace() or (not last) or
+            last.isspace()):
+            # Stripping the line leaves the locus as it was
+            variant = Variant(self.render().strip().split('\t'))
+            if self.located is not None:
+                for name in ('located', 'chrom', 'chr_chrom', 'pos',
+                    'pos_text', 'ref', 'alt'):
+                    setattr(variant, name, getattr(self, name))
+            return variant
+        return self
+
+
+"""Column without the quotes that would break a query built from it
+"""
+def unquote(column):
+    return column.replace('"', '').replace("'", '')
+
+
+"""Renders a list of records (and lines that no stage parsed) to text
+"""
+def renderAll(items, sep='\t'):
+    return [item if isinstance(item, str) else item.render(sep=sep)
+        for item in items]
+
+
+"""Writes a chunk of records (and unparsed lines) to a spill file opened
+in binary mode. Spills are marshalled, so they are only meant to be read
+back by the same Python version, e.g. by the next stage of a job.
+"""
+def writeSpill(fh, items):
+    marshal.dump([item if isinstance(item, str) else
+        (item.fields, item.info) for item in items], fh)
+
+
+"""Reads the chunks written to a spill file by writeSpill()
+"""
+def readSpill(fh):
+    while True:
+        try:
+            chunk = marshal.load(fh)
+        except EOFError:
+            return
+        yield [item if isinstance(item, str) else Variant(*item)
+            for item in chunk]
+
+### EOF
@@ -1,11 +1,15 @@
 import sys
 import time
+import fcntl
 from datetime import datetime
 import driver
+import pileup2vcf
+import profiling
 import boto3
 import os
 import configparser
 import json
+from botocore.exceptions import ClientError
 
 # Load configuration from ann_config.ini
 config = configparser.ConfigParser()
@@ -16,6 +20,31 @@ RESULTS_BUCKET = config.get('S3', 'RESULTS_BUCKET')
 IDENTIFIER = config.get('IDENTIFIER', 'CNET_ID')
 DDB_TABLE_NAME = config.get('DDB', 'TABLE_NAME')
 SNS_TOPIC_ARN = config.get('SNS', 'RESULTS_TOPIC_ARN')
+SNAPSHOT_DIR = config.get('REFERENCE', 'SNAPSHOT_DIR', fallback='')
+REFERENCE_VERSION = config.get('REFERENCE', 'VERSION', fallback='') or None
+TRANSCRIPT_MODELS = config.getboolean('REFERENCE', 'TRANSCRIPT_MODELS',
+    fallback=False)
+CPG_INDEX = config.getboolean('REFERENCE', 'CPG_INDEX', fallback=False)
+BIGREFGENE_INDEX = config.getboolean('REFERENCE', 'BIGREFGENE_INDEX',
+    fallback=False)
+REFERENCE_BACKEND = config.get('REFERENCE', 'BACKEND', fallback='') or None
+BIN_INDEX = config.getboolean('REFERENCE', 'BIN_INDEX', fallback=False)
+PREFETCH_MAX_ROWS = config.getint('REFERENCE', 'PREFETCH_MAX_ROWS',
+    fallback=0)
+DBSNP_FILTER = config.get('REFERENCE', 'DBSNP_FILTER', fallback='') or None
+TABLE_VERSIONS = dict(config.items('REFERENCE_VERSIONS')) \
+    if config.has_section('REFERENCE_VERSIONS') else {}
+CACHE_PATH = config.get('CACHE', 'PATH', fallback='')
+CACHE_SIZE = config.getint('CACHE', 'MAX_ENTRIES', fallback=5000000)
+WORKERS = config.getint('PIPELINE', 'WORKERS', fallback=1)
+SHARD_WINDOW = config.getint('PIPELINE', 'SHARD_WINDOW', fallback=None)
+CONCURRENCY = config.getint('PIPELINE', 'CONCURRENCY', fallback=1)
+MEMO_SIZE = config.getint('PIPELINE', 'MEMO_SIZE', fallback=100000)
+INFLIGHT = config.getint('PIPELINE', 'INFLIGHT', fallback=1)
+COMPRESS_RESULTS = config.getboolean('PIPELINE', 'COMPRESS_RESULTS',
+    fallback=False)
+CHECKPOINT = config.getboolean('CHECKPOINT', 'ENABLED', fallback=False)
+CHECKPOINT_S3 = config.getboolean('CHECKPOINT', 'S3', fallback=False)
 
 # set up the AWS resource
 s3_client = boto3.client('s3', region_name=AWS_REGION)
@@ -54,22 +83,31 @@ def upload_to_s3(source_file, bucket, user_id):
         print(f"Failed to upload {source_file}. Error: {str(e)}")
         return None
 
-def update_dynamodb(job_id, result_key, log_key, completion_time):
+def update_dynamodb(job_id, result_key, log_key, completion_time, profile_key=None, profile_summary=None):
     """
     Update the DynamoDB table with the completion details
     """
     try:
+        update = 'SET s3_results_bucket = :bucket, s3_key_result_file = :res, s3_key_log_file = :log, complete_time = :ct, job_status = :status'
+        values = {
+            ':bucket': RESULTS_BUCKET,
+            ':res': result_key,
+            ':log': log_key,
+            ':ct': completion_time,
+            ':status': 'COMPLETED'
+        }
+        if profile_key is not None:
+            update += ', s3_key_profile_file = :prof'
+            values[':prof'] = profile_key
+        if profile_summary is not None:
+            update += ', profile_summary = :summary'
+            values[':summary'] = profile_summary
+
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/update_item.html
         response = table.update_item(
            Key={'job_id': job_id},
-           UpdateExpression='SET s3_results_bucket = :bucket, s3_key_result_file = :res, s3_key_log_file = :log, complete_time = :ct, job_status = :status',
-           ExpressionAttributeValues={
-               ':bucket': RESULTS_BUCKET,
-               ':res': result_key,
-               ':log': log_key,
-               ':ct': completion_time,
-               ':status': 'COMPLETED'
-            }
+           UpdateExpression=update,
+           ExpressionAttributeValues=values
         )
         print("DynamoDB update successful")
     except Exception as e:
@@ -95,6 +133,79 @@ def cleanup_local_directory(directory_path):
     except Exception as e:
         print(f"Failed to delete {directory_path}. Error: {str(e)}")
 
+def checkpoint_prefix(job_id, user_id):
+    """
+    S3 prefix under which a job's checkpoints are kept
+    """
+    return f"{IDENTIFIER}/{user_id}/checkpoints/{job_id}/"
+
+def persist_checkpoint(files, prefix):
+    """
+    Copy the files of a stage checkpoint to S3, the manifest last
+    """
+    for file_path in files:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_file.html
+        s3_client.upload_file(file_path, RESULTS_BUCKET,
+            prefix + os.path.basename(file_path))
+
+def restore_checkpoint(input_file, prefix):
+    """
+    Download a job's checkpoint from S3, e.g. for a job rescheduled on
+    another annotator, unless there is one locally
+    """
+    manifest_file = input_file + '.checkpoint.json'
+    if os.path.exists(manifest_file):
+        return
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
+        s3_client.download_file(RESULTS_BUCKET,
+            prefix + os.path.basename(manifest_file), manifest_file)
+    except ClientError:
+        # No checkpoint yet
+        return
+    with open(manifest_file) as fh:
+        stages = json.load(fh)['stages']
+    try:
+        if stages:
+            for file_path in [input_file + stages[-1]['output'],
+                input_file + '.count.log']:
+                s3_client.download_file(RESULTS_BUCKET,
+                    prefix + os.path.basename(file_path), file_path)
+        print(f"Restored checkpoint after {len(stages)} stages from S3")
+    except ClientError as e:
+        print(f"Failed to restore checkpoint, starting over: {str(e)}")
+        os.remove(manifest_file)
+
+def delete_checkpoint(prefix):
+    """
+    Remove a finished job's checkpoints from S3
+    """
+    try:
+        # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/list_objects_v2.html
+        response = s3_client.list_objects_v2(Bucket=RESULTS_BUCKET,
+            Prefix=prefix)
+        objects = [{'Key': o['Key']} for o in response.get('Contents', [])]
+        if objects:
+            # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/delete_objects.html
+            s3_client.delete_objects(Bucket=RESULTS_BUCKET,
+                Delete={'Objects': objects})
+    except Exception as e:
+        print(f"Failed to delete checkpoints under {prefix}: {str(e)}")
+
+def lock_job(input_file):
+    """
+    Lock a job's working directory for as long as this process runs, so
+    that a redelivered job request does not run it twice; returns None if
+    another process holds the lock
+    """
+    fh = open(os.path.join(os.path.dirname(input_file), 'job.lock'), 'w')
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    return fh
+
 def publish_notification(job_id, result_key, user_id, completion_time, user_email, user_name):
     try:
         msg = {
@@ -116,6 +227,14 @@ def publish_notification(job_id, result_key, user_id, completion_time, user_emai
         print(f"Failed to publish notification: {str(e)}")
 
 if __name__ == '__main__':
+    if CACHE_PATH and not (REFERENCE_VERSION or SNAPSHOT_DIR or
+        TABLE_VERSIONS):
+        # Cached results of different reference releases could not be
+        # told apart
+        print("The lookup cache needs [REFERENCE] VERSION, SNAPSHOT_DIR " +
+            "or [REFERENCE_VERSIONS]")
+        sys.exit(1)
+
     # Call the AnnTools pipeline
     # Expecting at least five arguments
     if len(sys.argv) > 5:
@@ -124,19 +243,59 @@ if __name__ == '__main__':
         user_id = sys.argv[3]
         user_name = sys.argv[4]
         user_email = sys.argv[5]
+        lock = lock_job(input_file)
+        if lock is None:
+            # Leave the request queued until the running job completes
+            print(f"Job {job_id} is already running")
+            sys.exit(1)
         with Timer():
-            result_file = input_file.replace('.vcf', '.annot.vcf')
+            # Pileup uploads are annotated as the VCF they convert to
+            pileup_file = None
+            if pileup2vcf.is_pileup(input_file):
+                pileup_file = input_file
+                input_file, count = driver.convertPileup(pileup_file)
+                print(f"Converted {count} pileup variants to VCF")
+            result_file = driver.getOutputFile(input_file,
+                compress=COMPRESS_RESULTS)
+            index_file = result_file + '.gzi'
             log_file = input_file + '.count.log'
+            profile_file = input_file + '.profile.json'
         
-            driver.run(input_file, 'vcf')
+            options = dict(snapshot_dir=SNAPSHOT_DIR, cache_path=CACHE_PATH,
+                cache_size=CACHE_SIZE, reference_version=REFERENCE_VERSION,
+                transcript_models=TRANSCRIPT_MODELS, cpg_index=CPG_INDEX,
+                bigrefgene_index=BIGREFGENE_INDEX, backend=REFERENCE_BACKEND,
+                table_versions=TABLE_VERSIONS, memo_size=MEMO_SIZE,
+                inflight=INFLIGHT, bin_index=BIN_INDEX,
+                prefetch_rows=PREFETCH_MAX_ROWS, dbsnp_filter=DBSNP_FILTER)
+            prefix = checkpoint_prefix(job_id, user_id)
+
+            if CHECKPOINT:
+                # Stage by stage, resuming after the last completed stage
+                if CHECKPOINT_S3:
+                    restore_checkpoint(input_file, prefix)
+                driver.runChained(input_file, 'vcf', compress=COMPRESS_RESULTS,
+                    checkpoint=True,
+                    persist=(lambda files: persist_checkpoint(files, prefix))
+                        if CHECKPOINT_S3 else None, **options)
+            else:
+                driver.run(input_file, 'vcf', workers=WORKERS,
+                    window=SHARD_WINDOW, concurrency=CONCURRENCY,
+                    compress=COMPRESS_RESULTS, **options)
         
             # Upload the results and log files to S3
             result_key = upload_to_s3(result_file, RESULTS_BUCKET, user_id)
             log_key = upload_to_s3(log_file, RESULTS_BUCKET, user_id)
+            profile_key = upload_to_s3(profile_file, RESULTS_BUCKET, user_id)
+            if os.path.exists(index_file):
+                upload_to_s3(index_file, RESULTS_BUCKET, user_id)
 
             # Update DynamoDB with the completion details
             completion_time = int(datetime.now().timestamp())
-            update_dynamodb(job_id, result_key, log_key, completion_time)
+            with open(profile_file) as fh:
+                profile_summary = profiling.summarize(json.load(fh))
+            update_dynamodb(job_id, result_key, log_key, completion_time,
+                profile_key=profile_key, profile_summary=profile_summary)
 
             # Publish a notification to SNS
             publish_notification(job_id, result_key, user_id, completion_time, user_email, user_name)
@@ -144,9 +303,19 @@ if __name__ == '__main__':
             # Clean up local files
             cleanup_local_file(result_file)
             cleanup_local_file(log_file)
+            cleanup_local_file(profile_file)
+            if os.path.exists(index_file):
+                cleanup_local_file(index_file)
             cleanup_local_file(input_file)
+            if pileup_file is not None:
+                cleanup_local_file(pileup_file)
+            if CHECKPOINT_S3:
+                delete_checkpoint(prefix)
+            lock.close()
+            cleanup_local_file(os.path.join(os.path.dirname(input_file),
+                'job.lock'))
 
             # Clean up the left empty working directory
             cleanup_local_directory(os.path.dirname(input_file))
     else:
-        print("A valid .vcf file and job_id must be provided as input to this program.")
\ No newline at end of file
+        print("A valid .vcf or .pileup file and job_id must be provided as input to this program.")
\ No newline at end of file
@@ -0,0 +1,184 @@
+# snapshot.py
+#
+# Compiled reference snapshots: local, memory-mapped copies of the
+# interval tables queried by annotate.py
+#
+##
+
+import os
+import json
+import mmap
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MANIFEST = 'snapshot.json'
+
+# Column separator within a row of the payload string table
+SEP = '\x1f'
+
+"""Tables that can be compiled, as table -> (chrom column, start column,
+end column) of the overlap query the annotation stage runs against it
+"""
+TABLES = {
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    # gwasCatalog is matched on chromEnd = pos
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+}
+
+"""tfbsConsSites is split into one table per chromosome, tfbsConsSites<N>;
+the snapshot stores it as a single table keyed by <N>
+"""
+TFBS_TABLE = 'tfbsConsSites'
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+TFBS_COLUMNS = 'chrom, chromStart, chromEnd, name'
+
+
+def requireNumpy():
+    if np is None:
+        raise ImportError("Reference snapshots require numpy")
+
+
+"""Writes a compiled snapshot directory
+
+Rows are handed over per table and chromosome as (start, end, row) in
+the order the SQL overlap query returns them (see
+backends.SqlBackend.chromRows()). That order is kept alongside the
+sorted intervals, so that overlaps come back in the same order as the
+SQL query would return them.
+"""
+class SnapshotWriter(object):
+    def __init__(self, root, version):
+        requireNumpy()
+        self.root = root
+        self.version = version
+        self.tables = {}
+
+    def addChrom(self, table, chrom, intervals):
+        table_dir = os.path.join(self.root, table)
+        if not os.path.isdir(table_dir):
+            os.makedirs(table_dir)
+
+        order = sorted(range(len(intervals)),
+            key=lambda i: (intervals[i][0], i))
+        starts = np.array([intervals[i][0] for i in order], dtype=np.int64)
+        ends = np.array([intervals[i][1] for i in order], dtype=np.int64)
+
+        offsets = [0]
+        payload = bytearray()
+        for i in order:
+            payload += SEP.join([str(x) for x in intervals[i][2]]).encode('utf-8')
+            offsets.append(len(payload))
+
+        path = os.path.join(table_dir, chrom)
+        np.save(path + '.starts.npy', starts)
+        np.save(path + '.ends.npy', ends)
+        # Running maximum of ends, used to find the first interval that
+        # can still reach a position
+        np.save(path + '.maxends.npy', np.maximum.accumulate(ends)
+            if len(ends) > 0 else ends)
+        np.save(path + '.order.npy', np.array(order, dtype=np.int64))
+        np.save(path + '.offsets.npy', np.array(offsets, dtype=np.int64))
+        with open(path + '.payload', 'wb') as fh:
+            fh.write(payload)
+
+        self.tables.setdefault(table, []).append(chrom)
+
+    def addTable(self, table, rows_by_chrom):
+        for chrom in rows_by_chrom:
+            self.addChrom(table, chrom, rows_by_chrom[chrom])
+        self.tables.setdefault(table, [])
+
+    def close(self):
+        with open(os.path.join(self.root, MANIFEST), 'w') as fh:
+            json.dump({'version': self.version, 'tables': self.tables}, fh,
+                indent=2, sort_keys=True)
+
+
+"""Intervals of one table on one chromosome, memory-mapped from disk
+"""
+class ChromIntervals(object):
+    def __init__(self, path):
+        self.starts = np.load(path + '.starts.npy', mmap_mode='r')
+        self.ends = np.load(path + '.ends.npy', mmap_mode='r')
+        self.maxends = np.load(path + '.maxends.npy', mmap_mode='r')
+        self.order = np.load(path + '.order.npy', mmap_mode='r')
+        self.offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+        with open(path + '.payload', 'rb') as fh:
+            if (int(self.offsets[-1]) > 0):
+                self.payload = mmap.mmap(fh.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+            else:
+                self.payload = b''
+
+    def __len__(self):
+        return len(self.starts)
+
+    def row(self, i):
+        return tuple(self.payload[int(self.offsets[i]):
+            int(self.offsets[i + 1])].decode('utf-8').split(SEP))
+
+    """Indices of the intervals with start <= pos <= end, in the order of
+    the SQL overlap query
+    """
+    def overlapIndices(self, pos):
+        hi = int(np.searchsorted(self.starts, pos, side='right'))
+        lo = int(np.searchsorted(self.maxends, pos, side='left'))
+        return self.inQueryOrder([i for i in range(lo, hi)
+            if self.ends[i] >= pos])
+
+    """Indices of intervals sorted into the order of the SQL overlap query
+    """
+    def inQueryOrder(self, indices):
+        return sorted(indices, key=lambda i: int(self.order[i]))
+
+    def overlap(self, pos):
+        return [self.row(i) for i in self.overlapIndices(pos)]
+
+
+"""Read-only view of a compiled snapshot directory. Tables are looked up
+by the same chromosome names the annotation stages put in their queries,
+and each chromosome's files are mapped on first use.
+"""
+class Snapshot(object):
+    def __init__(self, root):
+        requireNumpy()
+        with open(os.path.join(root, MANIFEST)) as fh:
+            manifest = json.load(fh)
+        self.root = root
+        self.version = manifest['version']
+        self.tables = dict([(t, set(c)) for (t, c) in
+            manifest['tables'].items()])
+        self.chroms = {}
+
+    def hasTable(self, table):
+        return table in self.tables
+
+    def intervals(self, table, chrom):
+        if chrom not in self.tables[table]:
+            return None
+        if (table, chrom) not in self.chroms:
+            self.chroms[(table, chrom)] = ChromIntervals(
+                os.path.join(self.root, table, chrom))
+        return self.chroms[(table, chrom)]
+
+    """Rows of table on chrom overlapping pos, as tuples of strings
+    """
+    def overlap(self, table, chrom, pos):
+        intervals = self.intervals(table, chrom)
+        if intervals is None:
+            return []
+        return intervals.overlap(pos)
+
+### EOF
@@ -0,0 +1,81 @@
+# sweep.py
+#
+# Sorted-merge (sweep line) overlap join of coordinate-sorted variants
+# against compiled reference snapshot tables
+#
+##
+
+import heapq
+
+
+"""Answers overlap queries for a stream of positions that is sorted by
+coordinate within each chromosome, with chromosomes in contiguous blocks.
+
+The table's intervals for the current chromosome are walked in start
+order alongside the positions; intervals that have started are kept in a
+heap keyed by end and dropped once the positions pass their end. Each
+interval is therefore visited once, and memory is bounded by the number
+of intervals overlapping a single position.
+
+As soon as a position arrives out of order (a chromosome seen before, or
+a smaller position on the current chromosome), sorted is cleared and
+overlap() returns None from then on, and the caller falls back to point
+queries.
+"""
+class SweepJoin(object):
+    def __init__(self, snapshot, table):
+        self.snapshot = snapshot
+        self.table = table
+        self.sorted = True
+        self.seen = set()
+        self.chrom = None
+        self.intervals = None
+        self.next = 0
+        self.active = []
+        self.last = None
+
+    def startChrom(self, chrom):
+        self.seen.add(chrom)
+        self.chrom = chrom
+        self.intervals = self.snapshot.intervals(self.table, chrom)
+        self.next = 0
+        self.active = []
+        self.last = None
+
+    def overlap(self, chrom, pos):
+        if not self.sorted:
+            return None
+
+        if (chrom != self.chrom):
+            if chrom in self.seen:
+                self.unsorted()
+                return None
+            self.startChrom(chrom)
+
+        if (self.last is not None) and (pos < self.last):
+            self.unsorted()
+            return None
+        self.last = pos
+
+        intervals = self.intervals
+        if intervals is None:
+            return []
+
+        while (self.next < len(intervals)) and \
+            (intervals.starts[self.next] <= pos):
+            heapq.heappush(self.active,
+                (int(intervals.ends[self.next]), self.next))
+            self.next = self.next + 1
+
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [intervals.row(i) for i in intervals.inQueryOrder([i for
+            (end, i) in self.active])]
+
+    def unsorted(self):
+        self.sorted = False
+        self.intervals = None
+        self.active = []
+
+### EOF
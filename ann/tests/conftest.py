@@ -0,0 +1,91 @@
+# conftest.py
+#
+# Shared fixtures of the annotator tests: a small synthetic SQLite
+# reference database (see benchmark.py) and an input VCF of its loci
+#
+##
+
+import os
+import sys
+import shutil
+import random
+import sqlite3
+from collections import namedtuple
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+import benchmark
+import bins
+import utils as u
+
+VARIANTS = 1500
+CHROMS = '1,2,X'
+SPAN = 2000000
+
+Reference = namedtuple('Reference', ['db', 'vcf'])
+
+
+"""Adds a copy of some rows of the interval tables that stages take the
+first overlaps of, with the same start and a different end, after all
+other rows: overlaps must come back by start and then in table order on
+every backend. The copies are filed under the bin of their new range.
+"""
+def addTies(db):
+    conn = sqlite3.connect(db)
+    for (table, start_col, end_col) in [
+        ('genomicSuperDups', 'chromStart', 'chromEnd'),
+        ('targetScanS', 'chromStart', 'chromEnd'),
+        ('cpgIslandExt', 'chromStart', 'chromEnd'),
+        ('dgv_Cnv', 'chromStart', 'chromEnd'),
+        ('refGene', 'txStart', 'txEnd')]:
+        columns = [r[1] for r in conn.execute(f'pragma table_info({table})')]
+        rows = conn.execute(f'select * from {table} where rowid % 4 = 0')
+        start_ind = columns.index(start_col)
+        end_ind = columns.index(end_col)
+        copies = []
+        for row in rows.fetchall():
+            row = list(row)
+            row[end_ind] = row[end_ind] + 1000
+            if 'bin' in columns:
+                row[columns.index('bin')] = bins.binFromRange(row[start_ind],
+                    row[end_ind])
+            copies.append(row)
+        conn.executemany(f'insert into {table} values (' +
+            ','.join(['?'] * len(columns)) + ')', copies)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(scope='session')
+def reference(tmp_path_factory):
+    work_dir = str(tmp_path_factory.mktemp('reference'))
+    rng = random.Random(1)
+    chroms = benchmark.parseChroms(CHROMS)
+    loci = benchmark.generateLoci(VARIANTS, chroms, SPAN, rng)
+    vcf = os.path.join(work_dir, 'input.vcf')
+    benchmark.writeVcf(vcf, loci, rng)
+    db = os.path.join(work_dir, 'reference.db')
+    benchmark.buildReference(db, loci, chroms, SPAN, random.Random(2),
+        intervals_per_chrom=500)
+    addTies(db)
+    # Read by the backends and the connection pool on first use
+    u.SQLITE_DB = db
+    return Reference(db, vcf)
+
+
+"""Annotates a copy of the reference's input in work_dir with
+driver.run() and returns the data lines (and #CHROM line) of the result
+"""
+def annotate(reference, work_dir, **options):
+    import driver
+    os.makedirs(str(work_dir), exist_ok=True)
+    infile = os.path.join(str(work_dir), 'input.vcf')
+    shutil.copy(reference.vcf, infile)
+    driver.run(infile, 'vcf', **options)
+    with open(driver.getOutputFile(infile)) as fh:
+        return [line for line in fh if not line.startswith('##')]
+
+### EOF
@@ -0,0 +1,177 @@
+# test_backends.py
+#
+# Every way of answering the stages' lookups gives the output of the SQL
+# queries: the reference backends (backends.py), the in-memory indices of
+# the gene stages and the batched BigRefGene lookups, and the parallel and
+# concurrent pipelines. Compiled snapshots are compared in test_snapshot.py.
+#
+##
+
+import sqlite3
+import threading
+
+import pytest
+
+import backends
+import bigrefgene
+
+from conftest import annotate
+
+TABLES = [
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+]
+
+
+"""Positions to look up in table: the starts and ends of some of its rows
+(and around them), on each chromosome
+"""
+def probes(reference, table, chrom_col, start_col, end_col):
+    conn = sqlite3.connect(reference.db)
+    rows = conn.execute(f'select {chrom_col}, {start_col}, {end_col} from ' +
+        f'{table} where rowid % 7 = 0').fetchall()
+    conn.close()
+    return [(chrom, pos + d) for (chrom, start, end) in rows
+        for pos in (start, end) for d in (-1, 0, 1)]
+
+
+@pytest.fixture(scope='module')
+def sql(reference):
+    return backends.SQLiteBackend()
+
+
+@pytest.mark.parametrize('name', ['bin', 'memory', 'prefetch',
+    'prefetch_small'])
+@pytest.mark.parametrize('table, chrom_col, start_col, end_col', TABLES)
+def test_overlap_matches_sql(reference, sql, name, table, chrom_col,
+    start_col, end_col):
+    loci = probes(reference, table, chrom_col, start_col, end_col)
+    if (name == 'bin'):
+        backend = backends.SQLiteBackend(bin_index=True)
+    elif (name == 'memory'):
+        backend = backends.MemoryBackend(sql)
+    else:
+        ranges = {}
+        for (chrom, pos) in loci:
+            lo, hi = ranges.get(backends.chromKey(chrom), (pos, pos))
+            ranges[backends.chromKey(chrom)] = (min(lo, pos), max(hi, pos))
+        backend = backends.PrefetchBackend(sql,
+            100 if (name == 'prefetch_small') else 10 ** 6, ranges=ranges)
+
+    conn = sqlite3.connect(reference.db)
+    cursor = conn.cursor()
+    for margin in (0, 500):
+        for (chrom, pos) in loci:
+            options = dict(chrom_col=chrom_col, start_col=start_col,
+                end_col=end_col, margin=margin)
+            expected = sql.overlap(cursor, table, chrom, pos, **options)
+            assert backend.overlap(cursor, table, chrom, pos,
+                **options) == expected
+            assert backend.overlap(cursor, table, chrom, pos, limit=1,
+                **options) == expected[:1]
+    conn.close()
+
+
+def test_prefetch_loads_windows_outside_the_lock(reference):
+    class BlockingSource(backends.SQLiteBackend):
+        def __init__(self):
+            backends.SQLiteBackend.__init__(self)
+            self.started = threading.Event()
+            self.release = threading.Event()
+            self.loads = []
+
+        def window(self, cursor, table, *args, **kwargs):
+            self.loads.append(table)
+            if (table == 'genomicSuperDups'):
+                self.started.set()
+                assert self.release.wait(10)
+            return backends.SQLiteBackend.window(self, cursor, table, *args,
+                **kwargs)
+
+    source = BlockingSource()
+    conn = sqlite3.connect(reference.db, check_same_thread=False)
+    (chrom, pos), = conn.execute('select chrom, chromStart + 1 from ' +
+        'genomicSuperDups limit 1').fetchall()
+    prefetch = backends.PrefetchBackend(source, 10 ** 6,
+        ranges={backends.chromKey(chrom): (pos - 10 ** 6, pos + 10 ** 6)})
+
+    found = []
+    def lookup():
+        found.append(prefetch.overlap(conn.cursor(), 'genomicSuperDups',
+            chrom, pos))
+    threads = [threading.Thread(target=lookup) for k in range(2)]
+    for thread in threads:
+        thread.start()
+    assert source.started.wait(10)
+    # Another table's window loads while the first one is
+    assert prefetch.overlap(conn.cursor(), 'cpgIslandExt', chrom, pos) == \
+        source.overlap(conn.cursor(), 'cpgIslandExt', chrom, pos)
+    source.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    expected = source.overlap(conn.cursor(), 'genomicSuperDups', chrom, pos)
+    assert (found == [expected, expected]) and (len(expected) > 0)
+    # Loaded once, by one of the threads
+    assert source.loads.count('genomicSuperDups') == 1
+    conn.close()
+
+
+def test_point_lookup_matches_sql(reference, sql):
+    backend = backends.MemoryBackend(sql)
+    conn = sqlite3.connect(reference.db)
+    cursor = conn.cursor()
+    rows = conn.execute('select CHR, start, haplotypeReference from ' +
+        'chrom_pos_equal_base where rowid % 5 = 0').fetchall()
+    for (chr, start, ref) in rows:
+        for where in [{'CHR': chr, 'start': start},
+            {'CHR': chr, 'start': [start, start + 1, start + 2]},
+            {'CHR': chr, 'start': start, 'haplotypeReference': ref}]:
+            assert backend.point_lookup(cursor, 'chrom_pos_equal_base',
+                where) == sql.point_lookup(cursor, 'chrom_pos_equal_base',
+                where)
+    conn.close()
+
+
+@pytest.mark.parametrize('gap', [0, 1000, 10 ** 9])
+def test_unequal_windows_match_overlaps(reference, sql, gap):
+    loci = probes(reference, 'chrom_pos_unequal', 'CHR', 'start', 'end')
+    positions = {}
+    for (chrom, pos) in loci:
+        positions.setdefault(chrom, set()).add(pos)
+    conn = sqlite3.connect(reference.db)
+    cursor = conn.cursor()
+    found = 0
+    for chrom in positions:
+        rows = bigrefgene.unequalRowsAt(sql, cursor, chrom, positions[chrom],
+            gap=gap)
+        assert sorted(rows) == sorted(positions[chrom])
+        for pos in positions[chrom]:
+            assert rows[pos] == sql.overlap(cursor, 'chrom_pos_unequal',
+                chrom, pos, chrom_col='CHR', start_col='start', end_col='end')
+            found = found + len(rows[pos])
+    assert found > 0
+    conn.close()
+
+
+@pytest.mark.parametrize('options', [
+    dict(backend='memory'),
+    dict(prefetch_rows=10 ** 6),
+    dict(prefetch_rows=100),
+    dict(bin_index=True),
+    dict(transcript_models=True),
+    dict(cpg_index=True),
+    dict(bigrefgene_index=True),
+    dict(memo_size=0),
+    dict(inflight=4, concurrency=2),
+    dict(workers=2),
+    dict(workers=2, window=500000),
+], ids=lambda options: ','.join([k + '=' + str(v) for (k, v) in
+    options.items()]))
+def test_output_matches_sql(reference, tmp_path, options):
+    expected = annotate(reference, tmp_path / 'sql')
+    assert annotate(reference, tmp_path / 'other', **options) == expected
+
+### EOF
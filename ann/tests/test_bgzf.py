@@ -0,0 +1,86 @@
+# test_bgzf.py
+#
+# BGZF files written by bgzf.py read back as gzip, and their .gzi index
+# points at the start of each block
+#
+##
+
+import gzip
+import random
+import struct
+import zlib
+
+import bgzf
+
+
+"""Compressed offset, compressed size and uncompressed data of each
+block of a BGZF file, the EOF block included
+"""
+def readBlocks(data):
+    blocks = []
+    offset = 0
+    while (offset < len(data)):
+        assert data[offset:offset + 4] == b'\x1f\x8b\x08\x04'
+        assert data[offset + 12:offset + 16] == b'BC\x02\x00'
+        bsize = struct.unpack('<H', data[offset + 16:offset + 18])[0] + 1
+        block = zlib.decompress(data[offset + 18:offset + bsize - 8], -15)
+        crc, isize = struct.unpack('<II', data[offset + bsize - 8:
+            offset + bsize])
+        assert (crc, isize) == (zlib.crc32(block) & 0xffffffff, len(block))
+        blocks.append((offset, bsize, block))
+        offset = offset + bsize
+    return blocks
+
+
+def test_blocks_and_index(tmp_path):
+    rng = random.Random(1)
+    filename = str(tmp_path / 'out.vcf.gz')
+    text = ''.join(['\t'.join([str(rng.randint(1, 22)),
+        str(rng.randint(1, 10 ** 8)), '.', rng.choice('ACGT'),
+        rng.choice('ACGT')]) + '\n' for i in range(20000)])
+    with bgzf.BgzfWriter(filename) as writer:
+        for k in range(0, len(text), 1000):
+            writer.write(text[k:k + 1000])
+
+    with gzip.open(filename, 'rt') as fh:
+        assert fh.read() == text
+
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+    assert data.endswith(bgzf.EOF_BLOCK)
+    blocks = readBlocks(data)
+    assert len(blocks) > 3
+    assert all([len(block) <= bgzf.BLOCK_SIZE for (offset, bsize, block) in
+        blocks])
+    assert blocks[-1][2] == b''
+
+    with open(filename + '.gzi', 'rb') as fh:
+        index = fh.read()
+    count = struct.unpack('<Q', index[:8])[0]
+    entries = [struct.unpack('<QQ', index[8 + 16 * k:24 + 16 * k])
+        for k in range(count)]
+    assert len(index) == 8 + 16 * count
+    # Every block but the first and the EOF block, with the uncompressed
+    # offset it starts at
+    uoffset = len(blocks[0][2])
+    expected = []
+    for (offset, bsize, block) in blocks[1:-1]:
+        expected.append((offset, uoffset))
+        uoffset = uoffset + len(block)
+    assert entries == expected
+
+    encoded = text.encode('utf-8')
+    for ((offset, bsize, block), (coffset, start)) in zip(blocks[1:-1],
+        entries):
+        assert encoded[start:start + len(block)] == block
+
+
+def test_no_index(tmp_path):
+    filename = str(tmp_path / 'out.gz')
+    with bgzf.BgzfWriter(filename, index=False) as writer:
+        writer.write('x\n')
+    with gzip.open(filename, 'rt') as fh:
+        assert fh.read() == 'x\n'
+    assert not (tmp_path / 'out.gz.gzi').exists()
+
+### EOF
@@ -0,0 +1,60 @@
+# test_bins.py
+#
+# The UCSC binning scheme (bins.py) against reference values of the UCSC
+# genome browser's binRange.c
+#
+##
+
+import pytest
+
+import bins
+
+
+@pytest.mark.parametrize('start, end, expected', [
+    # Smallest (128 kb) level: bins 585 - 4680
+    (0, 1, 585),
+    (0, 128 * 1024, 585),
+    (128 * 1024, 128 * 1024 + 1, 586),
+    (1000000, 1000100, 592),
+    # Crossing a 128 kb boundary: 1 Mb level, bins 73 - 584
+    (128 * 1024 - 1, 128 * 1024 + 1, 73),
+    # Crossing a 1 Mb boundary: 8 Mb level, bins 9 - 72
+    (1024 * 1024 - 1, 1024 * 1024 + 1, 9),
+    # Crossing an 8 Mb boundary: 64 Mb level, bins 1 - 8
+    (8 * 1024 * 1024 - 1, 8 * 1024 * 1024 + 1, 1),
+    # Crossing a 64 Mb boundary: the single 512 Mb bin
+    (64 * 1024 * 1024 - 1, 64 * 1024 * 1024 + 1, 0),
+    (0, 1 << 29, 0),
+    # Last bin of the 128 kb level
+    ((1 << 29) - 1, 1 << 29, 4680),
+])
+def test_bin_from_range(start, end, expected):
+    assert bins.binFromRange(start, end) == expected
+
+
+def test_outside_the_standard_scheme():
+    assert bins.binFromRange(0, (1 << 29) + 1) is None
+    assert bins.binFromRange(-1, 10) is None
+    assert bins.overlappingBins(0, (1 << 29) + 1) is None
+    assert bins.overlappingBins(10, 10) is None
+
+
+def test_overlapping_bins():
+    # A position, as queried for chr1:1 by the UCSC browser
+    assert sorted(bins.overlappingBins(0, 1)) == [0, 1, 9, 73, 585]
+    # A range across a 128 kb boundary touches two bins of that level
+    assert sorted(bins.overlappingBins(128 * 1024 - 1, 128 * 1024 + 1)) == \
+        [0, 1, 9, 73, 585, 586]
+
+
+def test_overlapping_bins_hold_every_overlapping_row():
+    rows = [(s, s + length) for s in range(0, 3000000, 97651)
+        for length in (1, 1000, 150000, 1100000, 9000000)]
+    for (qstart, qend) in [(0, 1), (131071, 131073), (1048575, 1048577),
+        (2500000, 2600000)]:
+        candidates = set(bins.overlappingBins(qstart, qend))
+        for (start, end) in rows:
+            if (start < qend) and (end > qstart):
+                assert bins.binFromRange(start, end) in candidates
+
+### EOF
@@ -0,0 +1,79 @@
+# test_cache.py
+#
+# The cross-job lookup cache (cache.py)
+#
+##
+
+import os
+import itertools
+
+import pytest
+
+import cache
+import driver
+from cache import AnnotationCache
+
+
+def test_cache_needs_a_version(tmp_path):
+    path = os.path.join(str(tmp_path), 'cache.db')
+    results = AnnotationCache(path)
+    with pytest.raises(ValueError):
+        results.put('stage', None, [(('1', 100), 'a')])
+    with pytest.raises(ValueError):
+        results.get('stage', None, [('1', 100)])
+    results.close()
+    with pytest.raises(ValueError):
+        driver.getPipeline(cache_path=path)
+
+
+def test_only_stages_with_a_version_are_cached(tmp_path):
+    path = os.path.join(str(tmp_path), 'cache.db')
+    stages = driver.getPipeline(cache_path=path,
+        table_versions={'gwasCatalog': '2024-05'})
+    cached = [stage.referenceName() for (label, stage) in stages
+        if stage.cache is not None]
+    assert cached == ['gwasCatalog']
+    driver.closeCache([stage for (label, stage) in stages])
+
+
+def test_results_are_kept_per_version(tmp_path):
+    path = os.path.join(str(tmp_path), 'cache.db')
+    results = AnnotationCache(path)
+    results.put('stage', '2023', [(('1', 100), 'a')])
+    other = AnnotationCache(path)
+    assert other.get('stage', '2024', [('1', 100)]) == {}
+    assert other.get('stage', '2023', [('1', 100)]) == {('1', 100): 'a'}
+    results.close()
+    other.close()
+
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(cache.time, 'time', lambda: next(clock))
+    lru = AnnotationCache(os.path.join(str(tmp_path), 'cache.db'),
+        max_entries=10)
+    lru.check_every = 1
+    for k in range(10):
+        lru.put('stage', '1', [(('1', k), k)])
+    assert lru.get('stage', '1', [('1', 0)]) == {('1', 0): 0}
+    # Down to 90% of the entries: the two used least recently go
+    lru.put('stage', '1', [(('1', 10), 10)])
+    found = lru.get('stage', '1', [('1', k) for k in range(11)])
+    assert sorted([key[1] for key in found]) == [0] + list(range(3, 11))
+    lru.close()
+
+
+def test_inserts_are_counted_across_jobs(tmp_path):
+    path = os.path.join(str(tmp_path), 'cache.db')
+    for k in range(30):
+        # One cache per job, each inserting fewer than check_every entries
+        job = AnnotationCache(path, max_entries=20)
+        job.check_every = 10
+        job.put('stage', '1', [(('1', k), k)])
+        job.close()
+    job = AnnotationCache(path)
+    found = job.get('stage', '1', [('1', k) for k in range(30)])
+    assert len(found) <= 20
+    job.close()
+
+### EOF
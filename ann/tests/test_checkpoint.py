@@ -0,0 +1,103 @@
+# test_checkpoint.py
+#
+# Chained runs resume after their last completed stage (checkpoint.py)
+#
+##
+
+import os
+import json
+import shutil
+
+import pytest
+
+import annotate as ann
+import driver
+from checkpoint import Checkpoint
+
+
+class Interrupted(Exception):
+    pass
+
+
+"""Runs the chained pipeline with checkpoints over a copy of the
+reference's input in work_dir; returns the input file
+"""
+def runChained(reference, work_dir, **options):
+    os.makedirs(str(work_dir), exist_ok=True)
+    infile = os.path.join(str(work_dir), 'input.vcf')
+    if not os.path.exists(infile):
+        shutil.copy(reference.vcf, infile)
+    driver.runChained(infile, 'vcf', checkpoint=True, **options)
+    return infile
+
+
+def read(filename):
+    with open(filename) as fh:
+        return fh.read()
+
+
+def test_resume_after_last_completed_stage(reference, tmp_path,
+    monkeypatch):
+    expected = runChained(reference, tmp_path / 'full')
+
+    run_stage = ann.runStage
+    calls = []
+    def failingRunStage(stage, vcf, **kwargs):
+        calls.append(stage)
+        if (len(calls) == 4) and not resuming:
+            # Interrupted part way, after writing to the count log
+            with open(vcf + '.count.log', 'a') as fh:
+                fh.write('partial\n')
+            raise Interrupted()
+        run_stage(stage, vcf, **kwargs)
+    monkeypatch.setattr(ann, 'runStage', failingRunStage)
+    resuming = False
+
+    with pytest.raises(Interrupted):
+        runChained(reference, tmp_path / 'resumed')
+    infile = os.path.join(str(tmp_path / 'resumed'), 'input.vcf')
+    with open(infile + '.checkpoint.json') as fh:
+        assert len(json.load(fh)['stages']) == 3
+
+    calls.clear()
+    resuming = True
+    runChained(reference, tmp_path / 'resumed')
+    assert len(calls) == len(driver.getStages()) - 3
+    assert not os.path.exists(infile + '.checkpoint.json')
+
+    assert read(driver.getOutputFile(infile)) == \
+        read(driver.getOutputFile(expected))
+    assert read(infile + '.count.log') == read(expected + '.count.log')
+
+
+def test_other_pipeline_starts_over(tmp_path):
+    infile = os.path.join(str(tmp_path), 'input.vcf')
+    log_file = infile + '.count.log'
+
+    class Stage(object):
+        profile = ann.profiling.StageProfile()
+        def getCounts(self):
+            return {'var_count': 1}
+
+    checkpoint = Checkpoint(infile, ['a', 'b'])
+    for k in range(2):
+        with open(infile + '.' + str(k + 1), 'w') as fh:
+            fh.write('stage output\n')
+        with open(log_file, 'a') as fh:
+            fh.write('stage ' + str(k) + '\n')
+        checkpoint.complete(k, Stage(), '.' + str(k + 1), log_file)
+
+    assert Checkpoint(infile, ['a', 'b']).load() == 2
+    assert Checkpoint(infile, ['a', 'c']).load() == 0
+
+    # The log is cut back to the last completed stage
+    with open(log_file, 'a') as fh:
+        fh.write('partial\n')
+    checkpoint.restoreLog(log_file)
+    assert read(log_file) == 'stage 0\nstage 1\n'
+
+    # Without the last stage's output there is nothing to resume from
+    os.unlink(infile + '.2')
+    assert Checkpoint(infile, ['a', 'b']).load() == 0
+
+### EOF
@@ -0,0 +1,80 @@
+# test_dbsnp_filter.py
+#
+# The dbSNP membership filter (dbsnp_filter.py) never rules out a variant
+# that is in the table
+#
+##
+
+import json
+import random
+import sqlite3
+
+import pytest
+
+import dbsnp_filter
+
+from conftest import annotate
+
+
+def dbSnpRows(reference):
+    conn = sqlite3.connect(reference.db)
+    rows = conn.execute('select CHR, POS, REF from dbSNP').fetchall()
+    conn.close()
+    return rows
+
+
+@pytest.mark.parametrize('max_mb', [None, 0.001])
+def test_no_false_negatives(reference, tmp_path, max_mb):
+    filename = str(tmp_path / 'dbsnp.bloom')
+    header = dbsnp_filter.buildFilter(filename, 'test', fpr=0.01,
+        max_mb=max_mb)
+    rows = dbSnpRows(reference)
+    assert header['keys'] == len(rows) > 0
+
+    membership = dbsnp_filter.DbSnpFilter(filename)
+    for (chrom, pos, ref) in rows:
+        assert membership.mayContain(chrom, pos, ref)
+        # Looked up as the stage sees variants: with or without the chr
+        # prefix, and in any case
+        assert membership.mayContain('chr' + str(chrom).replace('chr', ''),
+            str(pos), str(ref).lower())
+    membership.close()
+
+
+def test_output_matches_unfiltered(reference, tmp_path):
+    filename = str(tmp_path / 'dbsnp.bloom')
+    dbsnp_filter.buildFilter(filename, 'test', max_mb=0.001)
+    expected = annotate(reference, tmp_path / 'unfiltered',
+        reference_version='test')
+    assert annotate(reference, tmp_path / 'filtered',
+        reference_version='test', dbsnp_filter=filename) == expected
+    with open(str(tmp_path / 'filtered' / 'input.vcf.profile.json')) as fh:
+        assert json.load(fh)['stages'][0]['filter_skips'] > 0
+
+
+def test_false_positive_rate(reference, tmp_path):
+    filename = str(tmp_path / 'dbsnp.bloom')
+    dbsnp_filter.buildFilter(filename, 'test', fpr=0.01)
+    membership = dbsnp_filter.DbSnpFilter(filename)
+    present = set([(dbsnp_filter.filterKey(*row)) for row in
+        dbSnpRows(reference)])
+    rng = random.Random(1)
+    absent = [('1', rng.randint(1, 10 ** 9), 'A') for i in range(20000)]
+    absent = [key for key in absent if dbsnp_filter.filterKey(*key) not in
+        present]
+    hits = len([key for key in absent if membership.mayContain(*key)])
+    assert hits < 0.03 * len(absent)
+    membership.close()
+
+
+def test_only_covers_its_release(reference, tmp_path):
+    filename = str(tmp_path / 'dbsnp.bloom')
+    dbsnp_filter.buildFilter(filename, '155')
+    membership = dbsnp_filter.DbSnpFilter(filename)
+    assert membership.covers('dbSNP', '155')
+    assert not membership.covers('dbSNP', '156')
+    assert not membership.covers('dbSNP', None)
+    assert not membership.covers('other', '155')
+    membership.close()
+
+### EOF
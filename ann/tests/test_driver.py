@@ -0,0 +1,34 @@
+# test_driver.py
+#
+# Tests of the pipeline's assembly in driver.py
+#
+##
+
+import annotate as ann
+import driver
+from conftest import annotate
+
+
+def test_stage_labels_are_unique():
+    labels = [label for (label, stage) in driver.getStages()]
+    assert len(labels) == len(set(labels))
+
+
+def test_reference_versions_only_for_known_versions():
+    stages = [stage for (label, stage) in driver.getStages()]
+    header = ['##fileformat=VCFv4.2', '#CHROM\tPOS']
+    assert ann.addReferenceVersions(list(header), stages) == header
+
+    stages[0].version = '155'
+    lines = ann.addReferenceVersions(list(header), stages)
+    assert lines == [header[0],
+        '##annotationReference=<ID=' + stages[0].referenceName() +
+        ',Version=155>', header[1]]
+
+
+def test_concurrent_lookups_match_serial(reference, tmp_path):
+    serial = annotate(reference, tmp_path / 'serial')
+    assert annotate(reference, tmp_path / 'concurrent', concurrency=4) == \
+        serial
+
+### EOF
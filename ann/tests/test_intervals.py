@@ -0,0 +1,38 @@
+# test_intervals.py
+#
+# In-memory interval indices return overlaps in the order of the SQL
+# overlap query, which is the order they were loaded in
+#
+##
+
+import sqlite3
+
+import backends
+import intervals
+
+
+def test_chrom_index_keeps_given_order():
+    rows = [(10, 50, 'a'), (5, 60, 'b'), (10, 20, 'c'), (30, 40, 'd'),
+        (5, 8, 'e')]
+    index = intervals.ChromIndex(rows)
+    assert index.overlap(15) == ['a', 'b', 'c']
+    assert index.overlap(7) == ['b', 'e']
+    assert index.overlap(9, margin=1) == ['a', 'b', 'c', 'e']
+    assert index.overlap(100) == []
+
+
+def test_first_matches_query(reference):
+    conn = sqlite3.connect(reference.db)
+    columns = ['chrom', 'chromStart', 'chromEnd', 'name']
+    index = intervals.IntervalIndex(conn.cursor(), backends.SQLiteBackend(),
+        'cpgIslandExt', columns)
+    for (chrom, pos) in conn.execute('select chrom, chromStart + 1 from ' +
+        'cpgIslandExt').fetchall():
+        expected = conn.execute('select ' + ', '.join(columns) +
+            ' from cpgIslandExt where chrom = ? and chromStart <= ? and ' +
+            'chromEnd >= ? limit 1',
+            (chrom, pos, pos)).fetchone()
+        assert index.first(chrom, pos) == expected
+    assert index.first('chrUn', 1) is None
+
+### EOF
@@ -0,0 +1,95 @@
+# test_pileup2vcf.py
+#
+# The streaming pileup converter (pileup2vcf.py) writes what the original
+# line by line converter wrote
+#
+##
+
+import gzip
+import random
+
+import pytest
+
+import driver
+import pileup2vcf
+
+HETERO = {'M': 'AC', 'R': 'AG', 'W': 'AT', 'S': 'CG', 'Y': 'CT', 'K': 'GT'}
+
+
+"""The VCF line of a pileup line, as the original converter made it
+"""
+def oldLine(line):
+    fields = line.strip().split('\t')
+    chr, pos, ref, alt = fields[0:4]
+    if not ((alt != ref) and (chr.strip() in pileup2vcf.ACCEPTED_CHR)):
+        return None
+    consqual, snpqual, mapqual, depth, bases = fields[4:9]
+    bases = bases.upper()
+    alt_count = int(depth) - (bases.count('.') + bases.count(',') +
+        bases.count('*'))
+    GT = '1/1'
+    if alt in HETERO:
+        GT = '0/1'
+        alt = HETERO[alt][1] if (ref == HETERO[alt][0]) else HETERO[alt][0]
+    return '\t'.join([chr, pos, '.', ref, alt, mapqual, 'PASS', '.',
+        'GT:GQ:DP:AD', GT + ':' + consqual + ':' + depth + ':' +
+        str(alt_count)])
+
+
+def pileupLines(count, rng):
+    lines = []
+    for i in range(count):
+        chr = rng.choice(pileup2vcf.ACCEPTED_CHR + ['chr1', 'GL000192.1',
+            'M'])
+        ref = rng.choice('ACGT')
+        alt = rng.choice([ref, rng.choice('ACGT'), rng.choice(list(HETERO))])
+        depth = rng.randint(1, 60)
+        bases = ''.join([rng.choice('..,,ACGTacgt*^]$') for j in
+            range(depth)])
+        fields = [chr, str(rng.randint(1, 10 ** 8)), ref, alt,
+            str(rng.randint(0, 99)), str(rng.randint(0, 99)),
+            str(rng.randint(0, 60)), str(depth), bases]
+        if rng.random() < 0.5:
+            # Base qualities, which the converter ignores
+            fields.append(''.join([rng.choice('!#5?I') for j in
+                range(depth)]))
+        lines.append('\t'.join(fields))
+    return lines
+
+
+def body(lines):
+    return [line for line in lines if not line.startswith('##fileDate=')]
+
+
+@pytest.mark.parametrize('gz', [False, True])
+def test_matches_old_converter(tmp_path, gz):
+    lines = pileupLines(3000, random.Random(1))
+    pileup = str(tmp_path / ('sample.pileup' + ('.gz' if gz else '')))
+    with (gzip.open(pileup, 'wt') if gz else open(pileup, 'w')) as fh:
+        fh.write('\n'.join(lines) + '\n')
+    outfile = str(tmp_path / 'sample.vcf')
+
+    count = pileup2vcf.filter_pileup(pileup, outfile, chunk_size=7)
+    with open(outfile) as fh:
+        written = fh.read().splitlines()
+
+    expected = [line for line in [oldLine(line) for line in lines]
+        if line is not None]
+    header = pileup2vcf.vcfheader(pileup).split('\n')
+    assert count == len(expected)
+    assert body(written) == body(header) + expected
+    assert header[-1].endswith('\tsample')
+
+
+def test_convert_pileup(tmp_path):
+    lines = pileupLines(100, random.Random(2))
+    pileup = str(tmp_path / 'upload.pileup')
+    with open(pileup, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    vcf, count = driver.convertPileup(pileup)
+    assert vcf == str(tmp_path / 'upload.vcf')
+    with open(vcf) as fh:
+        assert len([line for line in fh if not line.startswith('#')]) == count
+    assert count == len([line for line in lines if oldLine(line) is not None])
+
+### EOF
@@ -0,0 +1,82 @@
+# test_records.py
+#
+# Variant records passed between stages (records.py) behave like the text
+# lines the chained pipeline writes and reads back
+#
+##
+
+import io
+
+import pytest
+
+import records
+
+INDS = (0, 1, 3, 4)
+
+LINES = [
+    '1\t100\t.\tA\tG\t50\tPASS\tDP=10',
+    'chr2\t200\trs1\tAC\tA\t.\t.\t.\tGT\t0/1',
+    '3\t300\t.\t"T"\tC',
+]
+
+
+def test_locate():
+    variant = records.Variant(LINES[1].split('\t')).locate(INDS)
+    assert (variant.chrom, variant.chr_chrom, variant.pos, variant.ref,
+        variant.alt) == ('2', 'chr2', 200, 'AC', 'A')
+    variant = records.Variant(LINES[2].split('\t')).locate(INDS)
+    assert (variant.chrom, variant.chr_chrom, variant.ref) == ('3', 'chr3',
+        'T')
+
+
+@pytest.mark.parametrize('line', LINES)
+@pytest.mark.parametrize('fragments', [[], [';X=1'], [' ', 'Y'], ['\t']])
+def test_restrip_reads_back_like_text(line, fragments):
+    variant = records.Variant(line.split('\t')).locate(INDS)
+    if variant.info is not None:
+        for fragment in fragments:
+            variant.appendInfo(fragment)
+    variant.fields[0] = ' ' + variant.fields[0]
+    text = variant.render()
+    restripped = variant.restrip()
+    assert restripped.render() == text.strip()
+    assert (restripped.chrom, restripped.pos, restripped.ref,
+        restripped.alt) == (variant.chrom, variant.pos, variant.ref,
+        variant.alt)
+
+
+@pytest.mark.parametrize('line', LINES)
+def test_indent_unindent(line):
+    variant = records.Variant(line.split('\t'))
+    if variant.info is not None:
+        variant.appendInfo(';X=1')
+    text = variant.render()
+    variant.indent(' ')
+    assert variant.render() == '\t '.join(text.split('\t'))
+    variant.unindent(' ')
+    assert variant.render() == text
+    # Left as is unless every column is indented
+    variant.unindent(' ')
+    assert variant.render() == text
+
+
+def test_spill_round_trip():
+    items = ['##fileformat=VCFv4.2', '#CHROM\tPOS']
+    for line in LINES:
+        variant = records.Variant(line.split('\t'))
+        if variant.info is not None:
+            variant.appendInfo(';X=1')
+            variant.appendInfo('')
+        items.append(variant)
+    fh = io.BytesIO()
+    records.writeSpill(fh, items[:3])
+    records.writeSpill(fh, items[3:])
+    fh.seek(0)
+    chunks = list(records.readSpill(fh))
+    assert [len(chunk) for chunk in chunks] == [3, 2]
+    read = chunks[0] + chunks[1]
+    assert records.renderAll(read) == records.renderAll(items)
+    assert [item.info for item in read[2:]] == [item.info for item in
+        items[2:]]
+
+### EOF
@@ -0,0 +1,98 @@
+# test_snapshot.py
+#
+# Compiled reference snapshots answer overlaps like the SQL queries
+#
+##
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import annotate as ann
+import compile_reference
+import driver
+import snapshot as snap
+
+from conftest import annotate
+
+
+@pytest.fixture(scope='module')
+def snapshot_dir(reference, tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('snapshot'))
+    compile_reference.compileReference(root,
+        sorted(snap.TABLES) + [snap.TFBS_TABLE], 'test')
+    return root
+
+
+def test_overlap_order_matches_sql(reference, snapshot_dir):
+    import sqlite3
+    reference_snapshot = snap.Snapshot(snapshot_dir)
+    conn = sqlite3.connect(reference.db)
+    for (chrom, pos) in conn.execute('select chrom, chromStart + 1 from ' +
+        'genomicSuperDups limit 200').fetchall():
+        expected = [tuple(str(x) for x in row) for row in conn.execute(
+            'select * from genomicSuperDups where chrom = ? and ' +
+            'chromStart <= ? and chromEnd >= ?',
+            (chrom, pos, pos)).fetchall()]
+        assert reference_snapshot.overlap('genomicSuperDups', chrom,
+            pos) == expected
+
+
+@pytest.mark.parametrize('sweep', [True, False])
+def test_output_matches_sql(reference, snapshot_dir, tmp_path, sweep):
+    expected = annotate(reference, tmp_path / 'sql')
+    assert annotate(reference, tmp_path / 'snapshot',
+        snapshot_dir=snapshot_dir, sweep=sweep) == expected
+
+
+def test_snapshot_version_only_for_its_tables(snapshot_dir, tmp_path):
+    path = str(tmp_path / 'cache.db')
+    for reference_version in [None, '2024']:
+        stages = [stage for (label, stage) in driver.getPipeline(
+            snapshot_dir=snapshot_dir, cache_path=path,
+            reference_version=reference_version)]
+        for stage in stages:
+            if stage.servedBySnapshot():
+                assert stage.version == 'test'
+            else:
+                # Served by the database, whose release the snapshot's
+                # version says nothing about
+                assert stage.version == reference_version
+            assert (stage.cache is not None) == (stage.version is not None)
+        assert len([stage for stage in stages
+            if not stage.servedBySnapshot()]) == 3
+        driver.closeCache(stages)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_headers_only_for_snapshot_tables(reference, snapshot_dir, tmp_path,
+    workers):
+    import os
+    import shutil
+    infile = os.path.join(str(tmp_path), 'input.vcf')
+    shutil.copy(reference.vcf, infile)
+    driver.run(infile, 'vcf', snapshot_dir=snapshot_dir, workers=workers)
+    with open(driver.getOutputFile(infile)) as fh:
+        lines = [line.rstrip('\n') for line in fh
+            if line.startswith('##annotationReference=')]
+    stages = [stage for (label, stage) in driver.getPipeline(
+        snapshot_dir=snapshot_dir) if stage.servedBySnapshot()]
+    assert sorted(lines) == sorted(['##annotationReference=<ID=' +
+        stage.referenceName() + ',Version=test>' for stage in stages])
+
+
+def test_unsorted_input_falls_back_once(snapshot_dir):
+    stage = ann.GenomicSuperDupsStage(table='genomicSuperDups')
+    stage.snapshot = snap.Snapshot(snapshot_dir)
+    stage.sweeps = {}
+    found = 0
+    for (chrom, pos) in [('chr1', 1000), ('chr1', 5000), ('chr1', 2000),
+        ('chr2', 10), ('chr1', 3000)]:
+        rows = stage.snapshotOverlap('genomicSuperDups', chrom, pos)
+        assert rows == stage.snapshot.overlap('genomicSuperDups', chrom, pos)
+        found = found + len(rows)
+    assert found > 0
+    assert not stage.sweeps['genomicSuperDups'].sorted
+    assert stage.profile.sweep_fallbacks == 1
+
+### EOF
@@ -0,0 +1,175 @@
+# transcripts.py
+#
+# Pre-parsed refGene transcript models: transcript and CDS bounds, strand
+# and exon boundaries held in compact integer arrays, for classifying
+# variant positions without re-parsing the exon lists of every row
+#
+##
+
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def decode(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return str(value)
+
+
+"""Transcripts of a set of refGene rows (e.g. those of one chromosome, or
+those returned by a query), sorted by txStart, with their position in
+the order of the rows given (that of the overlap query, see
+backends.SqlBackend.chromRows()). Transcript i has exons exonOffsets[i]
+to exonOffsets[i + 1] of exonStarts/exonEnds.
+
+Only the name, strand and name2 columns are kept of each row, as the
+{column index: value} dict that annotate.collapseGeneNames() reads.
+"""
+class TranscriptSet(object):
+    def __init__(self, rows):
+        order = sorted(range(len(rows)), key=lambda i: (int(rows[i][4]), i))
+        self.order = array('l', order)
+        self.txStarts = array('l')
+        self.txEnds = array('l')
+        self.cdsStarts = array('l')
+        self.cdsEnds = array('l')
+        self.strands = []
+        self.names = []
+        self.exonOffsets = array('l', [0])
+        self.exonStarts = array('l')
+        self.exonEnds = array('l')
+        # Whether a transcript's exons are sorted and disjoint, so that
+        # they can be binary searched
+        self.ordered = bytearray()
+
+        for i in order:
+            row = rows[i]
+            self.txStarts.append(int(row[4]))
+            self.txEnds.append(int(row[5]))
+            self.cdsStarts.append(int(row[6]))
+            self.cdsEnds.append(int(row[7]))
+            self.strands.append(str(row[3]))
+            self.names.append({1: row[1], 3: row[3], 12: row[12]})
+
+            exonCount = int(row[8])
+            starts = decode(row[9]).split(',')
+            ends = decode(row[10]).split(',')
+            ordered = 1
+            for e in range(0, exonCount):
+                start = int(starts[e])
+                end = int(ends[e])
+                if (end < start) or ((e > 0) and
+                    (start <= self.exonEnds[-1])):
+                    ordered = 0
+                self.exonStarts.append(start)
+                self.exonEnds.append(end)
+            self.exonOffsets.append(len(self.exonStarts))
+            self.ordered.append(ordered)
+
+        # Running maximum of txEnd, to find the first transcript that can
+        # still reach a position
+        self.maxEnds = array('l')
+        for end in self.txEnds:
+            self.maxEnds.append(max(end, self.maxEnds[-1])
+                if (len(self.maxEnds) > 0) else end)
+
+    def __len__(self):
+        return len(self.txStarts)
+
+    """Transcripts with txStart - offset <= pos <= txEnd + offset, in the
+    order of the rows given, i.e. that of the per-position query
+    """
+    def overlapping(self, pos, offset=0):
+        hi = bisect_right(self.txStarts, pos + offset)
+        lo = bisect_left(self.maxEnds, pos - offset)
+        hits = [i for i in range(lo, hi) if (self.txEnds[i] + offset >= pos)]
+        hits.sort(key=lambda i: self.order[i])
+        return hits
+
+    def exonCount(self, i):
+        return self.exonOffsets[i + 1] - self.exonOffsets[i]
+
+    """Exons e of transcript i (0-based, ascending) with start <= pos <= end
+    """
+    def exonsAt(self, i, pos):
+        first = self.exonOffsets[i]
+        last = self.exonOffsets[i + 1]
+        if not self.ordered[i]:
+            return [e - first for e in range(first, last) if
+                (self.exonStarts[e] <= pos) and (pos <= self.exonEnds[e])]
+
+        # Exons are disjoint and sorted, so their ends are increasing: the
+        # hits are the exons before the last one starting at or before pos
+        # that still end at or after it
+        exons = []
+        e = bisect_right(self.exonStarts, pos, first, last) - 1
+        while (e >= first) and (self.exonEnds[e] >= pos):
+            exons.append(e - first)
+            e = e - 1
+        exons.reverse()
+        return exons
+
+
+"""Transcripts of the rows a per-position query returned, read in place
+with the interface of TranscriptSet: for the few rows of a single
+variant, sorting them and copying them into arrays would cost more than
+it saves. Rows are kept in the order given, and their exon lists are
+only parsed by exonsAt().
+"""
+class TranscriptRows(object):
+    def __init__(self, rows):
+        self.txStarts = [int(row[4]) for row in rows]
+        self.txEnds = [int(row[5]) for row in rows]
+        self.cdsStarts = [int(row[6]) for row in rows]
+        self.cdsEnds = [int(row[7]) for row in rows]
+        self.strands = [str(row[3]) for row in rows]
+        # Rows have the columns collapseGeneNames() reads
+        self.names = rows
+
+    def __len__(self):
+        return len(self.names)
+
+    """All of the transcripts, which the query matched, in its order
+    """
+    def overlapping(self, pos, offset=0):
+        return list(range(len(self.names)))
+
+    def exonCount(self, i):
+        return int(self.names[i][8])
+
+    def exonsAt(self, i, pos):
+        starts = decode(self.names[i][9]).split(',')
+        ends = decode(self.names[i][10]).split(',')
+        return [e for e in range(self.exonCount(i))
+            if (int(starts[e]) <= pos) and (pos <= int(ends[e]))]
+
+
+"""All transcripts of a refGene table, per chromosome, read a chromosome
+at a time from the SQL backend (see backends.SqlBackend.chromRows())
+"""
+class TranscriptModels(object):
+    def __init__(self, cursor, backend, table='refGene'):
+        self.chroms = {}
+        for chrom in backend.chroms(cursor, table):
+            self.chroms[str(chrom)] = TranscriptSet(backend.chromRows(cursor,
+                table, chrom, start_col='txStart', end_col='txEnd'))
+        self.empty = TranscriptSet([])
+
+    def chrom(self, chrom):
+        return self.chroms.get(chrom, self.empty)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+"""Get the transcript models of a table, loading them from backend on
+first use in this process
+"""
+def getModels(cursor, backend, table='refGene'):
+    with _models_lock:
+        if table not in _models:
+            _models[table] = TranscriptModels(cursor, backend, table=table)
+        return _models[table]
+
+### EOF
@@ -13,24 +13,85 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
+# Seconds for which the RDS secret is reused before it is fetched again
+CREDENTIALS_TTL = int(os.environ['ANN_DB_CREDENTIALS_TTL']) if \
+    ('ANN_DB_CREDENTIALS_TTL' in os.environ) else 3600
+
+# Maximum number of open reference database connections per process
+POOL_SIZE = int(os.environ['ANN_DB_POOL_SIZE']) if \
+    ('ANN_DB_POOL_SIZE' in os.environ) else 4
+
+# SQLite database standing in for the reference database, e.g. one built
+# by benchmark.py; the RDS database is used if not set
+SQLITE_DB = os.environ['ANN_DB_SQLITE'] if \
+    ('ANN_DB_SQLITE' in os.environ) else None
+
+_credentials = None
+_credentials_time = 0
+_credentials_lock = threading.Lock()
+
+"""Get RDS credentials from AWS Secrets Manager, cached for
+CREDENTIALS_TTL seconds
+"""
+def db_credentials(refresh=False):
+    global _credentials, _credentials_time
+
+    with _credentials_lock:
+        if (refresh or (_credentials is None) or
+            (time.time() - _credentials_time > CREDENTIALS_TTL)):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _credentials = json.loads(asm_response['SecretString'])
+                _credentials_time = time.time()
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _credentials
+
+
+"""Connection to a local SQLite copy of the reference database, with the
+parts of the pymysql connection interface the annotator uses
+"""
+class SqliteConnection(object):
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+
+    # Cursor classes (e.g. pymysql.cursors.SSCursor) do not apply
+    def cursor(self, cursor_class=None):
+        return self.conn.cursor()
+
+    def ping(self, reconnect=False):
+        pass
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
 """Get connection to reference database
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+def db_connect(refresh=False):
+    if SQLITE_DB:
+        return SqliteConnection(SQLITE_DB)
+
+    rds_secret = db_credentials(refresh=refresh)
 
     # Extract database connection parameters
     rds_host = rds_secret['host']
@@ -48,6 +109,116 @@ def db_connect():
         db=database_name)
 
 
+"""Pool of reference database connections, shared by all stages and jobs
+running in a process. Connections are checked before they are handed
+out and reopened (with freshly fetched credentials, in case the secret
+was rotated) if they went stale.
+"""
+class ConnectionPool(object):
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    """Hands out a connection; with block=False, returns None instead of
+    waiting if all of them are in use
+    """
+    def acquire(self, block=True):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = (self.created < self.size)
+                if create:
+                    self.created = self.created + 1
+            if create:
+                try:
+                    return db_connect()
+                except Exception:
+                    with self.lock:
+                        self.created = self.created - 1
+                    raise
+            if not block:
+                return None
+            # Wait for another stage or job to return a connection
+            conn = self.idle.get()
+
+        try:
+            conn.ping(reconnect=True)
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            try:
+                conn = db_connect(refresh=True)
+            except Exception:
+                with self.lock:
+                    self.created = self.created - 1
+                raise
+        return conn
+
+    def release(self, conn):
+        self.idle.put(conn)
+
+    """Borrow a connection for the duration of a with block
+    """
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self.lock:
+                self.created = self.created - 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+"""Get the process-wide reference database connection pool
+"""
+def db_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(size=POOL_SIZE)
+        return _pool
+
+
+"""Forked worker processes must not share the parent's sockets, so they
+start with an empty pool of their own
+"""
+def _reset_pool():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+
+"""Borrow a pooled connection to the reference database:
+
+    with u.db_connection() as conn:
+        cursor = conn.cursor()
+"""
+def db_connection():
+    return db_pool().connection()
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):